@@ -21,6 +21,7 @@ from components.download import download_section
 from components.action_fixed import action_section
 from components.realtime_mapping import realtime_mapping_section
 from components.global_map import global_forest_health_section
+from utils.image_store import SessionImageStore
 
 # Set page configuration
 st.set_page_config(
@@ -39,12 +40,17 @@ def load_css():
 load_css()
 
 # Initialize session state variables if they don't exist
-if 'uploaded_image' not in st.session_state:
-    st.session_state.uploaded_image = None
-if 'analyzed_image' not in st.session_state:
-    st.session_state.analyzed_image = None
+# Uploaded and analyzed images live in a per-session store that keeps each
+# distinct image once and moves cold ones out of memory
+if 'images' not in st.session_state:
+    st.session_state.images = SessionImageStore()
+    # Uploads still being decoded, by image name
+    st.session_state.uploads = {}
 if 'deforested_areas' not in st.session_state:
     st.session_state.deforested_areas = None
+if 'geotransform' not in st.session_state:
+    st.session_state.geotransform = None
+    st.session_state.roi = None
 if 'analysis_complete' not in st.session_state:
     st.session_state.analysis_complete = False
 if 'selected_location' not in st.session_state:
@@ -55,7 +61,13 @@ if 'prev_location' not in st.session_state:
 if 'theme' not in st.session_state:
     st.session_state.theme = "light"
 if 'timelapse_images' not in st.session_state:
-    st.session_state.timelapse_images = {}
+    st.session_state.timelapse_images = None
+if 'loss_year' not in st.session_state:
+    st.session_state.loss_year = None
+    st.session_state.loss_year_years = []
+if 'change_mask' not in st.session_state:
+    # Change mask of the last analysis, a tiled raster in the analysis cache
+    st.session_state.change_mask = None
 if 'time_series_data' not in st.session_state:
     st.session_state.time_series_data = None
 if 'forest_loss_stats' not in st.session_state:
@@ -535,6 +547,15 @@ elif location == "Custom Upload":
 st.sidebar.markdown("---")
 st.sidebar.markdown("<small>*Data reflects most recent available statistics. Sources include global forest monitoring agencies and satellite data aggregators.</small>", unsafe_allow_html=True)
 
+# Memory held by this session's images
+image_usage = st.session_state.images.memory_usage()
+if image_usage["images"]:
+    st.sidebar.caption(
+        f"🖼️ Session images: {image_usage['images']} stored, "
+        f"{image_usage['memory_bytes'] / 2**20:.1f} MB in memory, "
+        f"{image_usage['spilled_bytes'] / 2**20:.1f} MB on disk"
+    )
+
 if location != st.session_state.selected_location:
     # Store previous location before changing
     st.session_state.prev_location = st.session_state.selected_location
@@ -602,11 +623,14 @@ if page == "Overview Dashboard":
         from utils.mapping import create_map_with_deforestation
         
         coordinates = get_coordinates_for_location(st.session_state.selected_location)
+        analyzed_image = st.session_state.images.get("analyzed_image")
         map_view = create_map_with_deforestation(
             center_lat=coordinates["lat"],
             center_lon=coordinates["lon"],
             zoom=coordinates["zoom"],
-            deforested_areas=st.session_state.deforested_areas if 'deforested_areas' in st.session_state else None
+            deforested_areas=st.session_state.deforested_areas if 'deforested_areas' in st.session_state else None,
+            image_size=analyzed_image.size if analyzed_image is not None else None,
+            geotransform=st.session_state.geotransform
         )
         
         from streamlit_folium import folium_static
@@ -645,16 +669,17 @@ if page == "Overview Dashboard":
         )
         
         if quick_upload is not None:
-            from PIL import Image
+            from utils.pyramid import FULL_WIDTH_PX
+            from components.upload import ingest_upload, collect_upload, upload_preview
             
             try:
-                # Read and display the uploaded image
-                image = Image.open(quick_upload)
-                st.image(image, caption="Uploaded Image", use_container_width=True)
+                # Decode in the background and display a preview meanwhile
+                ingest_upload(quick_upload, "uploaded_image")
+                st.image(upload_preview("uploaded_image", FULL_WIDTH_PX), caption="Uploaded Image", use_container_width=True)
                 
                 # Add a button to redirect to the full analysis page
                 if st.button("Proceed to Full Analysis"):
-                    st.session_state.uploaded_image = image
+                    collect_upload("uploaded_image", wait=True)
                     # We'll use the session state to track that we want to switch to the upload section
                     st.session_state.redirect_to_upload = True
                     st.rerun()
@@ -0,0 +1,229 @@
+"""
+Headless batch deforestation analysis over before/after image pairs.
+
+Pairs come from a directory or a manifest file and are analyzed by a pool
+of worker processes. One JSON line is written per pair as soon as it
+finishes, and finished pair ids are appended to a checkpoint file so an
+interrupted run can be resumed with the same command.
+
+Examples:
+    python batch_analyze.py scenes/ --output results.jsonl --checkpoint done.txt
+    python batch_analyze.py pairs.csv --workers 8 --save-images annotated/
+"""
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image
+
+from utils.tiling import process_satellite_scene
+from utils.cache import cached_process_satellite_scene
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff")
+
+def find_pairs(source):
+    """
+    Collect before/after pairs from a directory or a manifest file.
+    
+    A directory may hold '<id>_before.<ext>' and '<id>_after.<ext>' files,
+    or 'before/' and 'after/' subdirectories with matching file names.
+    A manifest is a CSV file with 'id', 'before' and 'after' columns or a
+    JSON-lines file with the same keys; relative paths are resolved against
+    the manifest's directory.
+    
+    Parameters:
+    -----------
+    source : str
+        Directory or manifest path
+    
+    Returns:
+    --------
+    list
+        Dictionaries with 'id', 'before' and 'after' paths, sorted by id
+    """
+    pairs = {}
+    
+    if os.path.isdir(source):
+        before_dir = os.path.join(source, "before")
+        after_dir = os.path.join(source, "after")
+        if os.path.isdir(before_dir) and os.path.isdir(after_dir):
+            for name in os.listdir(before_dir):
+                if name.lower().endswith(IMAGE_EXTENSIONS) and os.path.exists(os.path.join(after_dir, name)):
+                    pairs[os.path.splitext(name)[0]] = {
+                        "before": os.path.join(before_dir, name),
+                        "after": os.path.join(after_dir, name),
+                    }
+        else:
+            for name in os.listdir(source):
+                stem, ext = os.path.splitext(name)
+                if ext.lower() not in IMAGE_EXTENSIONS:
+                    continue
+                for suffix in ("_before", "_after"):
+                    if stem.endswith(suffix):
+                        pair_id = stem[:-len(suffix)]
+                        pairs.setdefault(pair_id, {})[suffix[1:]] = os.path.join(source, name)
+    else:
+        base_dir = os.path.dirname(os.path.abspath(source))
+        with open(source, newline="") as f:
+            if source.endswith((".jsonl", ".json")):
+                rows = [json.loads(line) for line in f if line.strip()]
+            else:
+                rows = list(csv.DictReader(f))
+        for row in rows:
+            pairs[str(row["id"])] = {
+                "before": os.path.join(base_dir, row["before"]),
+                "after": os.path.join(base_dir, row["after"]),
+            }
+    
+    return [
+        {"id": pair_id, "before": paths["before"], "after": paths["after"]}
+        for pair_id, paths in sorted(pairs.items())
+        if "before" in paths and "after" in paths
+    ]
+
+def load_checkpoint(path):
+    """Return the set of pair ids already recorded in a checkpoint file."""
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip()}
+
+def analyze_pair(pair, params, save_dir=None, use_cache=False):
+    """
+    Analyze one before/after pair; runs inside a worker process.
+    
+    Returns:
+    --------
+    dict
+        JSON-serializable result with detections and timings, or an 'error'
+    """
+    result = {"id": pair["id"], "before": pair["before"], "after": pair["after"]}
+    started = time.perf_counter()
+    try:
+        before_image = Image.open(pair["before"]).convert("RGB")
+        after_image = Image.open(pair["after"]).convert("RGB")
+        loaded = time.perf_counter()
+        
+        # Each pair already runs in its own worker, so tiles stay in-process
+        analyze = cached_process_satellite_scene if use_cache else process_satellite_scene
+        analyzed_image, deforested_areas = analyze(after_image, before_image=before_image, workers=1, **params)
+        analyzed = time.perf_counter()
+        
+        if save_dir:
+            analyzed_image.save(os.path.join(save_dir, f"{pair['id']}_analyzed.png"))
+        
+        result.update({
+            "width": after_image.width,
+            "height": after_image.height,
+            "num_areas": len(deforested_areas),
+            "total_area_km2": round(sum(area["area_km2"] for area in deforested_areas), 2),
+            "deforested_areas": deforested_areas,
+            "timings": {
+                "load_s": round(loaded - started, 4),
+                "analyze_s": round(analyzed - loaded, 4),
+                "total_s": round(time.perf_counter() - started, 4),
+            },
+        })
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+def run_batch(pairs, output, params, workers=None, checkpoint=None, save_dir=None, use_cache=False):
+    """
+    Analyze pairs with a process pool, streaming results as JSON lines.
+    
+    Parameters:
+    -----------
+    pairs : list
+        Pairs from find_pairs
+    output : file
+        Text stream receiving one JSON line per pair
+    params : dict
+        Analysis parameters for process_satellite_scene
+    workers : int, optional
+        Number of worker processes, defaults to the number of cores
+    checkpoint : str, optional
+        File of finished pair ids; pairs listed there are skipped
+    save_dir : str, optional
+        Directory for annotated images
+    use_cache : bool
+        Reuse and fill the shared analysis cache
+    
+    Returns:
+    --------
+    dict
+        Counts of 'done', 'failed' and 'skipped' pairs
+    """
+    finished = load_checkpoint(checkpoint)
+    pending = [pair for pair in pairs if pair["id"] not in finished]
+    counts = {"done": 0, "failed": 0, "skipped": len(pairs) - len(pending)}
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+    
+    checkpoint_file = open(checkpoint, "a") if checkpoint else None
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(analyze_pair, pair, params, save_dir, use_cache) for pair in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+                
+                if "error" in result:
+                    counts["failed"] += 1
+                    continue
+                counts["done"] += 1
+                # Only successful pairs are checkpointed, so failures are retried on resume
+                if checkpoint_file:
+                    checkpoint_file.write(result["id"] + "\n")
+                    checkpoint_file.flush()
+                    os.fsync(checkpoint_file.fileno())
+    finally:
+        if checkpoint_file:
+            checkpoint_file.close()
+    
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch deforestation analysis over before/after image pairs.")
+    parser.add_argument("source", help="directory of image pairs or CSV/JSONL manifest")
+    parser.add_argument("--output", "-o", help="JSON-lines output file (appended to); defaults to stdout")
+    parser.add_argument("--checkpoint", help="file recording finished pair ids, used to resume")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--save-images", metavar="DIR", help="write annotated images to DIR")
+    parser.add_argument("--cache", action="store_true", help="reuse and fill the shared analysis cache")
+    parser.add_argument("--threshold", type=float, default=0.15, help="vegetation index drop counted as change")
+    parser.add_argument("--min-region-pixels", type=int, default=50, help="smallest region reported")
+    parser.add_argument("--pixel-size", type=float, default=30.0, help="ground size of one pixel in metres")
+    parser.add_argument("--smoothing-radius", type=int, default=0, help="change-mask speckle removal radius in pixels")
+    parser.add_argument("--progressive", action="store_true",
+                        help="refine at full resolution only around changes found at 1/8 scale")
+    args = parser.parse_args(argv)
+    
+    pairs = find_pairs(args.source)
+    if not pairs:
+        parser.error(f"no before/after pairs found in {args.source}")
+    
+    params = {
+        "threshold": args.threshold,
+        "min_region_pixels": args.min_region_pixels,
+        "pixel_size_m": args.pixel_size,
+        "smoothing_radius": args.smoothing_radius,
+        "progressive": args.progressive,
+    }
+    
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        counts = run_batch(pairs, output, params, args.workers, args.checkpoint, args.save_images, args.cache)
+    finally:
+        if args.output:
+            output.close()
+    
+    print(f"{counts['done']} analyzed, {counts['failed']} failed, {counts['skipped']} skipped", file=sys.stderr)
+    return 1 if counts["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
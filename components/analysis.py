@@ -1,13 +1,20 @@
 import streamlit as st
 import folium
-from streamlit_folium import folium_static
+from streamlit_folium import st_folium
+import json
 import numpy as np
 from datetime import datetime
 import pandas as pd
 
 from utils.mapping import create_map_with_deforestation
+from utils.vectorize import areas_to_geojson
+from utils.roi import drawings_to_polygons
 from utils.visualization import create_deforestation_heatmap
+from utils.pyramid import display_image, COLUMN_WIDTH_PX, FULL_WIDTH_PX
+from utils.image_transport import get_image_transport
+from utils.raster_store import raster_png
 from data.sample_coordinates import get_coordinates_for_location
+from components.upload import reanalyze_region
 
 def analysis_section():
     """Display analysis results for deforestation detection."""
@@ -19,8 +26,8 @@ def analysis_section():
         return
     
     # Check if we have before and after images
-    has_before_after = ('before_image' in st.session_state and 
-                       'after_image' in st.session_state)
+    has_before_after = ("before_image" in st.session_state.images and 
+                       "after_image" in st.session_state.images)
     
     # Create tabs for different views
     analysis_tabs = st.tabs(["Image Comparison", "Deforestation Detection", "Map View"])
@@ -34,14 +41,14 @@ def analysis_section():
             
             with col1:
                 st.image(
-                    st.session_state.before_image,
+                    display_image(st.session_state.images.get("before_image"), COLUMN_WIDTH_PX),
                     use_container_width=True,
                     caption="Before - Original Forest Coverage"
                 )
             
             with col2:
                 st.image(
-                    st.session_state.after_image,
+                    display_image(st.session_state.images.get("after_image"), COLUMN_WIDTH_PX),
                     use_container_width=True,
                     caption="After - Current Forest Coverage"
                 )
@@ -53,20 +60,14 @@ def analysis_section():
             comparison_value = st.slider("Slide to compare", 0, 100, 50, key="image_comparison_slider")
             
             # Get the dimensions of the images
-            width = getattr(st.session_state.before_image, 'width', 600)
-            height = getattr(st.session_state.before_image, 'height', 450)
+            width = getattr(st.session_state.images.get("before_image"), 'width', 600)
+            height = getattr(st.session_state.images.get("before_image"), 'height', 450)
             
-            # Convert images to base64 for HTML embedding
-            import base64
-            from io import BytesIO
-            
-            def get_image_base64(img):
-                buffered = BytesIO()
-                img.save(buffered, format="PNG")
-                return base64.b64encode(buffered.getvalue()).decode()
-            
-            before_b64 = get_image_base64(st.session_state.before_image)
-            after_b64 = get_image_base64(st.session_state.after_image)
+            # Display copies are encoded once and served as static files,
+            # so reruns of this page only send their URLs
+            transport = get_image_transport()
+            before_url = transport.url(st.session_state.images.get("before_image"), FULL_WIDTH_PX)
+            after_url = transport.url(st.session_state.images.get("after_image"), FULL_WIDTH_PX)
             
             # Create image comparison with CSS
             comparison_html = f"""
@@ -102,10 +103,10 @@ def analysis_section():
             </style>
             <div class="img-comp-container">
               <div class="img-comp-after">
-                <img src="data:image/png;base64,{after_b64}" width="100%">
+                <img src="{after_url}" width="100%">
               </div>
               <div class="img-comp-before">
-                <img src="data:image/png;base64,{before_b64}" width="100%">
+                <img src="{before_url}" width="100%">
               </div>
             </div>
             """
@@ -124,7 +125,7 @@ def analysis_section():
         else:
             # Only single image available (old functionality)
             st.image(
-                st.session_state.uploaded_image, 
+                display_image(st.session_state.images.get("uploaded_image")), 
                 use_container_width=True, 
                 caption="Satellite Image"
             )
@@ -139,14 +140,20 @@ def analysis_section():
             
             with col1:
                 st.image(
-                    st.session_state.before_analyzed if hasattr(st.session_state, 'before_analyzed') else st.session_state.before_image,
+                    display_image(
+                        st.session_state.images.get("before_analyzed") if "before_analyzed" in st.session_state.images else st.session_state.images.get("before_image"),
+                        COLUMN_WIDTH_PX
+                    ),
                     use_container_width=True,
                     caption="Before - Analyzed Forest Coverage"
                 )
             
             with col2:
                 st.image(
-                    st.session_state.after_analyzed if hasattr(st.session_state, 'after_analyzed') else st.session_state.analyzed_image,
+                    display_image(
+                        st.session_state.images.get("after_analyzed") if "after_analyzed" in st.session_state.images else st.session_state.images.get("analyzed_image"),
+                        COLUMN_WIDTH_PX
+                    ),
                     use_container_width=True,
                     caption="After - Detected Deforestation"
                 )
@@ -154,7 +161,7 @@ def analysis_section():
             # Add a difference visualization if available
             st.subheader("Detected Changes")
             st.image(
-                st.session_state.analyzed_image,
+                display_image(st.session_state.images.get("analyzed_image")),
                 use_container_width=True,
                 caption="Areas of Deforestation Highlighted"
             )
@@ -166,15 +173,15 @@ def analysis_section():
                 ["Original Image", "Analyzed Image with Deforestation Highlighted"]
             )
             
-            if view_option == "Original Image" and st.session_state.uploaded_image is not None:
+            if view_option == "Original Image" and st.session_state.images.get("uploaded_image") is not None:
                 st.image(
-                    st.session_state.uploaded_image, 
+                    display_image(st.session_state.images.get("uploaded_image")), 
                     use_container_width=True, 
                     caption="Original Satellite Image"
                 )
-            elif view_option == "Analyzed Image with Deforestation Highlighted" and st.session_state.analyzed_image is not None:
+            elif view_option == "Analyzed Image with Deforestation Highlighted" and st.session_state.images.get("analyzed_image") is not None:
                 st.image(
-                    st.session_state.analyzed_image, 
+                    display_image(st.session_state.images.get("analyzed_image")), 
                     use_container_width=True, 
                     caption="Deforested Areas Highlighted"
                 )
@@ -184,15 +191,63 @@ def analysis_section():
         
         coordinates = get_coordinates_for_location(st.session_state.selected_location)
         
+        analyzed_image = st.session_state.images.get("analyzed_image")
+        image_size = analyzed_image.size if analyzed_image is not None else None
+        
         # Create interactive map with deforestation areas
         map_view = create_map_with_deforestation(
             center_lat=coordinates["lat"],
             center_lon=coordinates["lon"],
             zoom=coordinates["zoom"],
-            deforested_areas=st.session_state.deforested_areas
+            deforested_areas=st.session_state.deforested_areas,
+            image_size=image_size,
+            geotransform=st.session_state.geotransform,
+            draw=True,
+            change_mask=st.session_state.get("change_mask")
         )
         
-        folium_static(map_view)
+        # Only drawn shapes are sent back, so panning does not rerun the app
+        map_state = st_folium(map_view, width=700, height=500, returned_objects=["all_drawings"])
+        drawings = (map_state or {}).get("all_drawings") or []
+        
+        if st.session_state.geotransform is not None and st.session_state.images.get("after_image") is not None:
+            roi_col1, roi_col2 = st.columns(2)
+            with roi_col1:
+                if st.button("Analyze Drawn Region Only", disabled=not drawings,
+                             help="Draw polygons or rectangles on the map, then analyze only the pixels inside them"):
+                    roi = drawings_to_polygons(drawings, st.session_state.geotransform)
+                    with st.spinner("Analyzing the region of interest..."):
+                        reanalyze_region(roi)
+                    st.rerun()
+            with roi_col2:
+                if st.session_state.get("roi") and st.button("Analyze Whole Image"):
+                    with st.spinner("Analyzing the whole image..."):
+                        reanalyze_region(None)
+                    st.rerun()
+            if st.session_state.get("roi"):
+                st.info(f"Showing results inside {len(st.session_state.roi)} drawn region(s) only.")
+        
+        if st.session_state.deforested_areas and st.session_state.geotransform is not None:
+            # Full-detail outlines, without zoom-dependent simplification
+            geojson = areas_to_geojson(
+                st.session_state.deforested_areas,
+                st.session_state.geotransform.pixel_to_lonlat
+            )
+            st.download_button(
+                "Download Detected Areas (GeoJSON)",
+                data=json.dumps(geojson),
+                file_name=f"{st.session_state.selected_location.replace(' ', '_')}_deforestation.geojson",
+                mime="application/geo+json"
+            )
+        
+        if st.session_state.get("change_mask") is not None:
+            # Assembled from the stored tiles at 1 bit per pixel
+            st.download_button(
+                "Download Change Mask (PNG)",
+                data=raster_png(st.session_state.change_mask),
+                file_name=f"{st.session_state.selected_location.replace(' ', '_')}_change_mask.png",
+                mime="image/png"
+            )
         
         st.markdown("""
         **Map Legend:**
@@ -241,6 +296,18 @@ def analysis_section():
             "Value": [region, country, total_area, deforested, rate]
         }
         
+        change_mask = st.session_state.get("change_mask")
+        if change_mask is not None:
+            # Changed pixels counted tile by tile from the stored mask
+            mask_size = (change_mask.shape[1], change_mask.shape[0])
+            if st.session_state.geotransform is not None:
+                center_lat, _ = st.session_state.geotransform.center(mask_size)
+                pixel_area_km2 = float(st.session_state.geotransform.pixel_area_km2(center_lat))
+            else:
+                pixel_area_km2 = 30.0 * 30.0 / 1e6
+            metrics_data["Metric"].append("Detected Change Area")
+            metrics_data["Value"].append(f"{change_mask.count_nonzero() * pixel_area_km2:,.2f} km²")
+        
         metrics_df = pd.DataFrame(metrics_data)
         st.table(metrics_df)
     
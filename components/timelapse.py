@@ -4,7 +4,14 @@ from PIL import Image
 import plotly.express as px
 import pandas as pd
 from datetime import datetime
-import time
+
+from utils.pyramid import display_image, FULL_WIDTH_PX
+from utils.loss_year import loss_area_by_year
+from utils.timelapse import ANIMATION_FORMAT
+from utils.image_transport import get_image_transport
+
+# The time-lapse image sits in the wider of a 3:2 column split
+TIMELAPSE_WIDTH_PX = FULL_WIDTH_PX * 3 // 5
 
 def timelapse_section():
     """Display time-lapse view of deforestation changes."""
@@ -21,8 +28,9 @@ def timelapse_section():
         st.subheader("Deforestation Over Time")
         
         # If using a sample location, we have timelapse images
-        if st.session_state.selected_location != "Custom Upload" and len(st.session_state.timelapse_images) > 0:
-            years = sorted(list(st.session_state.timelapse_images.keys()))
+        frames = st.session_state.timelapse_images
+        if st.session_state.selected_location != "Custom Upload" and frames:
+            years = frames.years
             
             # Create a slider to select the year
             selected_year = st.slider(
@@ -33,41 +41,48 @@ def timelapse_section():
                 step=1
             )
             
-            # Display the image for the selected year
-            if selected_year in st.session_state.timelapse_images:
+            # Display the image for the selected year, computed at display size
+            if selected_year in frames:
                 st.image(
-                    st.session_state.timelapse_images[selected_year],
+                    frames.encoded_frame(selected_year, TIMELAPSE_WIDTH_PX),
                     use_container_width=True,
                     caption=f"Satellite Image from {selected_year}"
                 )
             
-            # Create an auto-play option
+            # Auto-play runs in the browser from one pre-encoded animation,
+            # so no frame triggers a rerun of the app. It is served as a
+            # static file; reruns only resend its URL
             auto_play = st.checkbox("Auto-play time-lapse")
             
             if auto_play:
                 play_speed = st.slider("Playback speed (seconds per frame)", 0.5, 3.0, 1.0, 0.1)
                 
-                progress_bar = st.progress(0)
-                
-                for i, year in enumerate(years):
-                    # Update progress bar
-                    progress = i / (len(years) - 1)
-                    progress_bar.progress(progress)
-                    
-                    # Display image
-                    st.image(
-                        st.session_state.timelapse_images[year],
-                        use_container_width=True,
-                        caption=f"Satellite Image from {year}"
-                    )
-                    
-                    time.sleep(play_speed)
-                    
-                    # Clear output for next frame (except for the last one)
-                    if i < len(years) - 1:
-                        st.rerun()
-                
-                progress_bar.progress(1.0)
+                with st.spinner("Preparing time-lapse animation..."):
+                    animation = frames.animation(TIMELAPSE_WIDTH_PX, int(play_speed * 1000))
+                animation_url = get_image_transport().encoded_url(animation, ANIMATION_FORMAT)
+                st.markdown(
+                    f'<img src="{animation_url}" style="width: 100%;" '
+                    f'alt="Time-lapse {years[0]}-{years[-1]}">',
+                    unsafe_allow_html=True
+                )
+                st.caption(f"Satellite time-lapse {years[0]}-{years[-1]}")
+            
+            # Per-year loss measured from the imagery itself, via the loss-year raster
+            if st.session_state.get('loss_year') is not None:
+                loss_df = pd.DataFrame(
+                    loss_area_by_year(st.session_state.loss_year, st.session_state.loss_year_years)
+                )
+                fig_loss = px.bar(
+                    loss_df,
+                    x='Year',
+                    y='Loss (km²)',
+                    title='Detected Forest Loss by Year',
+                    color='Loss (km²)',
+                    color_continuous_scale='Reds',
+                    hover_data=['Loss (%)', 'Forest Cover (%)']
+                )
+                fig_loss.update_layout(xaxis=dict(dtick=1))
+                st.plotly_chart(fig_loss, use_container_width=True)
         else:
             # For custom uploads or if no timelapse data is available
             st.info(
@@ -76,9 +91,9 @@ def timelapse_section():
             )
             
             # Show a placeholder image
-            if st.session_state.analyzed_image is not None:
+            if st.session_state.images.get("analyzed_image") is not None:
                 st.image(
-                    st.session_state.analyzed_image,
+                    display_image(st.session_state.images.get("analyzed_image"), TIMELAPSE_WIDTH_PX),
                     use_container_width=True,
                     caption="Current Analysis (Time-lapse not available)"
                 )
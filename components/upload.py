@@ -3,8 +3,113 @@ import io
 from PIL import Image
 import numpy as np
 import datetime
-from utils.image_processing import process_satellite_image
+from utils.cache import cached_process_satellite_scene
+from utils.timelapse import TimelapseFrames
 from utils.mapping import create_map_with_deforestation
+from utils.pyramid import display_image, COLUMN_WIDTH_PX, FULL_WIDTH_PX
+from utils.loss_year import compute_loss_year
+from utils.raster_store import store_raster
+from utils.georeference import GeoTransform, georeference_areas
+from utils.ingest import IngestedImage, upload_digest
+from data.sample_coordinates import get_coordinates_for_location
+
+def georeference_detections(deforested_areas, image_size, location, geotransform=None):
+    """
+    Place detected areas at geographic coordinates and store the transform.
+    
+    Parameters:
+    -----------
+    deforested_areas : list
+        Detected areas in pixel coordinates
+    image_size : tuple
+        (width, height) of the analyzed image
+    location : str
+        Location the image is centred on when it has no georeference
+    geotransform : GeoTransform, optional
+        Georeference supplied with the upload
+    
+    Returns:
+    --------
+    list
+        The areas with 'lat', 'lon', 'bounds' and true 'area_km2'
+    """
+    if geotransform is None:
+        coordinates = get_coordinates_for_location(location)
+        geotransform = GeoTransform.from_center(coordinates["lat"], coordinates["lon"], image_size)
+    st.session_state.geotransform = geotransform
+    return georeference_areas(deforested_areas, geotransform)
+
+def reanalyze_region(roi=None):
+    """
+    Re-run the last before/after analysis inside a region of interest.
+    
+    Parameters:
+    -----------
+    roi : list, optional
+        Polygons in pixel coordinates of the 'After' image; None analyzes
+        the whole image again
+    """
+    after_analyzed, deforested_areas, change_mask = cached_process_satellite_scene(
+        st.session_state.images.get("after_image"),
+        before_image=st.session_state.images.get("before_image"),
+        roi=roi,
+        change_mask=True,
+        **st.session_state.get("analysis_params", {})
+    )
+    st.session_state.change_mask = change_mask
+    st.session_state.images["after_analyzed"] = after_analyzed
+    st.session_state.images["analyzed_image"] = after_analyzed
+    st.session_state.deforested_areas = georeference_detections(
+        deforested_areas, after_analyzed.size, st.session_state.selected_location, st.session_state.geotransform
+    )
+    st.session_state.roi = roi
+
+def ingest_upload(uploaded_file, name):
+    """
+    Start ingesting an uploaded file unless the same file already was.
+    
+    The preview is available at once; the full-resolution image is decoded
+    in the background and moved into the session image store under name by
+    collect_upload.
+    
+    Parameters:
+    -----------
+    uploaded_file : UploadedFile
+        File from st.file_uploader
+    name : str
+        Name of the image in the session image store
+    
+    Returns:
+    --------
+    IngestedImage
+        The ingest of the file
+    """
+    data = uploaded_file.getvalue()
+    ingest = st.session_state.uploads.get(name)
+    if (ingest is None or ingest.digest != upload_digest(data)
+            or (not ingest.pending and name not in st.session_state.images)):
+        ingest = IngestedImage(data)
+        st.session_state.uploads[name] = ingest
+    collect_upload(name)
+    return ingest
+
+def collect_upload(name, wait=False):
+    """Move a decoded upload into the session image store once ready, or with wait, as soon as it is."""
+    ingest = st.session_state.uploads.get(name)
+    if ingest is not None and ingest.pending and (wait or ingest.done()):
+        st.session_state.images[name] = ingest.take()
+
+def has_upload(name):
+    """True if an image was uploaded under name, decoded or not."""
+    ingest = st.session_state.uploads.get(name)
+    return name in st.session_state.images or (ingest is not None and ingest.pending)
+
+def upload_preview(name, width=COLUMN_WIDTH_PX):
+    """Image to display for an upload: its preview while decoding, then its stored image."""
+    ingest = st.session_state.uploads.get(name)
+    if ingest is not None and ingest.pending:
+        return display_image(ingest.preview, width)
+    return display_image(st.session_state.images.get(name), width)
 
 def upload_section():
     """Create the upload section for satellite images with before and after comparison."""
@@ -139,19 +244,18 @@ def upload_section():
             st.subheader("Upload 'Before' Image")
             uploaded_before = st.file_uploader(
                 "Choose a satellite image (earlier timepoint)",
-                type=["jpg", "jpeg", "png"],
+                type=["jpg", "jpeg", "png", "tif", "tiff"],
                 key="before_uploader"
             )
             
             # Preview of before image
             if uploaded_before is not None:
                 try:
-                    # Read the uploaded image
-                    before_image = Image.open(uploaded_before)
-                    st.session_state.before_image = before_image
+                    # Decode in the background and show a preview meanwhile
+                    ingest_upload(uploaded_before, "before_image")
                     
                     # Display preview
-                    st.image(before_image, use_container_width=True, caption="'Before' Image Preview")
+                    st.image(upload_preview("before_image", FULL_WIDTH_PX), use_container_width=True, caption="'Before' Image Preview")
                     st.success("'Before' image uploaded successfully!")
                     
                 except Exception as e:
@@ -164,19 +268,35 @@ def upload_section():
             st.subheader("Upload 'After' Image")
             uploaded_after = st.file_uploader(
                 "Choose a satellite image (later timepoint)",
-                type=["jpg", "jpeg", "png"],
+                type=["jpg", "jpeg", "png", "tif", "tiff"],
                 key="after_uploader"
             )
+            uploaded_world_file = st.file_uploader(
+                "Optional: world file locating the 'After' image (.tfw, .jgw, .pgw, .wld)",
+                type=["tfw", "jgw", "pgw", "wld"],
+                key="after_world_file",
+                help="Without a world file or GeoTIFF tags the image is assumed to be centred "
+                     "on the selected location at 30 m per pixel"
+            )
             
             # Preview of after image
             if uploaded_after is not None:
                 try:
-                    # Read the uploaded image
-                    after_image = Image.open(uploaded_after)
-                    st.session_state.after_image = after_image
+                    # Decode in the background and show a preview meanwhile
+                    after_ingest = ingest_upload(uploaded_after, "after_image")
+                    
+                    # Georeference from the world file, else from GeoTIFF tags
+                    if uploaded_world_file is not None:
+                        st.session_state.after_geotransform = GeoTransform.from_world_file(
+                            uploaded_world_file.getvalue().decode("ascii", errors="replace")
+                        )
+                    else:
+                        st.session_state.after_geotransform = after_ingest.geotransform
+                    if st.session_state.after_geotransform is not None:
+                        st.info("Image georeference found; detections will be placed at its coordinates.")
                     
                     # Display preview
-                    st.image(after_image, use_container_width=True, caption="'After' Image Preview")
+                    st.image(upload_preview("after_image", FULL_WIDTH_PX), use_container_width=True, caption="'After' Image Preview")
                     st.success("'After' image uploaded successfully!")
                     
                 except Exception as e:
@@ -188,32 +308,77 @@ def upload_section():
         with upload_tabs[2]:  # Comparison Preview Tab
             st.subheader("Compare Before & After Images")
             
-            both_images_uploaded = ('before_image' in st.session_state and 
-                                  'after_image' in st.session_state)
+            both_images_uploaded = has_upload("before_image") and has_upload("after_image")
             
             if both_images_uploaded:
                 # Display side by side comparison
                 col1, col2 = st.columns(2)
                 with col1:
-                    st.image(st.session_state.before_image, use_container_width=True, caption="Before")
+                    st.image(upload_preview("before_image"), use_container_width=True, caption="Before")
                 with col2:
-                    st.image(st.session_state.after_image, use_container_width=True, caption="After")
+                    st.image(upload_preview("after_image"), use_container_width=True, caption="After")
+                
+                normalize = st.checkbox(
+                    "Normalize lighting between images",
+                    help="Match the colors of the 'After' image to the 'Before' image so differences "
+                         "in lighting or season are not reported as deforestation"
+                )
+                
+                progressive = st.checkbox(
+                    "Progressive analysis (quick preview for large images)",
+                    help="Show a low-resolution result first, then analyze at full resolution "
+                         "only around the areas it found"
+                )
                 
                 # Process button
                 if st.button("Analyze Deforestation Between Images"):
+                    preview_placeholder = st.empty()
+                    
+                    def show_preview(preview_image, preview_areas):
+                        preview_placeholder.image(
+                            preview_image,
+                            use_container_width=True,
+                            caption=f"Preview: {len(preview_areas)} candidate areas, refining at full resolution..."
+                        )
+                    
                     with st.spinner("Analyzing deforestation patterns..."):
+                        # Full-resolution images, decoded in the background since upload
+                        try:
+                            collect_upload("before_image", wait=True)
+                            collect_upload("after_image", wait=True)
+                        except Exception as e:
+                            st.error(f"Error decoding uploaded images: {str(e)}")
+                            st.stop()
+                        
                         # Process the before image for reference
-                        before_analyzed, _ = process_satellite_image(st.session_state.before_image)
-                        st.session_state.before_analyzed = before_analyzed
+                        before_analyzed, _ = cached_process_satellite_scene(st.session_state.images.get("before_image"))
+                        st.session_state.images["before_analyzed"] = before_analyzed
                         
-                        # Process the after image for comparison and detection
-                        after_analyzed, deforested_areas = process_satellite_image(st.session_state.after_image)
-                        st.session_state.after_analyzed = after_analyzed
-                        st.session_state.deforested_areas = deforested_areas
+                        # Compare the after image against the before image to detect vegetation loss
+                        after_analyzed, deforested_areas, change_mask = cached_process_satellite_scene(
+                            st.session_state.images.get("after_image"),
+                            before_image=st.session_state.images.get("before_image"),
+                            normalize=normalize,
+                            progressive=progressive,
+                            on_preview=show_preview if progressive else None,
+                            change_mask=True
+                        )
+                        preview_placeholder.empty()
+                        # Memory-mapped tiled raster; maps, statistics and exports read its tiles
+                        st.session_state.change_mask = change_mask
+                        st.session_state.analysis_params = {"normalize": normalize, "progressive": progressive}
+                        st.session_state.roi = None
+                        st.session_state.images["after_analyzed"] = after_analyzed
+                        st.session_state.deforested_areas = georeference_detections(
+                            deforested_areas,
+                            after_analyzed.size,
+                            st.session_state.selected_location,
+                            st.session_state.get("after_geotransform")
+                        )
                         
                         # Set uploaded_image to after image for compatibility with other components
-                        st.session_state.uploaded_image = st.session_state.after_image
-                        st.session_state.analyzed_image = after_analyzed
+                        st.session_state.images["uploaded_image"] = st.session_state.images.get("after_image")
+                        st.session_state.images["analyzed_image"] = after_analyzed
                         
                         # Mark analysis as complete
                         st.session_state.analysis_complete = True
@@ -223,10 +388,10 @@ def upload_section():
             else:
                 st.info("Please upload both 'Before' and 'After' images to enable comparison and analysis.")
                 
-                if 'before_image' not in st.session_state:
+                if not has_upload("before_image"):
                     st.warning("'Before' image not yet uploaded.")
                     
-                if 'after_image' not in st.session_state:
+                if not has_upload("after_image"):
                     st.warning("'After' image not yet uploaded.")
                 
                 # Show placeholder for comparison
@@ -254,49 +419,65 @@ def upload_section():
                 # Generate sample images for demonstration
                 width, height = 800, 600
                 
-                # Base image array with random noise
-                base_image_array = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+                # Base forest canopy: dark green with per-pixel texture noise
+                # int16 holds every colour plus noise without promoting to int64
+                noise = np.random.randint(-25, 26, (height, width, 3), dtype=np.int16)
+                canopy = np.array([40, 110, 45], dtype=np.int16) + noise
                 
-                # "Before" image - more green to represent more forest
-                before_array = np.copy(base_image_array)
-                before_array[:, :, 1] = np.clip(before_array[:, :, 1] + 100, 0, 255)  # Enhance green
+                # "Before" image - intact forest
+                before_array = np.clip(canopy, 0, 255).astype(np.uint8)
                 before_image = Image.fromarray(before_array)
                 
-                # "After" image - less green to represent deforestation
-                after_array = np.copy(base_image_array)
-                after_array[:, :, 1] = np.clip(after_array[:, :, 1] + 50, 0, 255)  # Less green
-                # Add some brown patches to simulate cleared land
-                mask = np.random.rand(height, width) > 0.8
-                after_array[mask, 0] = np.clip(after_array[mask, 0] + 70, 0, 255)  # More red
-                after_array[mask, 1] = np.clip(after_array[mask, 1] - 50, 0, 255)  # Less green
+                # "After" image - brown clearings cut into the canopy
+                yy, xx = np.mgrid[0:height, 0:width]
+                mask = np.zeros((height, width), dtype=bool)
+                for _ in range(np.random.randint(3, 9)):
+                    cy, cx = np.random.randint(0, height), np.random.randint(0, width)
+                    ry, rx = np.random.randint(15, 70), np.random.randint(15, 90)
+                    mask |= ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1.0
+                cleared = np.array([150, 115, 80], dtype=np.int16) + noise
+                after_array = np.clip(np.where(mask[:, :, None], cleared, canopy), 0, 255).astype(np.uint8)
                 after_image = Image.fromarray(after_array)
                 
                 # Store the images in session state
-                st.session_state.before_image = before_image
-                st.session_state.after_image = after_image
-                st.session_state.uploaded_image = after_image  # For compatibility with other components
+                st.session_state.images["before_image"] = before_image
+                st.session_state.images["after_image"] = after_image
+                st.session_state.images["uploaded_image"] = after_image  # For compatibility with other components
                 
                 # Process the images
-                before_analyzed, _ = process_satellite_image(before_image)
-                after_analyzed, deforested_areas = process_satellite_image(after_image)
+                before_analyzed, _ = cached_process_satellite_scene(before_image)
+                after_analyzed, deforested_areas, change_mask = cached_process_satellite_scene(
+                    after_image, before_image=before_image, change_mask=True
+                )
+                st.session_state.change_mask = change_mask
                 
                 # Store the processed results
-                st.session_state.before_analyzed = before_analyzed
-                st.session_state.after_analyzed = after_analyzed
-                st.session_state.analyzed_image = after_analyzed
-                st.session_state.deforested_areas = deforested_areas
+                st.session_state.images["before_analyzed"] = before_analyzed
+                st.session_state.images["after_analyzed"] = after_analyzed
+                st.session_state.images["analyzed_image"] = after_analyzed
+                st.session_state.deforested_areas = georeference_detections(
+                    deforested_areas, after_analyzed.size, sample_selection.split(' (')[0]
+                )
+                st.session_state.analysis_params = {}
+                st.session_state.roi = None
                 st.session_state.analysis_complete = True
                 
-                # Generate timelapse images
+                # Time-lapse frames are interpolated between the two images on
+                # demand, at the resolution they are displayed at. The
+                # keyframes are read from the image store, where their own
+                # names share the entries of the before and after images
                 years = list(range(selected_years['before_year'], selected_years['after_year'] + 1))
-                st.session_state.timelapse_images = {}
+                st.session_state.images["timelapse_start"] = before_image
+                st.session_state.images["timelapse_end"] = after_image
+                st.session_state.timelapse_images = TimelapseFrames(
+                    {years[0]: "timelapse_start", years[-1]: "timelapse_end"}, years, store=st.session_state.images
+                )
                 
-                for i, year in enumerate(years):
-                    # Interpolate between before and after images to simulate progression
-                    progress = i / (len(years) - 1)
-                    year_array = (1 - progress) * before_array + progress * after_array
-                    year_image = Image.fromarray(year_array.astype(np.uint8))
-                    st.session_state.timelapse_images[year] = year_image
+                # Year of first detected loss per pixel, computed once for all frames
+                # and kept on disk as a tiled raster rather than in the session
+                loss_year = compute_loss_year(st.session_state.timelapse_images)
+                st.session_state.loss_year = store_raster(loss_year, metadata={"years": years})
+                st.session_state.loss_year_years = years
                 
                 # Display success message
                 st.success(f"Sample data for {sample_selection} loaded successfully! Navigate to Analysis Results to view details.")
@@ -304,10 +485,10 @@ def upload_section():
             # Show a preview of the loaded samples
             col1, col2 = st.columns(2)
             with col1:
-                st.image(before_image, use_container_width=True, 
+                st.image(display_image(before_image, COLUMN_WIDTH_PX), use_container_width=True, 
                          caption=f"Before ({selected_years['before_year']})")
             with col2:
-                st.image(after_image, use_container_width=True, 
+                st.image(display_image(after_image, COLUMN_WIDTH_PX), use_container_width=True, 
                          caption=f"After ({selected_years['after_year']})")
 
 
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils.cache
+from utils.cache import AnalysisCache, cached_process_satellite_scene
+
+def forest_scene(size, seed=0):
+    """A noisy forest scene of size x size pixels."""
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(-25, 26, (size, size, 3), dtype=np.int16)
+    return np.clip(np.array([40, 110, 45], dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+
+@pytest.fixture
+def analyses(monkeypatch):
+    """Count the analyses that were run rather than served from the cache."""
+    calls = []
+    
+    def analyze(image, before_image=None, **params):
+        calls.append(image)
+        return Image.new('RGB', (1, 1)), [{"x1": 0, "y1": 0, "x2": 1, "y2": 1}] * len(calls)
+    
+    monkeypatch.setattr(utils.cache, "process_satellite_scene", analyze)
+    return calls
+
+@pytest.mark.parametrize("size, clearing", [(4000, 10), (8000, 15)])
+def test_small_clearing_in_large_scene_is_not_a_near_duplicate(tmp_path, analyses, size, clearing):
+    cache = AnalysisCache(str(tmp_path))
+    before = forest_scene(size)
+    after = before.copy()
+    after[size // 3:size // 3 + 20, size // 3:size // 3 + 20] = [150, 115, 80]
+    cached_process_satellite_scene(Image.fromarray(after), Image.fromarray(before), cache=cache)
+    
+    # The first analysis is a candidate by its hash and thumbnail...
+    after[size // 2:size // 2 + clearing, size // 2:size // 2 + clearing] = [150, 115, 80]
+    changed = Image.fromarray(after)
+    images = [changed, Image.fromarray(before)]
+    assert cache.similar_keys(
+        utils.cache.perceptual_signature(images),
+        utils.cache.analysis_match_key(images, {}),
+        [utils.cache.image_thumbnail(image) for image in images],
+        utils.cache.NEAR_DUPLICATE_BITS * 2,
+    )
+    # ...but the new clearing must be analyzed
+    _, areas = cached_process_satellite_scene(changed, images[1], cache=cache)
+    assert len(analyses) == 2
+    assert len(areas) == 2
+
+def test_resaved_scene_is_a_near_duplicate(tmp_path, analyses):
+    cache = AnalysisCache(str(tmp_path))
+    before, after = forest_scene(1000), forest_scene(1000, seed=1)
+    cached_process_satellite_scene(Image.fromarray(after), Image.fromarray(before), cache=cache)
+    
+    # A slightly brighter copy, as after re-saving with a different encoder
+    brighter = Image.fromarray(np.clip(after.astype(np.int16) + 1, 0, 255).astype(np.uint8))
+    _, areas = cached_process_satellite_scene(brighter, Image.fromarray(before), cache=cache)
+    assert len(analyses) == 1
+    assert len(areas) == 1
+
+def test_change_mask_is_stored_with_the_entry(tmp_path):
+    cache = AnalysisCache(str(tmp_path))
+    before = forest_scene(300)
+    after = before.copy()
+    after[100:150, 100:200] = [150, 115, 80]
+    _, areas, mask = cached_process_satellite_scene(Image.fromarray(after), Image.fromarray(before), cache=cache,
+                                                    change_mask=True, align=False)
+    assert mask.count_nonzero() >= 50 * 100
+    assert mask.read()[100:150, 100:200].all()
+    
+    # Served from the cache with the same mask; without asking, two values
+    _, _, cached_mask = cached_process_satellite_scene(Image.fromarray(after), Image.fromarray(before), cache=cache,
+                                                       change_mask=True, align=False)
+    assert np.array_equal(cached_mask.read(), mask.read())
+    assert len(cached_process_satellite_scene(Image.fromarray(after), Image.fromarray(before), cache=cache,
+                                              align=False)) == 2
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.image_processing import (
+    blend_arrays,
+    vegetation_index_terms,
+    compute_vegetation_index,
+    detect_vegetation_loss,
+    detect_bare_ground,
+    render_detection_overlay,
+)
+from utils.timelapse import TimelapseFrames
+from utils.loss_year import compute_loss_year
+
+@pytest.fixture
+def scenes():
+    """A forest scene and the same scene with a brown clearing."""
+    rng = np.random.default_rng(0)
+    noise = rng.integers(-25, 26, (60, 80, 3), dtype=np.int16)
+    before = np.clip(np.array([40, 110, 45], dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+    after = before.copy()
+    after[20:40, 30:60] = np.clip(np.array([150, 115, 80], dtype=np.int16) + noise[20:40, 30:60], 0, 255)
+    return before, after
+
+@pytest.mark.parametrize("fraction", [0.0, 0.3, 1.0])
+def test_blend_arrays_is_uint8(scenes, fraction):
+    before, after = scenes
+    blended = blend_arrays(before, after, fraction, band_rows=16)
+    assert blended.dtype == np.uint8
+    assert blended.shape == before.shape
+
+def test_blend_arrays_extremes_and_rounding(scenes):
+    before, after = scenes
+    assert np.array_equal(blend_arrays(before, after, 0.0), before)
+    assert np.array_equal(blend_arrays(before, after, 1.0), after)
+    exact = before * 0.7 + after * 0.3
+    assert np.abs(blend_arrays(before, after, 0.3).astype(np.float64) - exact).max() <= 1
+
+def test_vegetation_index_terms_are_exact_integers():
+    pixels = np.array([[[255, 0, 255], [0, 255, 0], [255, 255, 255], [0, 0, 0]]], dtype=np.uint8)
+    numerator, total = vegetation_index_terms(pixels)
+    assert numerator.dtype == np.int16
+    assert total.dtype == np.uint16
+    assert numerator.tolist() == [[-510, 510, 0, 0]]
+    assert total.tolist() == [[510, 255, 765, 0]]
+
+def test_vegetation_index_terms_of_float_input_are_float32():
+    numerator, total = vegetation_index_terms(np.ones((2, 2, 3), dtype=np.float64))
+    assert numerator.dtype == np.float32
+    assert total.dtype == np.float32
+
+def test_vegetation_index_is_float32(scenes):
+    before, _ = scenes
+    index = compute_vegetation_index(before)
+    assert index.dtype == np.float32
+    assert index.shape == before.shape[:2]
+    # Matches the float64 definition to float32 precision
+    pixels = before.astype(np.float64)
+    total = pixels.sum(axis=-1)
+    expected = (2 * pixels[..., 1] - pixels[..., 0] - pixels[..., 2]) / total
+    assert np.allclose(index, expected, atol=1e-6)
+
+def test_vegetation_loss_confidence_is_float32(scenes):
+    before, after = scenes
+    mask, confidence = detect_vegetation_loss(before, after, band_rows=16)
+    assert mask.dtype == bool
+    assert confidence.dtype == np.float32
+    assert mask[25:35, 35:55].all()
+
+def test_bare_ground_confidence_is_float32(scenes):
+    _, after = scenes
+    mask, confidence = detect_bare_ground(after, band_rows=16)
+    assert mask.dtype == bool
+    assert confidence.dtype == np.float32
+
+def test_detection_overlay_is_uint8(scenes):
+    _, after = scenes
+    areas = [{"x1": 30, "y1": 20, "x2": 60, "y2": 40}]
+    overlay = render_detection_overlay(Image.fromarray(after), areas, polygons=[[(0, 0), (10, 0), (10, 10)]])
+    result = np.asarray(overlay)
+    assert overlay.mode == 'RGB'
+    assert result.dtype == np.uint8
+    assert result.shape == after.shape
+
+def test_timelapse_band_is_uint8(scenes):
+    before, after = scenes
+    frames = TimelapseFrames({2018: Image.fromarray(before), 2021: Image.fromarray(after)}, [2018, 2019, 2020, 2021])
+    band = frames.read_band(10, 30)
+    assert band.dtype == np.uint8
+    assert band.shape == (4, 20, 80, 3)
+    assert np.array_equal(band[0], before[10:30])
+    assert np.array_equal(band[-1], after[10:30])
+
+def test_loss_year_is_uint8_for_arrays_and_frames(scenes):
+    before, after = scenes
+    stack = np.stack([before, before, after])
+    loss_year = compute_loss_year(stack, band_rows=16)
+    assert loss_year.dtype == np.uint8
+    assert loss_year.shape == before.shape[:2]
+    assert (loss_year[25:35, 35:55] == 2).all()
+    
+    frames = TimelapseFrames({2018: Image.fromarray(before), 2020: Image.fromarray(after)}, [2018, 2019, 2020])
+    from_frames = compute_loss_year(frames, band_rows=16)
+    assert from_frames.dtype == np.uint8
+    assert from_frames.shape == before.shape[:2]
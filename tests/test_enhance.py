@@ -0,0 +1,54 @@
+import time
+import numpy as np
+import pytest
+from PIL import Image, ImageEnhance
+
+from utils.image_processing import enhance_satellite_image, enhance_satellite_array
+
+def enhance_with_pillow(image, brightness, contrast, color):
+    image = ImageEnhance.Brightness(image).enhance(brightness)
+    image = ImageEnhance.Contrast(image).enhance(contrast)
+    return ImageEnhance.Color(image).enhance(color)
+
+@pytest.fixture
+def scene():
+    rng = np.random.default_rng(0)
+    noise = rng.integers(-25, 26, (300, 400, 3), dtype=np.int16)
+    return np.clip(np.array([40, 110, 45], dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+
+@pytest.mark.parametrize("factors", [(1.0, 1.0, 1.2), (1.2, 1.1, 1.3), (0.8, 1.5, 1.0), (1.6, 0.7, 0.5)])
+def test_enhance_matches_imageenhance(scene, factors):
+    image = Image.fromarray(scene)
+    expected = np.asarray(enhance_with_pillow(image, *factors), dtype=np.int16)
+    enhanced = enhance_satellite_image(image, *factors)
+    assert enhanced is not image
+    assert np.abs(np.asarray(enhanced, dtype=np.int16) - expected).max() <= 1
+
+def test_enhance_keeps_alpha(scene):
+    alpha = np.arange(scene.shape[0] * scene.shape[1], dtype=np.uint32).reshape(scene.shape[:2]) % 256
+    pixels = np.dstack((scene, alpha.astype(np.uint8)))
+    enhanced = np.asarray(enhance_satellite_image(Image.fromarray(pixels), 1.2, 1.1, 1.3))
+    expected = np.asarray(enhance_with_pillow(Image.fromarray(scene), 1.2, 1.1, 1.3), dtype=np.int16)
+    assert np.array_equal(enhanced[:, :, 3], pixels[:, :, 3])
+    assert np.abs(enhanced[:, :, :3].astype(np.int16) - expected).max() <= 1
+
+def test_enhance_array_in_place(scene):
+    expected = np.asarray(enhance_satellite_image(Image.fromarray(scene), 1.2, 1.1, 1.3))
+    pixels = scene.copy()
+    assert enhance_satellite_array(pixels, 1.2, 1.1, 1.3, out=pixels) is pixels
+    assert np.array_equal(pixels, expected)
+
+def test_enhance_is_faster_than_imageenhance():
+    # Sanity check on a 2000x2000 image: two C passes against six
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (2000, 2000, 3), dtype=np.uint8))
+    
+    def best_time(enhance):
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            enhance(image, 1.2, 1.1, 1.3)
+            times.append(time.perf_counter() - start)
+        return min(times)
+    
+    assert best_time(enhance_satellite_image) < best_time(enhance_with_pillow)
@@ -0,0 +1,44 @@
+import io
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.ingest import open_upload, decode_preview, IngestedImage
+
+def encode(image, format, overviews=(), **params):
+    pages = []
+    for width in overviews:
+        page = image.resize((width, image.height * width // image.width))
+        # NewSubfileType: reduced-resolution image
+        page.encoderinfo = {"tiffinfo": {254: 1}}
+        pages.append(page)
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, append_images=pages, save_all=bool(pages), **params)
+    return buffer.getvalue()
+
+@pytest.fixture
+def scene():
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (1500, 2000, 3), dtype=np.uint8))
+
+def test_pixel_limit_is_per_call(scene):
+    limit = Image.MAX_IMAGE_PIXELS
+    data = encode(scene, "PNG")
+    assert open_upload(data, max_pixels=limit * 4).size == (2000, 1500)
+    assert Image.MAX_IMAGE_PIXELS == limit
+    with pytest.raises(ValueError):
+        open_upload(data, max_pixels=2000 * 1500 - 1)
+
+def test_tiff_preview_decodes_an_overview(scene):
+    data = encode(scene, "TIFF", overviews=(1000, 500, 250), compression="tiff_deflate")
+    assert decode_preview(data, width=400).size == (500, 375)
+    assert decode_preview(data, width=1200) is None
+    assert decode_preview(encode(scene, "TIFF"), width=400) is None
+    assert decode_preview(encode(scene, "PNG"), width=400) is None
+
+def test_ingest_takes_the_full_image(scene):
+    ingest = IngestedImage(encode(scene, "TIFF", overviews=(500,)), preview_width=400)
+    assert ingest.preview.size == (500, 375)
+    image = ingest.take()
+    assert image.size == (2000, 1500)
+    assert np.array_equal(np.asarray(image), np.asarray(scene))
@@ -0,0 +1,47 @@
+import sys
+import types
+import numpy as np
+import pytest
+
+import utils.parallel
+from utils.parallel import analyze_scene_parallel
+from utils.tiling import analyze_scene_tiled
+
+@pytest.fixture
+def scenes():
+    rng = np.random.default_rng(0)
+    noise = rng.integers(-25, 26, (900, 1100, 3), dtype=np.int16)
+    before = np.clip(np.array([40, 110, 45], dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+    after = before.copy()
+    after[100:300, 200:500] = [150, 115, 80]
+    after[600:700, 800:1000] = [150, 115, 80]
+    return before, after
+
+@pytest.fixture
+def two_cpus(monkeypatch):
+    monkeypatch.setattr(utils.parallel, "available_cpus", lambda: 2)
+
+def test_workers_match_tiled_analysis(scenes, two_cpus):
+    before, after = scenes
+    expected = analyze_scene_tiled(after, before, tile_size=256)
+    assert analyze_scene_parallel(after, before, tile_size=256, workers=2) == expected
+
+def test_workers_do_not_run_the_page_script(tmp_path, scenes, two_cpus, monkeypatch):
+    # Streamlit runs the page as a __main__ module with a __file__ and no spec
+    marker = tmp_path / "ran"
+    script = tmp_path / "page.py"
+    script.write_text(f"open({str(marker)!r}, 'a').write('x')\n")
+    page = types.ModuleType("__main__")
+    page.__file__ = str(script)
+    monkeypatch.setitem(sys.modules, "__main__", page)
+    
+    before, after = scenes
+    analyze_scene_parallel(after, before, tile_size=256, workers=3)
+    assert sys.modules["__main__"] is page
+    assert not marker.exists()
+
+def test_single_cpu_stays_in_process(scenes, monkeypatch):
+    monkeypatch.setattr(utils.parallel, "available_cpus", lambda: 1)
+    monkeypatch.setattr(utils.parallel, "_get_pool", lambda workers: pytest.fail("worker pool started"))
+    before, after = scenes
+    assert analyze_scene_parallel(after, before, tile_size=256, workers=4) == analyze_scene_tiled(after, before, tile_size=256)
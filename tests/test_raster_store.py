@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.raster_store import write_raster, write_raster_rows, open_raster, raster_png
+from utils.image_processing import detect_vegetation_loss
+from utils.tiling import process_satellite_scene
+
+@pytest.fixture
+def mask():
+    return np.random.default_rng(0).random((700, 900)) < 0.2
+
+def test_rows_written_in_bands_read_back(tmp_path, mask):
+    bands = []
+    
+    def read_rows(top, bottom):
+        bands.append((top, bottom))
+        return mask[top:bottom]
+    
+    write_raster_rows(str(tmp_path / "mask"), mask.shape, bool, read_rows, tile_size=128)
+    with open_raster(str(tmp_path / "mask")) as raster:
+        assert np.array_equal(raster.read(), mask)
+        assert np.array_equal(raster.read_window(100, 250, 700, 300), mask[250:300, 100:700])
+    assert bands[0] == (0, 128) and bands[-1] == (640, 700)
+
+def test_summaries_match_the_array(tmp_path, mask):
+    write_raster(str(tmp_path / "mask"), mask, tile_size=128)
+    with open_raster(str(tmp_path / "mask")) as raster:
+        assert raster.count_nonzero() == mask.sum()
+        overview = raster.overview(100)
+        assert overview.shape == (78, 100)
+        assert np.allclose(overview[:77], mask[:693].reshape(77, 9, 100, 9).mean(axis=(1, 3)))
+        assert np.array_equal(np.asarray(raster.to_image()), mask)
+        assert raster_png(raster).startswith(b"\x89PNG")
+
+@pytest.fixture
+def scenes():
+    rng = np.random.default_rng(0)
+    noise = rng.integers(-25, 26, (600, 800, 3), dtype=np.int16)
+    before = np.clip(np.array([40, 110, 45], dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+    after = before.copy()
+    after[200:300, 300:500] = np.clip(np.array([150, 115, 80], dtype=np.int16) + noise[200:300, 300:500], 0, 255)
+    return Image.fromarray(before), Image.fromarray(after)
+
+@pytest.mark.parametrize("params", [{}, {"memory_limit_mb": 4, "workers": 1}])
+def test_scene_change_mask(tmp_path, scenes, params):
+    before, after = scenes
+    process_satellite_scene(after, before, align=False, mask_path=str(tmp_path / "mask"), **params)
+    expected, _ = detect_vegetation_loss(np.asarray(before), np.asarray(after))
+    with open_raster(str(tmp_path / "mask")) as raster:
+        assert np.array_equal(raster.read(), expected)
+
+def test_region_of_interest_change_mask(tmp_path, scenes):
+    before, after = scenes
+    roi = [[[250, 150], [400, 150], [400, 350], [250, 350]]]
+    process_satellite_scene(after, before, align=False, roi=roi, mask_path=str(tmp_path / "mask"))
+    expected, _ = detect_vegetation_loss(np.asarray(before), np.asarray(after))
+    with open_raster(str(tmp_path / "mask")) as raster:
+        changed = raster.read()
+    assert changed.shape == expected.shape
+    assert changed[200:300, 300:400].all()
+    assert not changed[:, 401:].any() and not changed[:, :249].any()
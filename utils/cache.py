@@ -0,0 +1,528 @@
+import os
+import json
+import base64
+import hashlib
+import tempfile
+import weakref
+import functools
+import threading
+import math
+import numpy as np
+from PIL import Image
+
+from utils.tiling import process_satellite_scene
+from utils.image_processing import compute_vegetation_index
+from utils.raster_store import open_raster
+from utils.perceptual_hash import perceptual_hash, image_thumbnail, thumbnail_difference, BKTree, HASH_SIZE
+
+# Location and byte budget of the analysis cache shared by all sessions
+DEFAULT_CACHE_DIR = os.environ.get(
+    "FORESTSIGHT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "forestsight-cache")
+)
+DEFAULT_CACHE_BYTES = int(float(os.environ.get("FORESTSIGHT_CACHE_MB", 1024)) * 1024 * 1024)
+
+# Part of every cache key; bump it when the analysis output changes so
+# entries written by older code are not served
+ANALYSIS_VERSION = 4
+
+# Entries analyzed from near-identical images (recompressed, re-saved) are
+# candidates when each image's perceptual hash differs by at most this many
+# bits...
+NEAR_DUPLICATE_BITS = 12
+# ...and no thumbnail cell differs by more than this many levels. The
+# 64-pixel thumbnail does not see small clearings in large scenes, so
+# candidates are only reused after comparing their vegetation grids
+NEAR_DUPLICATE_TOLERANCE = 8
+
+# Largest change of the vegetation index of any grid cell, as a fraction of
+# the loss threshold, for which an analysis is reused. Cells are small
+# enough that a region of min_region_pixels covers one, so a clearing the
+# analysis would report changes its cell by about the threshold
+NEAR_DUPLICATE_INDEX_FRACTION = 1 / 3
+
+# Vegetation grids are stored as uint8, mapping the index range [-1, 2]
+GRID_LEVELS_PER_UNIT = 85
+
+# Defaults of process_satellite_scene that the near-duplicate check depends on
+DEFAULT_THRESHOLD = 0.15
+DEFAULT_MIN_REGION_PIXELS = 50
+
+# Content hashes of images already hashed in this process, keyed by id()
+# (PIL images are unhashable) with a weak reference to detect reused ids
+_image_hashes = {}
+
+def image_content_hash(image, band_rows=1024):
+    """
+    Hash the decoded pixels of an image.
+    
+    Two uploads with identical pixels get the same hash regardless of file
+    name or encoding. Pixels are hashed in bands of rows to avoid copying the
+    whole image, and hashes are remembered per image object.
+    
+    Parameters:
+    -----------
+    image : PIL.Image
+        The image to hash
+    band_rows : int
+        Number of rows hashed per step
+    
+    Returns:
+    --------
+    str
+        Hex digest of the image mode, size and pixel data
+    """
+    cached = _image_hashes.get(id(image))
+    if cached is not None and cached[0]() is image:
+        return cached[1]
+    
+    digest = hashlib.blake2b(digest_size=20)
+    width, height = image.size
+    digest.update(f"{image.mode}:{width}x{height}".encode())
+    for top in range(0, height, band_rows):
+        digest.update(image.crop((0, top, width, min(top + band_rows, height))).tobytes())
+    
+    return remember_content_hash(image, digest.hexdigest())
+
+def remember_content_hash(image, content_hash):
+    """
+    Record the content hash of an image known to have it, e.g. one decoded
+    from a store entry keyed by the hash, and return the hash.
+    """
+    key = id(image)
+    _image_hashes[key] = (weakref.ref(image, lambda _: _image_hashes.pop(key, None)), content_hash)
+    return content_hash
+
+def analysis_cache_key(images, params):
+    """
+    Build a cache key from the input images and the analysis parameters.
+    
+    Parameters:
+    -----------
+    images : list
+        PIL images (or None for absent inputs) in a fixed order
+    params : dict
+        JSON-serializable analysis parameters
+    
+    Returns:
+    --------
+    str
+        Hex digest identifying the analysis
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"v{ANALYSIS_VERSION}".encode())
+    for image in images:
+        digest.update((image_content_hash(image) if image is not None else "-").encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def perceptual_signature(images):
+    """
+    Concatenate the perceptual hashes of the input images into one integer.
+    
+    Absent inputs contribute zero bits, so the Hamming distance between two
+    signatures is the sum of the distances between their images.
+    """
+    signature = 0
+    for image in images:
+        signature = (signature << HASH_SIZE * HASH_SIZE) | (perceptual_hash(image) if image is not None else 0)
+    return signature
+
+def grid_cell_size(min_region_pixels):
+    """
+    Side of the vegetation grid cells for a minimum region size.
+    
+    A square region of min_region_pixels always covers a whole cell; long,
+    thin regions may not.
+    """
+    return max((math.isqrt(max(int(min_region_pixels), 1)) + 1) // 2, 1)
+
+def vegetation_grid(image, cell_size):
+    """
+    Vegetation index of an image averaged over cells of cell_size pixels.
+    
+    Returns:
+    --------
+    numpy.ndarray
+        uint8 array of shape (ceil(height / cell_size), ceil(width / cell_size)),
+        GRID_LEVELS_PER_UNIT levels per unit of the index
+    """
+    source = image if image.mode == 'RGB' else image.convert('RGB')
+    index = compute_vegetation_index(np.asarray(source.reduce(cell_size)))
+    return np.clip(np.rint((index + 1) * GRID_LEVELS_PER_UNIT), 0, 255).astype(np.uint8)
+
+def analysis_match_key(images, params):
+    """
+    Build the part of a cache key that near-duplicate analyses must share.
+    
+    Covers everything but the pixels: the image sizes and modes, which
+    inputs are present, and the analysis parameters.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"v{ANALYSIS_VERSION}".encode())
+    for image in images:
+        digest.update((f"{image.mode}:{image.width}x{image.height};" if image is not None else "-;").encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+class AnalysisCache:
+    """
+    Disk-backed cache of analysis results with LRU eviction.
+    
+    Each entry is an uncompressed .npy file with the annotated image, which
+    is memory-mapped on a hit, plus a .json file with the deforested areas.
+    The .json file is written last and marks the entry as complete; its
+    modification time records the last access. Files are written atomically
+    with os.replace, so any number of sessions and worker processes can
+    share the same directory.
+    """
+    
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Near-duplicate index: perceptual data of entries by key, a BK-tree
+        # over their signatures, and the directory mtime they reflect
+        self._perceptual = {}
+        self._similar = BKTree()
+        self._indexed_mtime = None
+        self._index_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+    
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".npy", base + ".json"
+    
+    def _grid_path(self, key):
+        return os.path.join(self.directory, key + ".grid.npz")
+    
+    def _mask_path(self, key):
+        return os.path.join(self.directory, key + ".mask.fsrt")
+    
+    def change_mask(self, key):
+        """
+        Open the change mask stored with an entry.
+        
+        Returns:
+        --------
+        TiledRaster or None
+            The memory-mapped mask, or None when the entry has none
+        """
+        try:
+            return open_raster(self._mask_path(key))
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+    
+    def get(self, key):
+        """
+        Look up a cached analysis.
+        
+        Returns:
+        --------
+        tuple or None
+            (processed_image, deforested_areas, extra) on a hit, None on a miss
+        """
+        image_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            pixels = np.load(image_path, mmap_mode='r')
+            os.utime(meta_path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        
+        return Image.fromarray(np.asarray(pixels)), meta["deforested_areas"], meta.get("extra", {})
+    
+    def grids(self, key):
+        """
+        Read the vegetation grids stored with an entry.
+        
+        Returns:
+        --------
+        list or None
+            One array per input image (None for absent inputs), or None when
+            the entry has no grids
+        """
+        try:
+            with np.load(self._grid_path(key)) as data:
+                return [data[name] if name in data.files else None
+                        for name in (f"grid{i}" for i in range(int(data["count"])))]
+        except (FileNotFoundError, ValueError, OSError, KeyError):
+            return None
+    
+    def put(self, key, image, deforested_areas, extra=None, grids=None, mask_path=None):
+        """
+        Store an analysis result and evict old entries if over budget.
+        
+        Parameters:
+        -----------
+        key : str
+            Cache key from analysis_cache_key
+        image : PIL.Image
+            The annotated image
+        deforested_areas : list
+            The detected areas
+        extra : dict, optional
+            Additional JSON-serializable data stored with the entry
+        grids : list, optional
+            Vegetation grids of the input images (None for absent inputs)
+            from vegetation_grid, for the near-duplicate check
+        mask_path : str, optional
+            Change mask written by process_satellite_scene; the file is
+            moved into the cache
+        """
+        image_path, meta_path = self._paths(key)
+        meta = {"deforested_areas": deforested_areas, "extra": extra or {}}
+        
+        if mask_path is not None:
+            os.replace(mask_path, self._mask_path(key))
+        writes = [(image_path, lambda f: np.save(f, np.asarray(image.convert('RGB'))))]
+        if grids is not None:
+            arrays = {f"grid{i}": grid for i, grid in enumerate(grids) if grid is not None}
+            writes.append((self._grid_path(key), lambda f: np.savez(f, count=len(grids), **arrays)))
+        # The metadata marks the entry as complete and is written last
+        writes.append((meta_path, lambda f: f.write(json.dumps(meta).encode())))
+        for path, write in writes:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    write(f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        
+        self.evict()
+    
+    def _refresh_similarity_index(self):
+        """
+        Bring the near-duplicate index in line with the entries on disk.
+        
+        Other sessions and processes add entries and eviction removes them;
+        both change the directory's modification time, so the directory is
+        listed again only when it changed. Only new entries are read.
+        """
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._indexed_mtime:
+            return
+        # Recorded first, so changes made while listing trigger another refresh
+        self._indexed_mtime = mtime
+        
+        keys = {name[:-len(".json")] for name in os.listdir(self.directory) if name.endswith(".json")}
+        removed = self._perceptual.keys() - keys
+        added = keys - self._perceptual.keys()
+        for key in removed:
+            del self._perceptual[key]
+        for key in added:
+            try:
+                with open(self._paths(key)[1]) as f:
+                    perceptual = json.load(f).get("extra", {}).get("perceptual")
+            except (FileNotFoundError, ValueError, OSError):
+                continue
+            # Entries without perceptual data are remembered as None so they are not read again
+            self._perceptual[key] = perceptual and (
+                int(perceptual["signature"], 16),
+                perceptual["match"],
+                [np.frombuffer(base64.b64decode(data), dtype=np.uint8).reshape(shape) if data is not None else None
+                 for data, shape in perceptual["thumbnails"]],
+            )
+        
+        if removed or added:
+            index = BKTree()
+            for key, entry in self._perceptual.items():
+                if entry is not None:
+                    index.add(entry[0], key)
+            self._similar = index
+    
+    def similar_keys(self, signature, match, thumbnails, max_distance, tolerance=NEAR_DUPLICATE_TOLERANCE):
+        """
+        Find entries analyzed from near-identical images.
+        
+        Candidates come from a BK-tree over the perceptual signatures and
+        are confirmed by comparing thumbnails.
+        
+        Parameters:
+        -----------
+        signature : int
+            Perceptual signature from perceptual_signature
+        match : str
+            Key from analysis_match_key; only entries with the same one count
+        thumbnails : list
+            Thumbnails of the input images (None for absent inputs)
+        max_distance : int
+            Largest number of differing signature bits
+        tolerance : int
+            Largest thumbnail difference
+        
+        Returns:
+        --------
+        list
+            Keys of the matching entries, nearest first; an entry may be
+            evicted between this call and reading it
+        """
+        with self._index_lock:
+            self._refresh_similarity_index()
+            candidates = self._similar.search(signature, max_distance)
+            entries = [(key, self._perceptual[key]) for _, key in candidates]
+        
+        keys = []
+        for key, (_, entry_match, entry_thumbnails) in entries:
+            if entry_match == match and all(
+                (a is None and b is None) or
+                (a is not None and b is not None and thumbnail_difference(a, b) <= tolerance)
+                for a, b in zip(thumbnails, entry_thumbnails)
+            ):
+                keys.append(key)
+        return keys
+    
+    def entries(self):
+        """
+        List complete cache entries, least recently used first.
+        
+        Returns:
+        --------
+        list
+            (last_access, size_bytes, key) tuples
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            try:
+                sizes = [os.stat(path) for path in self._paths(key)]
+            except FileNotFoundError:
+                continue
+            size = sizes[0].st_size + sizes[1].st_size
+            for path in (self._grid_path(key), self._mask_path(key)):
+                try:
+                    size += os.stat(path).st_size
+                except FileNotFoundError:
+                    pass
+            entries.append((sizes[1].st_mtime, size, key))
+        return sorted(entries)
+    
+    def size_bytes(self):
+        """Return the total size of all complete entries."""
+        return sum(size for _, size, _ in self.entries())
+    
+    def evict(self):
+        """Delete least recently used entries until the cache fits its budget."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            # Remove the completion marker first so readers never see half an entry
+            for path in (*reversed(self._paths(key)), self._grid_path(key), self._mask_path(key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+@functools.lru_cache(maxsize=None)
+def get_analysis_cache(directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_BYTES):
+    """Return the process-wide AnalysisCache for a directory."""
+    return AnalysisCache(directory, max_bytes)
+
+def cached_process_satellite_scene(image, before_image=None, cache=None, near_duplicates=True, change_mask=False,
+                                   **params):
+    """
+    Run process_satellite_scene, reusing results for identical inputs.
+    
+    The cache key covers the decoded pixels of both images and every analysis
+    parameter, so byte-identical uploads under any file name hit the cache.
+    Failing that, an analysis of near-identical images (perceptual hashes
+    within NEAR_DUPLICATE_BITS, thumbnails within NEAR_DUPLICATE_TOLERANCE)
+    with the same sizes and parameters is reused, so recompressed copies of
+    a scene are not analyzed again. It is only reused when no cell of the
+    vegetation grids, sized after min_region_pixels, changed by more than
+    NEAR_DUPLICATE_INDEX_FRACTION of the threshold, so a new clearing large
+    enough to be reported is analyzed whatever the scene size.
+    
+    Parameters:
+    -----------
+    image : PIL.Image
+        The satellite image to process
+    before_image : PIL.Image, optional
+        Earlier image of the same scene
+    cache : AnalysisCache, optional
+        Cache to use, defaults to the shared cache from get_analysis_cache
+    near_duplicates : bool
+        Reuse analyses of near-identical images
+    change_mask : bool
+        Also return the change mask, stored with the entry as a tiled raster;
+        entries stored without one are analyzed again
+    **params
+        Analysis parameters passed on to process_satellite_scene
+    
+    Returns:
+    --------
+    tuple
+        (processed_image, deforested_areas), with the change mask as a
+        memory-mapped TiledRaster third when change_mask is set
+    """
+    cache = cache or get_analysis_cache()
+    # Execution settings and callbacks do not change the result and are left
+    # out of the key
+    key_params = {name: value for name, value in params.items()
+                  if name not in ("tile_size", "memory_limit_mb", "workers", "on_preview")}
+    key = analysis_cache_key([image, before_image], key_params)
+    
+    def cached_result(entry_key):
+        hit = cache.get(entry_key)
+        if hit is None:
+            return None
+        if not change_mask:
+            return hit[0], hit[1]
+        mask = cache.change_mask(entry_key)
+        return (hit[0], hit[1], mask) if mask is not None else None
+    
+    result = cached_result(key)
+    if result is not None:
+        return result
+    
+    extra = grids = None
+    if near_duplicates:
+        images = [image, before_image]
+        signature = perceptual_signature(images)
+        match = analysis_match_key(images, key_params)
+        thumbnails = [image_thumbnail(source) if source is not None else None for source in images]
+        cell_size = grid_cell_size(params.get("min_region_pixels", DEFAULT_MIN_REGION_PIXELS))
+        grids = [vegetation_grid(source, cell_size) if source is not None else None for source in images]
+        tolerance = params.get("threshold", DEFAULT_THRESHOLD) * NEAR_DUPLICATE_INDEX_FRACTION * GRID_LEVELS_PER_UNIT
+        # The nearest entry still on disk whose grids match is used
+        for similar_key in cache.similar_keys(signature, match, thumbnails, NEAR_DUPLICATE_BITS * len(images)):
+            entry_grids = cache.grids(similar_key)
+            if entry_grids is None or not all(
+                (a is None and b is None) or
+                (a is not None and b is not None and a.shape == b.shape and thumbnail_difference(a, b) <= tolerance)
+                for a, b in zip(grids, entry_grids)
+            ):
+                continue
+            result = cached_result(similar_key)
+            if result is not None:
+                return result
+        extra = {"perceptual": {
+            "signature": format(signature, "x"),
+            "match": match,
+            "thumbnails": [[base64.b64encode(thumbnail.tobytes()).decode(), thumbnail.shape]
+                           if thumbnail is not None else [None, None] for thumbnail in thumbnails],
+        }}
+    
+    mask_path = None
+    if change_mask:
+        fd, mask_path = tempfile.mkstemp(dir=cache.directory, suffix=".tmp")
+        os.close(fd)
+    try:
+        processed_image, deforested_areas = process_satellite_scene(image, before_image, mask_path=mask_path, **params)
+        cache.put(key, processed_image, deforested_areas, extra, grids, mask_path)
+    finally:
+        if mask_path is not None and os.path.exists(mask_path):
+            os.remove(mask_path)
+    if not change_mask:
+        return processed_image, deforested_areas
+    return processed_image, deforested_areas, cache.change_mask(key)
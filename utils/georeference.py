@@ -0,0 +1,217 @@
+import math
+import numpy as np
+
+# Mean Earth radius and the length of one degree of latitude on that sphere
+EARTH_RADIUS_M = 6371008.8
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+# GeoTIFF tags read by GeoTransform.from_geotiff
+MODEL_PIXEL_SCALE_TAG = 33550
+MODEL_TIEPOINT_TAG = 33922
+MODEL_TRANSFORMATION_TAG = 34264
+GEO_KEY_DIRECTORY_TAG = 34735
+GT_MODEL_TYPE_GEOKEY = 1024
+MODEL_TYPE_GEOGRAPHIC = 2
+
+class GeoTransform:
+    """
+    Affine mapping from pixel to geographic coordinates, as in GDAL.
+    
+    The six coefficients (c, a, b, f, d, e) map the pixel corner position
+    (x, y) to longitude c + a*x + b*y and latitude f + d*x + e*y, so (0, 0)
+    is the top-left corner of the top-left pixel. Coordinates are WGS84
+    degrees.
+    """
+    
+    def __init__(self, coefficients):
+        if len(coefficients) != 6:
+            raise ValueError("A geotransform has six coefficients")
+        self.coefficients = tuple(float(value) for value in coefficients)
+    
+    def __repr__(self):
+        return f"GeoTransform({self.coefficients})"
+    
+    def __eq__(self, other):
+        return isinstance(other, GeoTransform) and self.coefficients == other.coefficients
+    
+    @classmethod
+    def from_center(cls, center_lat, center_lon, image_size, pixel_size_m=30.0):
+        """
+        North-up transform for an image centred on a location.
+        
+        Parameters:
+        -----------
+        center_lat : float
+            Latitude of the image centre
+        center_lon : float
+            Longitude of the image centre
+        image_size : tuple
+            (width, height) of the image in pixels
+        pixel_size_m : float
+            Ground sampling distance of one pixel in metres
+        """
+        width, height = image_size
+        lat_step = pixel_size_m / METRES_PER_DEGREE
+        lon_step = lat_step / max(math.cos(math.radians(center_lat)), 1e-6)
+        return cls((center_lon - lon_step * width / 2, lon_step, 0.0,
+                    center_lat + lat_step * height / 2, 0.0, -lat_step))
+    
+    @classmethod
+    def from_world_file(cls, text):
+        """
+        Parse an ESRI world file (.tfw, .jgw, .pgw, .wld).
+        
+        World files list A, D, B, E, C, F, one per line, where (C, F) is the
+        centre of the top-left pixel.
+        """
+        values = [float(line) for line in text.split() if line.strip()]
+        if len(values) != 6:
+            raise ValueError("A world file has six numeric lines")
+        a, d, b, e, c, f = values
+        return cls((c - a / 2 - b / 2, a, b, f - d / 2 - e / 2, d, e))
+    
+    @classmethod
+    def from_geotiff(cls, image):
+        """
+        Read the transform embedded in a GeoTIFF.
+        
+        Parameters:
+        -----------
+        image : PIL.Image
+            An opened TIFF image
+        
+        Returns:
+        --------
+        GeoTransform or None
+            None when the image has no georeference or uses a projected
+            coordinate system, which would need a projection library
+        """
+        tags = getattr(image, "tag_v2", None)
+        if not tags:
+            return None
+        
+        directory = tags.get(GEO_KEY_DIRECTORY_TAG)
+        if directory:
+            # Header of four shorts, then (key, location, count, value) entries
+            keys = {directory[i]: directory[i + 3] for i in range(4, len(directory) - 3, 4)}
+            if keys.get(GT_MODEL_TYPE_GEOKEY, MODEL_TYPE_GEOGRAPHIC) != MODEL_TYPE_GEOGRAPHIC:
+                return None
+        
+        matrix = tags.get(MODEL_TRANSFORMATION_TAG)
+        if matrix and len(matrix) >= 8:
+            transform = cls((matrix[3], matrix[0], matrix[1], matrix[7], matrix[4], matrix[5]))
+        else:
+            scale, tiepoint = tags.get(MODEL_PIXEL_SCALE_TAG), tags.get(MODEL_TIEPOINT_TAG)
+            if not scale or not tiepoint or len(tiepoint) < 6:
+                return None
+            i, j, _, x, y, _ = tiepoint[:6]
+            transform = cls((x - i * scale[0], scale[0], 0.0, y + j * scale[1], 0.0, -scale[1]))
+        
+        west, north = transform.pixel_to_lonlat(0, 0)
+        if not (-180 <= west <= 360 and -90 <= north <= 90):
+            return None
+        return transform
+    
+    def pixel_to_lonlat(self, xs, ys):
+        """
+        Convert pixel positions to longitude and latitude.
+        
+        Parameters:
+        -----------
+        xs, ys : float or numpy.ndarray
+            Pixel corner coordinates; use x + 0.5 for pixel centres
+        
+        Returns:
+        --------
+        tuple
+            (longitudes, latitudes) with the shape of the inputs
+        """
+        c, a, b, f, d, e = self.coefficients
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        return c + a * xs + b * ys, f + d * xs + e * ys
+    
+    def lonlat_to_pixel(self, lons, lats):
+        """Convert longitude and latitude to pixel positions (inverse of pixel_to_lonlat)."""
+        c, a, b, f, d, e = self.coefficients
+        determinant = a * e - b * d
+        lons = np.asarray(lons, dtype=np.float64) - c
+        lats = np.asarray(lats, dtype=np.float64) - f
+        return (e * lons - b * lats) / determinant, (a * lats - d * lons) / determinant
+    
+    def pixel_area_km2(self, lats):
+        """
+        Ground area of one pixel at the given latitudes.
+        
+        A pixel covers |a*e - b*d| square degrees; a square degree shrinks
+        with the cosine of the latitude.
+        """
+        c, a, b, f, d, e = self.coefficients
+        square_degree_km2 = (METRES_PER_DEGREE / 1000) ** 2
+        return abs(a * e - b * d) * square_degree_km2 * np.cos(np.radians(np.asarray(lats, dtype=np.float64)))
+    
+    def pixel_size_m(self, lat):
+        """Side of a square with the ground area of one pixel at a latitude, in metres."""
+        return float(np.sqrt(self.pixel_area_km2(lat)) * 1000)
+    
+    def bounds(self, image_size):
+        """
+        Geographic extent of an image as ((south, west), (north, east)).
+        """
+        width, height = image_size
+        lons, lats = self.pixel_to_lonlat([0, width, width, 0], [0, 0, height, height])
+        return (float(lats.min()), float(lons.min())), (float(lats.max()), float(lons.max()))
+    
+    def center(self, image_size):
+        """Latitude and longitude of the image centre."""
+        lon, lat = self.pixel_to_lonlat(image_size[0] / 2, image_size[1] / 2)
+        return float(lat), float(lon)
+
+def georeference_areas(deforested_areas, transform):
+    """
+    Add geographic coordinates and true areas to detected areas.
+    
+    All areas are converted together with array operations: each gets the
+    'lat'/'lon' of its centroid, its bounding box as 'bounds'
+    ((south, west), (north, east)), and an 'area_km2' computed from its pixel
+    count and the ground area of a pixel at its latitude.
+    
+    Parameters:
+    -----------
+    deforested_areas : list
+        Area dictionaries in pixel coordinates; updated in place
+    transform : GeoTransform
+        Georeference of the analyzed image
+    
+    Returns:
+    --------
+    list
+        deforested_areas
+    """
+    if not deforested_areas:
+        return deforested_areas
+    
+    fields = {key: np.array([area[key] for area in deforested_areas], dtype=np.float64)
+              for key in ("x1", "y1", "x2", "y2", "pixel_count")}
+    centroid_x = np.array([area.get("centroid_x", (area["x1"] + area["x2"]) / 2)
+                           for area in deforested_areas], dtype=np.float64)
+    centroid_y = np.array([area.get("centroid_y", (area["y1"] + area["y2"]) / 2)
+                           for area in deforested_areas], dtype=np.float64)
+    
+    # Centroids are means of pixel indices; pixel centres sit half a pixel in
+    lons, lats = transform.pixel_to_lonlat(centroid_x + 0.5, centroid_y + 0.5)
+    areas_km2 = fields["pixel_count"] * transform.pixel_area_km2(lats)
+    
+    corner_x = np.stack([fields["x1"], fields["x2"], fields["x2"], fields["x1"]])
+    corner_y = np.stack([fields["y1"], fields["y1"], fields["y2"], fields["y2"]])
+    corner_lons, corner_lats = transform.pixel_to_lonlat(corner_x, corner_y)
+    south, north = corner_lats.min(axis=0), corner_lats.max(axis=0)
+    west, east = corner_lons.min(axis=0), corner_lons.max(axis=0)
+    
+    for i, area in enumerate(deforested_areas):
+        area["lat"] = round(float(lats[i]), 6)
+        area["lon"] = round(float(lons[i]), 6)
+        area["bounds"] = [[round(float(south[i]), 6), round(float(west[i]), 6)],
+                          [round(float(north[i]), 6), round(float(east[i]), 6)]]
+        area["area_km2"] = round(float(areas_km2[i]), 2)
+    return deforested_areas
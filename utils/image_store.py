@@ -0,0 +1,173 @@
+import os
+import zlib
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+from PIL import Image
+
+from utils.cache import image_content_hash, remember_content_hash
+
+# Memory one session may use for its images before cold ones go to disk
+DEFAULT_SESSION_BUDGET_MB = float(os.environ.get("FORESTSIGHT_SESSION_IMAGE_MB", 64))
+
+# Images kept decoded however small the budget. The Analysis Results page
+# shows the before and after images and both analyzed images on every
+# rerun, and decoding one again costs its display and hash memos too
+DEFAULT_HOT_IMAGES = 4
+
+# Parent of the per-session spill directories
+DEFAULT_SPILL_DIR = os.environ.get(
+    "FORESTSIGHT_SPILL_DIR", os.path.join(tempfile.gettempdir(), "forestsight-spill")
+)
+
+class SessionImageStore:
+    """
+    The images of one session, stored once per distinct content.
+    
+    Images are put and got by name ("before_image", "analyzed_image", ...).
+    Names with identical pixels share one entry. Recently used entries are
+    kept decoded. Colder ones are held as zlib-compressed pixels and, past
+    the memory budget, written to a spill directory owned by the store. They
+    are decoded again when next requested, unless the decoded image is
+    still alive elsewhere, in which case that same object is returned.
+    Either way the image keeps its content hash, so the memos built on it
+    (display copies, cache keys) still apply.
+    """
+    
+    def __init__(self, memory_budget_mb=DEFAULT_SESSION_BUDGET_MB, hot_images=DEFAULT_HOT_IMAGES,
+                 spill_dir=DEFAULT_SPILL_DIR, level=1):
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.hot_images = hot_images
+        self.level = level
+        self.names = {}
+        # Entries by content hash, least recently used first
+        self.entries = OrderedDict()
+        os.makedirs(spill_dir, exist_ok=True)
+        self.spill_dir = tempfile.mkdtemp(dir=spill_dir)
+        # Spilled files go with the store when the session ends
+        weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+    
+    def __contains__(self, name):
+        return name in self.names
+    
+    def __getitem__(self, name):
+        return self._decode(self.names[name])
+    
+    def __setitem__(self, name, image):
+        if image is None:
+            self.pop(name)
+            return
+        key = image_content_hash(image)
+        if key not in self.entries:
+            self.entries[key] = {
+                "image": image,
+                "mode": image.mode,
+                "size": image.size,
+                "palette": image.getpalette() if image.mode == "P" else None,
+                "decoded_bytes": image.width * image.height * len(image.getbands()),
+                "encoded": None,
+                "path": None,
+                "ref": None,
+            }
+        self.pop(name)
+        self.names[name] = key
+        self.entries.move_to_end(key)
+        self._enforce_budget()
+    
+    def get(self, name, default=None):
+        """Return the image stored under name, or default."""
+        return self[name] if name in self.names else default
+    
+    def pop(self, name):
+        """Forget a name, dropping its entry when no other name refers to it."""
+        key = self.names.pop(name, None)
+        if key is not None and key not in self.names.values():
+            entry = self.entries.pop(key)
+            if entry["path"] is not None:
+                os.remove(entry["path"])
+    
+    def _decode(self, key):
+        entry = self.entries[key]
+        self.entries.move_to_end(key)
+        if entry["image"] is None:
+            image = entry["ref"]() if entry["ref"] is not None else None
+            if image is None:
+                if entry["encoded"] is not None:
+                    data = entry["encoded"]
+                else:
+                    with open(entry["path"], "rb") as f:
+                        data = f.read()
+                image = Image.frombytes(entry["mode"], entry["size"], zlib.decompress(data))
+                if entry["palette"] is not None:
+                    image.putpalette(entry["palette"])
+                remember_content_hash(image, key)
+            entry["image"] = image
+            self._enforce_budget()
+        return entry["image"]
+    
+    def _memory_bytes(self):
+        total = 0
+        for entry in self.entries.values():
+            if entry["image"] is not None:
+                total += entry["decoded_bytes"]
+            if entry["encoded"] is not None:
+                total += len(entry["encoded"])
+        return total
+    
+    def _enforce_budget(self):
+        """Compress all but the hot images, then spill compressed ones until within budget."""
+        decoded = [key for key, entry in self.entries.items() if entry["image"] is not None]
+        for key in decoded[:max(len(decoded) - self.hot_images, 0)]:
+            self._compress(key)
+        
+        # Least recently used first
+        for key, entry in self.entries.items():
+            if self._memory_bytes() <= self.memory_budget:
+                break
+            if entry["encoded"] is not None and entry["image"] is None:
+                self._spill(key)
+    
+    def _compress(self, key):
+        entry = self.entries[key]
+        if entry["encoded"] is None and entry["path"] is None:
+            entry["encoded"] = zlib.compress(entry["image"].tobytes(), self.level)
+        # Still usable while something else holds the decoded image
+        entry["ref"] = weakref.ref(entry["image"])
+        entry["image"] = None
+    
+    def _spill(self, key):
+        entry = self.entries[key]
+        path = os.path.join(self.spill_dir, key + ".zlib")
+        with open(path, "wb") as f:
+            f.write(entry["encoded"])
+        entry["path"] = path
+        entry["encoded"] = None
+    
+    def memory_usage(self):
+        """
+        Report what the stored images cost.
+        
+        Returns:
+        --------
+        dict
+            'images' (distinct contents), 'names', 'decoded_bytes',
+            'encoded_bytes', 'memory_bytes' (their sum) and 'spilled_bytes'
+            on disk
+        """
+        decoded_bytes = encoded_bytes = spilled_bytes = 0
+        for entry in self.entries.values():
+            if entry["image"] is not None:
+                decoded_bytes += entry["decoded_bytes"]
+            if entry["encoded"] is not None:
+                encoded_bytes += len(entry["encoded"])
+            if entry["path"] is not None:
+                spilled_bytes += os.path.getsize(entry["path"])
+        return {
+            "images": len(self.entries),
+            "names": len(self.names),
+            "decoded_bytes": decoded_bytes,
+            "encoded_bytes": encoded_bytes,
+            "memory_bytes": decoded_bytes + encoded_bytes,
+            "spilled_bytes": spilled_bytes,
+        }
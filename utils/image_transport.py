@@ -0,0 +1,139 @@
+import io
+import os
+import hashlib
+import functools
+from PIL import Image, features
+
+from utils.cache import image_content_hash
+from utils.pyramid import display_image
+
+# Files under ./static are served by Streamlit at app/static/ when
+# server.enableStaticServing is on
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static")
+ENCODED_SUBDIR = "encoded"
+STATIC_URL_PREFIX = "app/static"
+
+# Disk used by encoded display images before the oldest are removed
+DEFAULT_STATIC_BYTES = int(float(os.environ.get("FORESTSIGHT_STATIC_MB", 256)) * 1024 * 1024)
+
+# WebP is much smaller than PNG for photographs; JPEG when Pillow lacks WebP
+DEFAULT_DISPLAY_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+FORMAT_EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg", "PNG": "png", "GIF": "gif"}
+
+class ImageTransport:
+    """
+    Encoded display copies of images, written once for static serving.
+    
+    Each image is encoded at the width it is shown at and stored under its
+    content hash, so reruns and sessions showing the same pixels reuse one
+    file and the page only carries its URL.
+    """
+    
+    def __init__(self, directory=os.path.join(STATIC_DIR, ENCODED_SUBDIR), max_bytes=DEFAULT_STATIC_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # File names by (content hash, width, format, quality)
+        self.files = {}
+        os.makedirs(directory, exist_ok=True)
+    
+    def filename(self, image, width, image_format=DEFAULT_DISPLAY_FORMAT, quality=85):
+        """
+        Encode an image for display unless already done and return its file name.
+        
+        Parameters:
+        -----------
+        image : PIL.Image
+            The full-resolution image
+        width : int
+            Width in pixels the image is rendered at
+        image_format : str
+            "WEBP" or "JPEG" (lossy) or "PNG" (lossless)
+        quality : int
+            Encoder quality for lossy formats
+        
+        Returns:
+        --------
+        str
+            Name of the encoded file inside the directory
+        """
+        key = (image_content_hash(image), width, image_format, quality)
+        name = self.files.get(key)
+        if name is not None and os.path.exists(os.path.join(self.directory, name)):
+            return name
+        
+        name = f"{key[0][:32]}-{width}-{quality}.{FORMAT_EXTENSIONS[image_format]}"
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            level = display_image(image, width)
+            if level.width > width:
+                level = level.resize((width, max(round(level.height * width / level.width), 1)), Image.LANCZOS)
+            buffer = io.BytesIO()
+            if image_format == "PNG":
+                level.save(buffer, format="PNG", optimize=True)
+            else:
+                level.convert('RGB').save(buffer, format=image_format, quality=quality)
+            self._write(path, buffer.getvalue())
+        self.files[key] = name
+        return name
+    
+    def url(self, image, width, image_format=DEFAULT_DISPLAY_FORMAT, quality=85):
+        """Return the static-serving URL of the display copy of an image."""
+        return self._url(self.filename(image, width, image_format, quality))
+    
+    def encoded_url(self, data, image_format):
+        """
+        Return the static-serving URL of already encoded image bytes.
+        
+        The bytes are written once under their digest, so serving the same
+        animation or image again only costs hashing it.
+        
+        Parameters:
+        -----------
+        data : bytes
+            The encoded image
+        image_format : str
+            PIL format of data, which gives the file extension
+        """
+        name = f"{hashlib.blake2b(data, digest_size=16).hexdigest()}.{FORMAT_EXTENSIONS[image_format]}"
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            self._write(path, data)
+        return self._url(name)
+    
+    def _url(self, name):
+        return f"{STATIC_URL_PREFIX}/{os.path.basename(self.directory)}/{name}"
+    
+    def _write(self, path, data):
+        # Written under a temporary name so the browser never reads a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self._prune(keep=path)
+    
+    def _prune(self, keep=None):
+        """Remove the least recently written files beyond max_bytes, except keep."""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+@functools.lru_cache(maxsize=None)
+def get_image_transport(directory=os.path.join(STATIC_DIR, ENCODED_SUBDIR), max_bytes=DEFAULT_STATIC_BYTES):
+    """Return the process-wide ImageTransport for a directory."""
+    return ImageTransport(directory, max_bytes)
@@ -0,0 +1,179 @@
+import io
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+
+from utils.pyramid import display_image, FULL_WIDTH_PX
+from utils.perceptual_hash import image_thumbnail
+from utils.georeference import GeoTransform
+
+# Largest upload accepted, in pixels; Pillow's own limit unless overridden,
+# e.g. with FORESTSIGHT_MAX_IMAGE_MPIXELS=500 for scenes over 20k px a side.
+# A higher limit is also set as Pillow's decompression-bomb limit, once and
+# only here, so every image opened in the process is held to the same limit
+MAX_IMAGE_PIXELS = int(float(os.environ.get("FORESTSIGHT_MAX_IMAGE_MPIXELS", 0)) * 1_000_000) or Image.MAX_IMAGE_PIXELS
+if Image.MAX_IMAGE_PIXELS is not None and Image.MAX_IMAGE_PIXELS < MAX_IMAGE_PIXELS:
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# TIFF NewSubfileType bit marking a reduced-resolution copy of the image
+TIFF_NEW_SUBFILE_TYPE = 254
+TIFF_REDUCED_RESOLUTION = 1
+
+# Decoding runs in threads; Pillow releases the GIL while decoding
+_decoder = ThreadPoolExecutor(max_workers=2, thread_name_prefix="forestsight-ingest")
+
+def upload_digest(data):
+    """Hex digest of the bytes of an uploaded file."""
+    return hashlib.sha256(data).hexdigest()
+
+def open_upload(data, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Open an uploaded image without decoding it, rejecting oversized images.
+    
+    Only the file header is read, so decompression bombs are refused before
+    any pixel memory is allocated. max_pixels can lower the limit below
+    MAX_IMAGE_PIXELS; Pillow refuses images far above that in any case.
+    
+    Raises:
+    -------
+    ValueError
+        When the image has more than max_pixels pixels
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise ValueError(str(e)) from None
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ValueError(
+            f"Image is {width}x{height} pixels, more than the {max_pixels:,} pixels accepted"
+        )
+    return image
+
+def normalize_image(image):
+    """Apply the EXIF orientation and convert to RGB, once per upload."""
+    image = ImageOps.exif_transpose(image)
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+def decode_upload(data, max_pixels=MAX_IMAGE_PIXELS):
+    """Decode an uploaded image at full resolution as a normalized RGB image."""
+    image = open_upload(data, max_pixels)
+    image.load()
+    return normalize_image(image)
+
+def seek_tiff_overview(image, width):
+    """
+    Select the smallest reduced-resolution page of a TIFF at least width
+    pixels wide, such as the overviews of a cloud-optimized GeoTIFF.
+    
+    Returns:
+    --------
+    bool
+        True when image was moved to such a page, False when it has none
+    """
+    full_width, full_height = image.size
+    best = None
+    for frame in range(1, getattr(image, "n_frames", 1)):
+        image.seek(frame)
+        reduced = image.tag_v2.get(TIFF_NEW_SUBFILE_TYPE, 0) & TIFF_REDUCED_RESOLUTION
+        # An overview keeps the aspect ratio, to within a pixel of rounding
+        same_shape = abs(image.width * full_height - image.height * full_width) <= max(full_width, full_height)
+        if reduced and same_shape and image.width >= width and (best is None or image.width < best[1]):
+            best = (frame, image.width)
+    image.seek(best[0] if best is not None else 0)
+    return best is not None
+
+def decode_preview(data, width=FULL_WIDTH_PX, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Decode an upload at reduced resolution for display.
+    
+    JPEG draft mode decodes at 1/2, 1/4 or 1/8 scale directly, and TIFFs
+    with overviews decode the smallest one that is wide enough, so this is
+    several times faster than a full decode.
+    
+    Returns:
+    --------
+    PIL.Image or None
+        Normalized RGB preview at least width pixels wide (or full size),
+        or None when the file has no reduced decoding, e.g. PNG
+    """
+    image = open_upload(data, max_pixels)
+    if image.format == "JPEG":
+        scale = min(width / image.width, 1.0)
+        image.draft('RGB', (max(int(image.width * scale), 1), max(int(image.height * scale), 1)))
+        return normalize_image(image)
+    if image.format == "TIFF" and image.width > width and seek_tiff_overview(image, width):
+        return normalize_image(image)
+    return None
+
+def _fingerprint(future):
+    """Compute the near-duplicate thumbnail of a decoded upload in the background."""
+    if not future.cancelled() and future.exception() is None:
+        # Remembered per image, so the near-duplicate lookup at analysis is free
+        _decoder.submit(image_thumbnail, future.result())
+
+class IngestedImage:
+    """
+    An uploaded image being decoded in the background.
+    
+    The header is checked and a preview decoded straight away; the
+    full-resolution image is decoded in a worker thread meanwhile, so it is
+    usually ready by the time it is analyzed. Its thumbnail for the
+    near-duplicate lookup is computed after that, as a separate task. Once the image is taken only
+    the digest and georeference remain.
+    """
+    
+    def __init__(self, data, preview_width=FULL_WIDTH_PX, max_pixels=MAX_IMAGE_PIXELS):
+        """
+        Parameters:
+        -----------
+        data : bytes
+            Contents of the uploaded file
+        preview_width : int
+            Width the preview is displayed at
+        max_pixels : int
+            Largest image accepted
+        
+        Raises:
+        -------
+        ValueError
+            When the image is too large
+        """
+        self.digest = upload_digest(data)
+        # Read from the header; the undecoded image is not kept, as it holds the upload bytes
+        self.geotransform = GeoTransform.from_geotiff(open_upload(data, max_pixels))
+        self._future = _decoder.submit(decode_upload, data, max_pixels)
+        self._future.add_done_callback(_fingerprint)
+        preview = decode_preview(data, preview_width, max_pixels)
+        if preview is None:
+            # No reduced decoding for this file; wait for the full image only
+            preview = display_image(self._future.result(), preview_width)
+        self.preview = preview
+    
+    @property
+    def pending(self):
+        """True until the full image has been taken."""
+        return self._future is not None
+    
+    def done(self):
+        """True once the full image is decoded (or decoding failed)."""
+        return self._future is None or self._future.done()
+    
+    def take(self):
+        """
+        Return the full-resolution image, waiting for it if needed.
+        
+        The ingest drops its references to the image and the preview, so it
+        can be taken only once; decoding errors are raised here.
+        
+        Returns:
+        --------
+        PIL.Image
+            Normalized RGB image
+        """
+        if self._future is None:
+            raise RuntimeError("The image of this upload was already taken")
+        future, self._future = self._future, None
+        self.preview = None
+        return future.result()
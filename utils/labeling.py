@@ -0,0 +1,236 @@
+import numpy as np
+
+def resolve_label_equivalences(num_nodes, first, second):
+    """
+    Find the root of every node given pairs of equivalent nodes.
+    
+    Each pair is hooked onto its smaller root and paths are compressed by
+    pointer jumping, repeated with whole-array operations until no pair
+    spans two roots.
+    
+    Parameters:
+    -----------
+    num_nodes : int
+        Number of nodes, numbered 0..num_nodes-1
+    first : numpy.ndarray
+        Integer array with one node of each pair
+    second : numpy.ndarray
+        Integer array with the other node of each pair
+    
+    Returns:
+    --------
+    numpy.ndarray
+        int64 array mapping each node to the smallest node of its component
+    """
+    parent = np.arange(num_nodes, dtype=np.int64)
+    first = np.asarray(first, dtype=np.int64)
+    second = np.asarray(second, dtype=np.int64)
+    
+    while True:
+        root_a = parent[first]
+        root_b = parent[second]
+        pending = root_a != root_b
+        if not pending.any():
+            break
+        
+        first, second = first[pending], second[pending]
+        root_a, root_b = root_a[pending], root_b[pending]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        
+        # Pointer jumping until every node points directly at its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+    
+    return parent
+
+def find_runs(mask):
+    """
+    Run-length encode the rows of a boolean mask.
+    
+    Parameters:
+    -----------
+    mask : numpy.ndarray
+        Boolean (H, W) array
+    
+    Returns:
+    --------
+    dict
+        int64 arrays 'row', 'start' and 'end' (exclusive) with one entry per
+        horizontal run of set pixels, in raster order
+    """
+    height, width = mask.shape
+    padded = np.zeros((height, width + 2), dtype=bool)
+    padded[:, 1:-1] = mask
+    # Every run starts and ends where the padded row changes value, so the
+    # changes alternate start, end within each row
+    changes = np.flatnonzero(padded[:, 1:] != padded[:, :-1])
+    rows, columns = np.divmod(changes, width + 1)
+    return {"row": rows[0::2], "start": columns[0::2], "end": columns[1::2]}
+
+def label_runs(runs, width):
+    """
+    Label 4-connected regions from the runs of a mask.
+    
+    Runs on consecutive rows that share a column are equivalent. All such
+    pairs are found with two binary searches per run (first pass) and
+    resolved with resolve_label_equivalences (second pass), so the work is
+    proportional to the number of runs rather than the number of pixels.
+    
+    Parameters:
+    -----------
+    runs : dict
+        Runs from find_runs
+    width : int
+        Width of the mask
+    
+    Returns:
+    --------
+    tuple
+        (run_labels, num_labels) where run_labels is an int32 array with the
+        region (1..num_labels) of every run, numbered in raster order
+    """
+    rows, starts, ends = runs["row"], runs["start"], runs["end"]
+    num_runs = rows.size
+    if num_runs == 0:
+        return np.zeros(0, dtype=np.int32), 0
+    
+    # Runs sorted by (row, column) as single keys; both arrays are increasing
+    start_keys = rows * (width + 1) + starts
+    end_keys = rows * (width + 1) + ends
+    previous_row = (rows - 1) * (width + 1)
+    # Runs of the row above overlapping run i form the range [low, high)
+    low = np.searchsorted(end_keys, previous_row + starts, side="right")
+    high = np.searchsorted(start_keys, previous_row + ends, side="left")
+    counts = np.maximum(high - low, 0)
+    
+    total = int(counts.sum())
+    first = np.repeat(np.arange(num_runs), counts)
+    second = np.repeat(low, counts) + (np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts))
+    parent = resolve_label_equivalences(num_runs, first, second)
+    
+    # Roots are the first run of each region, so numbering roots in order
+    # keeps raster order
+    is_root = parent == np.arange(num_runs)
+    region_ids = np.cumsum(is_root, dtype=np.int32)
+    return region_ids[parent], int(region_ids[-1])
+
+def runs_to_labels(shape, runs, run_labels):
+    """
+    Paint labeled runs into an int32 label raster (0 for background).
+    """
+    labels = np.zeros(shape, dtype=np.int32)
+    lengths = runs["end"] - runs["start"]
+    run_offsets = np.cumsum(lengths) - lengths
+    pixels = (np.repeat(runs["row"] * shape[1] + runs["start"] - run_offsets, lengths)
+              + np.arange(int(lengths.sum())))
+    labels.flat[pixels] = np.repeat(run_labels, lengths)
+    return labels
+
+def edge_labels(shape, runs, run_labels):
+    """
+    Labels along the four edges of a labeled mask, without painting it.
+    
+    Returns:
+    --------
+    dict
+        int32 arrays 'top', 'bottom' (length W), 'left' and 'right' (length H)
+    """
+    height, width = shape
+    rows, starts, ends = runs["row"], runs["start"], runs["end"]
+    
+    edges = {}
+    for name, row in (("top", 0), ("bottom", height - 1)):
+        strip = np.zeros(width, dtype=np.int32)
+        on_row = np.flatnonzero(rows == row)
+        if on_row.size:
+            strip = runs_to_labels((1, width), {"row": np.zeros(on_row.size, dtype=np.int64),
+                                                "start": starts[on_row], "end": ends[on_row]},
+                                   run_labels[on_row])[0]
+        edges[name] = strip
+    for name, touching in (("left", starts == 0), ("right", ends == width)):
+        strip = np.zeros(height, dtype=np.int32)
+        strip[rows[touching]] = run_labels[touching]
+        edges[name] = strip
+    return edges
+
+def region_properties(runs, run_labels, num_labels, confidence_values):
+    """
+    Measure every region from its runs.
+    
+    Pixel counts, coordinate sums (for centroids) and confidence sums come
+    from np.bincount over the runs, weighted by per-run totals; bounding
+    boxes from one reduction over the runs grouped by region.
+    
+    Parameters:
+    -----------
+    runs : dict
+        Runs from find_runs
+    run_labels : numpy.ndarray
+        Region of every run from label_runs
+    num_labels : int
+        Number of regions
+    confidence_values : numpy.ndarray
+        Confidence of the mask pixels in raster order, e.g. confidence[mask]
+    
+    Returns:
+    --------
+    dict
+        Arrays of length num_labels keyed by 'x1', 'y1', 'x2', 'y2',
+        'pixel_count', 'confidence_sum', 'x_sum' and 'y_sum'; x2/y2 are
+        exclusive and x_sum/y_sum are sums of pixel column and row indices
+    """
+    if num_labels == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return {"x1": empty, "y1": empty, "x2": empty, "y2": empty, "pixel_count": empty,
+                "confidence_sum": np.zeros(0), "x_sum": np.zeros(0), "y_sum": np.zeros(0)}
+    
+    rows, starts, ends = runs["row"], runs["start"], runs["end"]
+    lengths = ends - starts
+    region = run_labels - 1
+    run_confidence = np.add.reduceat(confidence_values, np.cumsum(lengths) - lengths, dtype=np.float64)
+    
+    def per_region(weights):
+        return np.bincount(region, weights=weights, minlength=num_labels)
+    
+    stats = {
+        "pixel_count": per_region(lengths).astype(np.int64),
+        "confidence_sum": per_region(run_confidence),
+        # Sum of the columns start..end-1 of each run
+        "x_sum": per_region((starts + ends - 1) * lengths / 2),
+        "y_sum": per_region(rows * lengths),
+    }
+    
+    # Runs grouped by region, each group still in raster order
+    order = np.argsort(region, kind="stable")
+    group_sizes = np.bincount(region, minlength=num_labels)
+    group_starts = np.cumsum(group_sizes) - group_sizes
+    stats["x1"] = np.minimum.reduceat(starts[order], group_starts)
+    stats["x2"] = np.maximum.reduceat(ends[order], group_starts)
+    stats["y1"] = rows[order][group_starts]
+    stats["y2"] = rows[order][group_starts + group_sizes - 1] + 1
+    return stats
+
+def label_regions(mask, confidence):
+    """
+    Label the 4-connected regions of a mask and measure them.
+    
+    Parameters:
+    -----------
+    mask : numpy.ndarray
+        Boolean (H, W) array
+    confidence : numpy.ndarray
+        float32 (H, W) per-pixel confidence
+    
+    Returns:
+    --------
+    tuple
+        (stats, runs, run_labels) with stats from region_properties, so
+        callers can paint or inspect the labels without a label raster
+    """
+    runs = find_runs(mask)
+    run_labels, num_labels = label_runs(runs, mask.shape[1])
+    stats = region_properties(runs, run_labels, num_labels, confidence[mask])
+    return stats, runs, run_labels
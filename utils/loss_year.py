@@ -0,0 +1,96 @@
+import numpy as np
+
+from utils.image_processing import compute_vegetation_index
+
+# Loss-year value of pixels that were not forest in the first image
+NOT_FOREST = 255
+
+def compute_loss_year(stack, threshold=0.15, vegetation_threshold=0.05, band_rows=64):
+    """
+    Compute the first year each pixel lost its vegetation in an image stack.
+    
+    The vegetation index of every frame is compared with the first frame,
+    and the index of the first frame whose drop exceeds the threshold is
+    recorded. All frames of a band of rows are evaluated together.
+    
+    Parameters:
+    -----------
+    stack : numpy.ndarray or TimelapseFrames
+        uint8 array of shape (T, H, W, C) of co-registered annual images,
+        oldest first, with 2 <= T < 255, or a utils.timelapse provider whose
+        frames are then computed one band of rows at a time
+    threshold : float
+        Minimum drop in vegetation index from the first frame counted as loss
+    vegetation_threshold : float
+        Minimum vegetation index in the first frame for a pixel to be forest
+    band_rows : int
+        Number of rows evaluated per vectorized step
+    
+    Returns:
+    --------
+    numpy.ndarray
+        uint8 (H, W) raster: 0 for forest without loss, t (1..T-1) for loss
+        first detected in frame t, NOT_FOREST where the first frame had no forest
+    """
+    num_frames, height, width = stack.shape[:3]
+    if not 2 <= num_frames < NOT_FOREST:
+        raise ValueError(f"Expected between 2 and {NOT_FOREST - 1} frames, got {num_frames}")
+    
+    loss_year = np.empty((height, width), dtype=np.uint8)
+    for top in range(0, height, band_rows):
+        bottom = min(top + band_rows, height)
+        if isinstance(stack, np.ndarray):
+            band_frames = stack[:, top:bottom, :, :3]
+        else:
+            band_frames = stack.read_band(top, bottom)
+        index = compute_vegetation_index(band_frames)
+        baseline = index[0]
+        
+        crossed = (baseline - index[1:]) > threshold
+        # argmax finds the first True along time; rows without loss get 0 below
+        first = np.argmax(crossed, axis=0).astype(np.uint8) + 1
+        band = np.where(crossed.any(axis=0), first, 0).astype(np.uint8)
+        band[baseline <= vegetation_threshold] = NOT_FOREST
+        loss_year[top:bottom] = band
+    
+    return loss_year
+
+def loss_area_by_year(loss_year, years, pixel_size_m=30.0):
+    """
+    Summarize a loss-year raster into per-year loss and remaining forest.
+    
+    Parameters:
+    -----------
+    loss_year : numpy.ndarray or TiledRaster
+        uint8 raster from compute_loss_year, in memory or stored with
+        utils.raster_store (read one tile at a time)
+    years : list
+        Calendar year of every frame of the stack, oldest first
+    pixel_size_m : float
+        Ground sampling distance of one pixel in metres
+    
+    Returns:
+    --------
+    dict
+        'Year', 'Loss (km²)', 'Loss (%)' and 'Forest Cover (%)' lists, one
+        entry per year, relative to the forest in the first frame
+    """
+    if isinstance(loss_year, np.ndarray):
+        counts = np.bincount(loss_year.ravel(), minlength=NOT_FOREST + 1)
+    else:
+        counts = np.zeros(NOT_FOREST + 1, dtype=np.int64)
+        for _, _, tile in loss_year.iter_tiles():
+            counts += np.bincount(tile.ravel(), minlength=NOT_FOREST + 1)
+    forest_pixels = counts[:NOT_FOREST].sum()
+    loss_pixels = counts[:len(years)].copy()
+    # Index 0 holds pixels without loss; the first year has no loss by definition
+    loss_pixels[0] = 0
+    
+    pixel_area_km2 = (pixel_size_m ** 2) / 1e6
+    share = loss_pixels / forest_pixels if forest_pixels else np.zeros(len(years))
+    return {
+        "Year": list(years),
+        "Loss (km²)": np.round(loss_pixels * pixel_area_km2, 2).tolist(),
+        "Loss (%)": np.round(100 * share, 2).tolist(),
+        "Forest Cover (%)": np.round(100 * (1 - np.cumsum(share)), 2).tolist(),
+    }
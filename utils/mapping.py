@@ -1,10 +1,17 @@
 import folium
 import random
+import numpy as np
 from folium.plugins import HeatMap, MarkerCluster, MeasureControl, Draw, Fullscreen
 from data.sample_coordinates import get_coordinates_for_location
+from utils.georeference import GeoTransform
+from utils.vectorize import areas_to_geojson, tolerance_for_zoom
 from datetime import datetime, timedelta
 
-def create_map_with_deforestation(center_lat, center_lon, zoom, deforested_areas=None):
+# Largest side of the change-mask overlay image sent to the map
+CHANGE_OVERLAY_SIZE = 1024
+
+def create_map_with_deforestation(center_lat, center_lon, zoom, deforested_areas=None, image_size=None,
+                                  pixel_size_m=30.0, geotransform=None, draw=False, change_mask=None):
     """
     Create an interactive map with deforested areas highlighted.
     
@@ -18,12 +25,36 @@ def create_map_with_deforestation(center_lat, center_lon, zoom, deforested_areas
         Initial zoom level
     deforested_areas : list, optional
         List of dictionaries containing deforested area information
+    image_size : tuple, optional
+        (width, height) of the analyzed image; defaults to the extent of the
+        areas
+    pixel_size_m : float
+        Ground sampling distance of one pixel in metres
+    geotransform : GeoTransform, optional
+        Georeference of the analyzed image. The map is then centred on the
+        image; without one the image is assumed centred on center_lat/lon.
+    draw : bool
+        Add polygon and rectangle drawing tools, e.g. to select a region of
+        interest
+    change_mask : TiledRaster, optional
+        Stored change mask of the analysis, overlaid as the share of changed
+        pixels at up to CHANGE_OVERLAY_SIZE pixels a side
         
     Returns:
     --------
     folium.Map
         An interactive Folium map
     """
+    if change_mask is not None and image_size is None:
+        image_size = (change_mask.shape[1], change_mask.shape[0])
+    if deforested_areas and image_size is None:
+        image_size = (max(area["x2"] for area in deforested_areas), max(area["y2"] for area in deforested_areas))
+    if geotransform is not None and image_size is not None:
+        center_lat, center_lon = geotransform.center(image_size)
+        pixel_size_m = geotransform.pixel_size_m(center_lat)
+    elif deforested_areas or change_mask is not None:
+        geotransform = GeoTransform.from_center(center_lat, center_lon, image_size, pixel_size_m)
+    
     # Create base map
     m = folium.Map(
         location=[center_lat, center_lon],
@@ -42,24 +73,66 @@ def create_map_with_deforestation(center_lat, center_lon, zoom, deforested_areas
     # Add a simple scale
     folium.plugins.MeasureControl(position='bottomleft', primary_length_unit='kilometers').add_to(m)
     
+    if draw:
+        Draw(
+            position='topleft',
+            draw_options={
+                'polyline': False,
+                'polygon': True,
+                'rectangle': True,
+                'circle': False,
+                'marker': False,
+                'circlemarker': False
+            }
+        ).add_to(m)
+    
+    if change_mask is not None:
+        # Read from the stored tiles at overlay resolution, never in full
+        coverage = change_mask.overview(CHANGE_OVERLAY_SIZE)
+        overlay = np.zeros(coverage.shape + (4,), dtype=np.uint8)
+        overlay[..., 0] = 255
+        overlay[..., 3] = np.rint(coverage * 200).astype(np.uint8)
+        # Edge blocks of the overview extend past the scene to whole blocks
+        factor = max(-(-max(change_mask.shape) // CHANGE_OVERLAY_SIZE), 1)
+        height, width = coverage.shape[0] * factor, coverage.shape[1] * factor
+        lons, lats = geotransform.pixel_to_lonlat(np.array([0, width, 0, width]), np.array([0, 0, height, height]))
+        folium.raster_layers.ImageOverlay(
+            overlay,
+            bounds=[[float(lats.min()), float(lons.min())], [float(lats.max()), float(lons.max())]],
+            name="Changed Pixels"
+        ).add_to(m)
+    
     # If we have deforested areas, add them to the map
     if deforested_areas:
-        # In a real application, these would be actual geo-coordinates
-        # Here we're simulating by generating random coordinates around the center
+        # Region outlines simplified to what is visible at the initial zoom
+        geojson = areas_to_geojson(
+            deforested_areas, geotransform.pixel_to_lonlat, tolerance_for_zoom(zoom, center_lat, pixel_size_m)
+        )
+        folium.GeoJson(
+            geojson,
+            name="Deforested Areas",
+            style_function=lambda feature: {
+                "color": "red",
+                "weight": 2,
+                "fillColor": "red",
+                "fillOpacity": 0.4,
+            },
+            tooltip=folium.GeoJsonTooltip(
+                fields=["id", "area_km2", "confidence"],
+                aliases=["Deforested Area #", "Area (km²)", "Confidence"],
+                localize=True
+            )
+        ).add_to(m)
         
-        # Create a feature group for deforested areas
-        deforested_group = folium.FeatureGroup(name="Deforested Areas")
+        # Markers and heatmap points at the region centroids, converted
+        # together; centroids index pixels, so their centres are half a pixel in
+        centroid_x = np.array([area.get("centroid_x", (area["x1"] + area["x2"]) / 2) for area in deforested_areas])
+        centroid_y = np.array([area.get("centroid_y", (area["y1"] + area["y2"]) / 2) for area in deforested_areas])
+        lons, lats = geotransform.pixel_to_lonlat(centroid_x + 0.5, centroid_y + 0.5)
+        lons, lats = lons.tolist(), lats.tolist()
         
+        marker_group = folium.FeatureGroup(name="Area Markers")
         for i, area in enumerate(deforested_areas):
-            # Generate a random offset from the center (in degrees)
-            lat_offset = random.uniform(-0.05, 0.05)
-            lon_offset = random.uniform(-0.05, 0.05)
-            
-            # Calculate coordinate
-            area_lat = center_lat + lat_offset
-            area_lon = center_lon + lon_offset
-            
-            # Add a marker with popup
             popup_html = f"""
             <div style="width: 200px;">
                 <h4>Deforested Area #{i+1}</h4>
@@ -70,38 +143,13 @@ def create_map_with_deforestation(center_lat, center_lon, zoom, deforested_areas
             """
             
             folium.Marker(
-                [area_lat, area_lon],
+                [lats[i], lons[i]],
                 popup=folium.Popup(popup_html, max_width=300),
                 icon=folium.Icon(color="red", icon="tree", prefix="fa")
-            ).add_to(deforested_group)
+            ).add_to(marker_group)
+        marker_group.add_to(m)
             
-            # Add a red circle to highlight the area
-            folium.Circle(
-                [area_lat, area_lon],
-                radius=area['area_km2'] * 100,  # Scale for visibility
-                color="red",
-                fill=True,
-                fill_color="red",
-                fill_opacity=0.4,
-                tooltip=f"Deforested Area: {area['area_km2']} km²"
-            ).add_to(deforested_group)
-        
-        # Add the deforested areas to the map
-        deforested_group.add_to(m)
-        
-        # Generate heatmap data
-        heatmap_data = []
-        for i in range(20):  # Generate more points for a better heatmap
-            for area in deforested_areas:
-                # Add multiple points around each deforested area
-                lat_offset = random.uniform(-0.03, 0.03)
-                lon_offset = random.uniform(-0.03, 0.03)
-                area_lat = center_lat + lat_offset
-                area_lon = center_lon + lon_offset
-                intensity = area['confidence'] * random.uniform(0.5, 1.0)
-                heatmap_data.append([area_lat, area_lon, intensity])
-        
-        # Add heatmap layer
+        heatmap_data = [[lat, lon, area['confidence']] for lat, lon, area in zip(lats, lons, deforested_areas)]
         HeatMap(heatmap_data, name="Deforestation Intensity").add_to(m)
     
     # Add layer control
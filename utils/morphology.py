@@ -0,0 +1,214 @@
+import numpy as np
+
+def integral_image(array):
+    """
+    Compute the summed-area table of a 2D array.
+    
+    Parameters:
+    -----------
+    array : numpy.ndarray
+        2D array; booleans and integers are summed as int64, floats as float64
+    
+    Returns:
+    --------
+    numpy.ndarray
+        Array of shape (H + 1, W + 1) whose entry [y, x] is the sum of
+        array[:y, :x]
+    """
+    dtype = np.float64 if np.issubdtype(array.dtype, np.floating) else np.int64
+    integral = np.zeros((array.shape[0] + 1, array.shape[1] + 1), dtype=dtype)
+    np.cumsum(array, axis=0, dtype=dtype, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return integral
+
+def rectangle_sum(integral, x0, y0, x1, y1):
+    """
+    Sum the pixels of one or many rectangles with four lookups each.
+    
+    Parameters:
+    -----------
+    integral : numpy.ndarray
+        Summed-area table from integral_image
+    x0, y0, x1, y1 : int or numpy.ndarray
+        Rectangle bounds in pixels, x1/y1 exclusive
+    
+    Returns:
+    --------
+    scalar or numpy.ndarray
+        Sum over each rectangle
+    """
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+def _box_sum_axis(array, radius, axis, dtype):
+    """Sum over a window of 2 * radius + 1 along one axis, clipped at the edges."""
+    length = array.shape[axis]
+    shape = list(array.shape)
+    shape[axis] = length + 1
+    
+    def along(start, stop=None):
+        index = [slice(None)] * array.ndim
+        index[axis] = slice(start, stop)
+        return tuple(index)
+    
+    # cumulative[k] holds the sum of the first k values along the axis
+    cumulative = np.zeros(shape, dtype=dtype)
+    if axis == 0:
+        # numpy's cumsum down the columns of a C-ordered array is strided;
+        # adding whole rows keeps every step contiguous
+        cumulative[1:] = array
+        for row in range(1, length):
+            np.add(cumulative[row + 1], cumulative[row], out=cumulative[row + 1])
+    else:
+        np.cumsum(array, axis=axis, dtype=dtype, out=cumulative[along(1)])
+    
+    # out[i] = cumulative[min(i + radius + 1, length)] - cumulative[max(i - radius, 0)],
+    # written as slices so no index arrays are gathered
+    out = np.empty(array.shape, dtype=dtype)
+    split = max(length - radius - 1, 0)
+    out[along(0, split)] = cumulative[along(radius + 1, radius + 1 + split)]
+    out[along(split)] = cumulative[along(length, length + 1)]
+    lead = min(radius, length)
+    out[along(lead)] -= cumulative[along(0, length - lead)]
+    return out
+
+def box_count(shape, radius):
+    """
+    Number of in-image pixels in each square window of a 2D shape.
+    
+    Windows are clipped at the image edges, so counts are smaller there.
+    """
+    counts = []
+    for length in shape:
+        positions = np.arange(length)
+        counts.append(np.minimum(positions + radius + 1, length) - np.maximum(positions - radius, 0))
+    return np.outer(counts[0], counts[1])
+
+def box_sum(array, radius):
+    """
+    Sum every pixel's (2 * radius + 1) square neighbourhood.
+    
+    The box is separable, so the sum is taken as one running sum along the
+    rows and one along the columns. Each costs a constant number of
+    operations per pixel whatever the radius. Windows are clipped at the
+    image edges.
+    
+    Parameters:
+    -----------
+    array : numpy.ndarray
+        2D array; booleans are summed as int32, integers as int64 and
+        floats as float64
+    radius : int
+        Half-width of the square window
+    
+    Returns:
+    --------
+    numpy.ndarray
+        Array of the same shape with the window sums
+    """
+    if np.issubdtype(array.dtype, np.floating):
+        dtype = np.float64
+    else:
+        # Masks are summed in int32 to halve memory traffic; window counts
+        # stay far below its range
+        dtype = np.int32 if array.dtype == bool else np.int64
+    return _box_sum_axis(_box_sum_axis(array, radius, 0, dtype), radius, 1, dtype)
+
+def box_filter(array, radius):
+    """
+    Mean of every pixel's (2 * radius + 1) square neighbourhood.
+    
+    Windows are clipped at the image edges and averaged over the pixels they
+    cover.
+    
+    Returns:
+    --------
+    numpy.ndarray
+        float64 array of the same shape
+    """
+    return box_sum(array, radius) / box_count(array.shape, radius)
+
+def local_mean_variance(array, radius):
+    """
+    Compute the sliding-window mean and variance of a 2D array.
+    
+    Both come from box sums of the values and of their squares, so local
+    texture can be measured at any window size in linear time.
+    
+    Parameters:
+    -----------
+    array : numpy.ndarray
+        2D array, e.g. a vegetation index or a grayscale band
+    radius : int
+        Half-width of the square window
+    
+    Returns:
+    --------
+    tuple
+        (mean, variance) float64 arrays of the same shape as array
+    """
+    if np.issubdtype(array.dtype, np.floating):
+        values = array.astype(np.float64)
+        squares = values * values
+    else:
+        # Integer squares are summed exactly
+        values = array.astype(np.int64)
+        squares = values * values
+    
+    counts = box_count(array.shape, radius)
+    mean = box_sum(values, radius) / counts
+    variance = box_sum(squares, radius) / counts - mean * mean
+    np.maximum(variance, 0, out=variance)
+    return mean, variance
+
+def erode(mask, radius):
+    """
+    Binary erosion with a (2 * radius + 1) square structuring element.
+    
+    A pixel stays set when its whole window (clipped at the image edges)
+    is set.
+    """
+    if radius <= 0:
+        return mask.copy()
+    return box_sum(mask, radius) == box_count(mask.shape, radius)
+
+def dilate(mask, radius):
+    """
+    Binary dilation with a (2 * radius + 1) square structuring element.
+    
+    A pixel becomes set when any pixel of its window is set.
+    """
+    if radius <= 0:
+        return mask.copy()
+    return box_sum(mask, radius) > 0
+
+def opening(mask, radius):
+    """Erode then dilate: removes set regions narrower than the window."""
+    return dilate(erode(mask, radius), radius)
+
+def closing(mask, radius):
+    """Dilate then erode: fills holes and gaps narrower than the window."""
+    return erode(dilate(mask, radius), radius)
+
+def smooth_mask(mask, radius):
+    """
+    Clean a thresholded change mask.
+    
+    An opening removes isolated speckle, then a closing fills pinholes
+    inside the remaining regions. The result at a pixel depends only on
+    pixels within 4 * radius of it.
+    
+    Parameters:
+    -----------
+    mask : numpy.ndarray
+        2D boolean mask
+    radius : int
+        Half-width of the square structuring element; 0 returns mask unchanged
+    
+    Returns:
+    --------
+    numpy.ndarray
+        The smoothed boolean mask
+    """
+    if radius <= 0:
+        return mask
+    return closing(opening(mask, radius), radius)
@@ -0,0 +1,204 @@
+import os
+import sys
+import queue
+import pickle
+import atexit
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from utils.tiling import (
+    iter_tile_windows,
+    scene_size,
+    read_window,
+    merge_tile_results,
+    tile_size_for_memory,
+    analyze_scene_tiled,
+)
+from utils.image_processing import regions_to_areas
+
+def available_cpus():
+    """Number of CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# Default number of worker processes for parallel tile analysis
+DEFAULT_WORKERS = int(os.environ.get("FORESTSIGHT_WORKERS", 0)) or available_cpus()
+
+# Directory containing the utils package, from which workers are started
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Worker pools by size, kept for the life of the process
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _copy_to_file(source, band_rows=1024):
+    """
+    Copy a scene into a temporary .npy file as a uint8 RGB array.
+    
+    The scene is copied in bands of rows so no second full-size temporary
+    is created for PIL sources. Workers memory-map the file, so the pages
+    are shared through the page cache rather than copied.
+    
+    Returns:
+    --------
+    str
+        Path of the file; the caller removes it
+    """
+    width, height = scene_size(source)
+    fd, path = tempfile.mkstemp(prefix="forestsight-scene-", suffix=".npy")
+    os.close(fd)
+    try:
+        scene = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(height, width, 3))
+        for top in range(0, height, band_rows):
+            bottom = min(top + band_rows, height)
+            scene[top:bottom] = read_window(source, (0, top, width, bottom))
+        del scene
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+class _WorkerPool:
+    """
+    Long-lived worker processes running utils.tile_worker.
+    
+    Workers are started as ``python -m utils.tile_worker`` rather than
+    through multiprocessing, which re-runs the parent's __main__ in every
+    child; under Streamlit that is the page script. Nothing in the parent
+    changes while they start, so other sessions are unaffected.
+    """
+    
+    def __init__(self, size):
+        self.size = size
+        self._processes = [self._start() for _ in range(size)]
+        self._idle = queue.Queue()
+        for process in self._processes:
+            self._idle.put(process)
+    
+    @staticmethod
+    def _start():
+        return subprocess.Popen([sys.executable, "-m", "utils.tile_worker"],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=PACKAGE_ROOT)
+    
+    def _run(self, task):
+        """Run one task on an idle worker, replacing the worker if it died."""
+        process = self._idle.get()
+        try:
+            pickle.dump(task, process.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+            process.stdin.flush()
+            ok, result = pickle.load(process.stdout)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            process.kill()
+            process.wait()
+            replacement = self._start()
+            self._processes[self._processes.index(process)] = replacement
+            process = replacement
+            raise RuntimeError("A tile worker process exited unexpectedly")
+        finally:
+            self._idle.put(process)
+        if not ok:
+            raise result
+        return result
+    
+    def map(self, tasks):
+        """Run tasks on the workers, returning their results in task order."""
+        with ThreadPoolExecutor(self.size, thread_name_prefix="forestsight-tiles") as executor:
+            return list(executor.map(self._run, tasks))
+    
+    def terminate(self):
+        for process in self._processes:
+            process.kill()
+
+def _get_pool(workers):
+    """Return the worker pool of a size, starting it on first use."""
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = _pools[workers] = _WorkerPool(workers)
+        return pool
+
+@atexit.register
+def _shutdown_pools():
+    for pool in _pools.values():
+        pool.terminate()
+
+def analyze_scene_parallel(after, before=None, threshold=0.15, min_region_pixels=50, pixel_size_m=30.0,
+                           tile_size=2048, overlap=32, memory_limit_mb=None, workers=None,
+                           smoothing_radius=0):
+    """
+    Detect deforestation in a large scene with tiles analyzed in parallel.
+    
+    The scenes are written once to temporary files that worker processes
+    memory-map to read their tile windows, so only tile descriptions and the
+    small per-tile region statistics cross process boundaries. Results are merged
+    in tile order, giving the same output as analyze_scene_tiled. The worker
+    processes are started once and reused by later analyses.
+    
+    Parameters:
+    -----------
+    after : PIL.Image or numpy.ndarray
+        The later image (or the only image)
+    before : PIL.Image or numpy.ndarray, optional
+        The earlier image, same size as after
+    threshold : float
+        Minimum drop in vegetation index counted as change
+    min_region_pixels : int
+        Regions smaller than this are discarded as noise
+    pixel_size_m : float
+        Ground sampling distance of one pixel in metres
+    tile_size : int
+        Side length of each tile core in pixels
+    overlap : int
+        Extra pixels read on each side of a tile
+    memory_limit_mb : float, optional
+        Memory ceiling for each worker's per-tile working set
+    workers : int, optional
+        Number of worker processes, defaults to DEFAULT_WORKERS; at most one
+        per available CPU is used, and with one the scene is analyzed in
+        this process
+    smoothing_radius : int
+        Radius of the change-mask smoothing; overlap is widened to cover it
+    
+    Returns:
+    --------
+    list
+        List of deforested area dictionaries in scene coordinates
+    """
+    width, height = scene_size(after)
+    if before is not None and scene_size(before) != (width, height):
+        raise ValueError("Before and after images must have the same dimensions")
+    
+    overlap = max(overlap, 4 * smoothing_radius)
+    if memory_limit_mb is not None:
+        tile_size = min(tile_size, tile_size_for_memory(memory_limit_mb, overlap))
+    
+    tiles = list(iter_tile_windows(width, height, tile_size, overlap))
+    # Workers beyond the CPUs available only add start-up and copying cost
+    workers = min(workers or DEFAULT_WORKERS, len(tiles), available_cpus())
+    if workers <= 1:
+        return analyze_scene_tiled(after, before, threshold, min_region_pixels, pixel_size_m,
+                                   tile_size=tile_size, overlap=overlap, smoothing_radius=smoothing_radius)
+    
+    paths = []
+    try:
+        paths.append(_copy_to_file(after))
+        scenes = {"after": paths[0], "before": None}
+        if before is not None:
+            paths.append(_copy_to_file(before))
+            scenes["before"] = paths[1]
+        
+        tile_stats = _get_pool(workers).map(
+            [(scenes, tile, threshold, smoothing_radius) for tile in tiles]
+        )
+    finally:
+        # Workers map the files only while a task runs
+        for path in paths:
+            os.remove(path)
+    
+    stats = merge_tile_results(list(zip(tiles, tile_stats)))
+    return regions_to_areas(stats, min_region_pixels, pixel_size_m)
@@ -0,0 +1,128 @@
+import weakref
+import numpy as np
+from PIL import Image
+
+# Width of the thumbnail kept per image; its cells are averages over
+# blocks of 1/64 of the image width
+THUMBNAIL_WIDTH = 64
+
+# Side of the difference-hash grid; the hash has HASH_SIZE**2 bits
+HASH_SIZE = 8
+
+# Thumbnails of images already seen in this process, keyed by id()
+_thumbnails = {}
+
+def image_thumbnail(image, width=THUMBNAIL_WIDTH):
+    """
+    Box-averaged RGB thumbnail of an image, remembered per image object.
+    
+    Returns:
+    --------
+    numpy.ndarray
+        uint8 array of shape (height, width, 3), the height following the
+        aspect ratio
+    """
+    key = (id(image), width)
+    cached = _thumbnails.get(key)
+    if cached is not None and cached[0]() is image:
+        return cached[1]
+    
+    # Averaging before any mode conversion avoids a full-size copy
+    source = image if image.mode == 'RGB' else image.convert('RGB')
+    height = max(round(image.height * width / image.width), 1)
+    thumbnail = np.asarray(source.resize((width, height), Image.BOX))
+    
+    _thumbnails[key] = (weakref.ref(image, lambda _: _thumbnails.pop(key, None)), thumbnail)
+    return thumbnail
+
+def perceptual_hash(image, hash_size=HASH_SIZE):
+    """
+    Difference hash (dHash) of an image.
+    
+    The image is box-averaged to a (hash_size + 1) x hash_size grayscale
+    grid and each bit records whether a cell is brighter than its right
+    neighbour. Recompressing, rescaling or renaming an image changes few
+    bits, but so can small changes to the scene: the hash finds candidates,
+    compare thumbnails to confirm them.
+    
+    Parameters:
+    -----------
+    image : PIL.Image
+        The image to hash
+    hash_size : int
+        Side of the hash grid
+    
+    Returns:
+    --------
+    int
+        The hash as an unsigned integer
+    """
+    thumbnail = Image.fromarray(image_thumbnail(image))
+    grid = np.asarray(thumbnail.resize((hash_size + 1, hash_size), Image.BOX).convert('L'), dtype=np.int16)
+    bits = (grid[:, 1:] > grid[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def thumbnail_difference(a, b):
+    """Largest per-channel difference between two thumbnails of the same shape."""
+    return int(np.abs(a.astype(np.int16) - b).max())
+
+def hamming_distance(a, b):
+    """Number of differing bits between two hashes."""
+    return (a ^ b).bit_count()
+
+class BKTree:
+    """
+    Burkhard-Keller tree of hashes under the Hamming distance.
+    
+    Each child edge is labelled with the distance between child and parent,
+    so a search within radius r only descends into edges labelled
+    d - r .. d + r, visiting a small fraction of the tree.
+    """
+    
+    def __init__(self):
+        # Nodes are [hash, values, children by distance]
+        self.root = None
+        self.size = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def add(self, value_hash, value):
+        """Add a value under a hash; values with equal hashes share a node."""
+        self.size += 1
+        if self.root is None:
+            self.root = [value_hash, [value], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value_hash, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value_hash, [value], {}]
+                return
+            node = child
+    
+    def search(self, query_hash, max_distance):
+        """
+        Find the values whose hash is within max_distance of query_hash.
+        
+        Returns:
+        --------
+        list
+            (distance, value) pairs, nearest first
+        """
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(query_hash, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, value) for value in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        matches.sort(key=lambda match: match[0])
+        return matches
@@ -0,0 +1,201 @@
+import numpy as np
+from PIL import Image
+
+from utils.image_processing import (
+    detect_vegetation_loss,
+    detect_bare_ground,
+    regions_to_areas,
+    render_detection_overlay,
+)
+from utils.labeling import label_regions
+from utils.morphology import dilate
+from utils.roi import reduce_roi
+from utils.tiling import (
+    iter_tile_windows,
+    scene_size,
+    read_window,
+    analyze_tile,
+    merge_tile_results,
+    window_of,
+)
+
+# Downscaling of the preview pass; the scene is analyzed at 1/8 resolution
+PREVIEW_SCALE = 8
+
+# Averaging 8x8 blocks dilutes clearings smaller than a block, so the coarse
+# pass uses a lower threshold to keep them as candidates
+COARSE_THRESHOLD_FACTOR = 0.5
+
+# Tile size of the refinement pass; smaller tiles skip more intact forest
+REFINE_TILE_SIZE = 512
+
+def reduce_scene(source, scale):
+    """Downscale a PIL image, an AlignedImage or an (H, W, C) array by box averaging, as an RGB array."""
+    if isinstance(source, np.ndarray):
+        source = Image.fromarray(np.ascontiguousarray(source[:, :, :3]))
+    return np.asarray(source.convert('RGB').reduce(scale))
+
+def preview_analysis(after, before=None, threshold=0.15, min_region_pixels=50, pixel_size_m=30.0,
+                     scale=PREVIEW_SCALE, coarse_roi=None):
+    """
+    Detect change on a downscaled copy of a scene.
+    
+    Parameters:
+    -----------
+    after : PIL.Image or numpy.ndarray
+        The later image (or the only image)
+    before : PIL.Image or numpy.ndarray, optional
+        The earlier image, same size as after
+    threshold : float
+        Minimum drop in vegetation index counted as change at full resolution
+    min_region_pixels : int
+        Minimum region size in full-resolution pixels
+    pixel_size_m : float
+        Ground sampling distance of one full-resolution pixel in metres
+    scale : int
+        Downscaling factor
+    coarse_roi : numpy.ndarray, optional
+        Region-of-interest mask at 1/scale resolution
+    
+    Returns:
+    --------
+    tuple
+        (coarse_mask, coarse_after, areas) where coarse_mask is the boolean
+        change mask at 1/scale resolution, coarse_after the downscaled RGB
+        array, and areas the coarse regions in full-resolution pixel
+        coordinates
+    """
+    coarse_after = reduce_scene(after, scale)
+    if before is not None:
+        coarse_mask, confidence = detect_vegetation_loss(
+            reduce_scene(before, scale), coarse_after, threshold * COARSE_THRESHOLD_FACTOR
+        )
+    else:
+        coarse_mask, confidence = detect_bare_ground(coarse_after)
+    if coarse_roi is not None:
+        coarse_mask &= coarse_roi
+    
+    stats, _, _ = label_regions(coarse_mask, confidence)
+    areas = regions_to_areas(stats, max(min_region_pixels // (scale * scale), 1), pixel_size_m * scale)
+    
+    # Coarse pixel i covers full-resolution pixels scale*i .. scale*i + scale - 1
+    width, height = scene_size(after)
+    for area in areas:
+        area["x1"] *= scale
+        area["y1"] *= scale
+        area["x2"] = min(area["x2"] * scale, width)
+        area["y2"] = min(area["y2"] * scale, height)
+        area["pixel_count"] *= scale * scale
+        area["centroid_x"] = round(area["centroid_x"] * scale + (scale - 1) / 2, 2)
+        area["centroid_y"] = round(area["centroid_y"] * scale + (scale - 1) / 2, 2)
+    return coarse_mask, coarse_after, areas
+
+def candidate_tiles(coarse_mask, width, height, tile_size=REFINE_TILE_SIZE, overlap=32, scale=PREVIEW_SCALE):
+    """
+    Select the full-resolution tiles that may contain change.
+    
+    A tile is kept when any coarse change pixel lies within its read window
+    grown by one coarse pixel, so regions reaching into a tile from its
+    neighbours are refined too.
+    
+    Yields:
+    -------
+    dict
+        Tile descriptions from iter_tile_windows
+    """
+    # Growing the mask once is cheaper than growing every window
+    grown = dilate(coarse_mask, 1)
+    for tile in iter_tile_windows(width, height, tile_size, overlap):
+        x0, y0, x1, y1 = tile["window"]
+        if grown[y0 // scale:-(-y1 // scale), x0 // scale:-(-x1 // scale)].any():
+            yield tile
+
+def render_preview(coarse_after, areas, scale=PREVIEW_SCALE):
+    """
+    Draw coarse detections on the downscaled scene.
+    
+    Parameters:
+    -----------
+    coarse_after : numpy.ndarray
+        Downscaled RGB array from preview_analysis
+    areas : list
+        Areas in full-resolution pixel coordinates
+    scale : int
+        Downscaling factor of coarse_after
+    
+    Returns:
+    --------
+    PIL.Image
+        The preview image
+    """
+    coarse_areas = [{"x1": area["x1"] // scale, "y1": area["y1"] // scale,
+                     "x2": -(-area["x2"] // scale), "y2": -(-area["y2"] // scale)} for area in areas]
+    return render_detection_overlay(Image.fromarray(coarse_after), coarse_areas, outline_width=1)
+
+def analyze_scene_progressive(after, before=None, threshold=0.15, min_region_pixels=50, pixel_size_m=30.0,
+                              tile_size=REFINE_TILE_SIZE, overlap=32, smoothing_radius=0,
+                              scale=PREVIEW_SCALE, on_preview=None, roi_mask=None):
+    """
+    Detect deforestation coarse to fine.
+    
+    The scene is first analyzed at 1/scale resolution and the result handed
+    to on_preview. Full-resolution detection then runs only on the tiles
+    around coarse candidates; tiles of intact forest are never read at full
+    resolution. Regions inside refined tiles match the tiled analysis
+    exactly. Change in skipped tiles is assumed absent, so faint clearings
+    the coarse pass misses entirely can be lost.
+    
+    Parameters:
+    -----------
+    after : PIL.Image or numpy.ndarray
+        The later image (or the only image)
+    before : PIL.Image or numpy.ndarray, optional
+        The earlier image, same size as after
+    threshold : float
+        Minimum drop in vegetation index counted as change
+    min_region_pixels : int
+        Regions smaller than this are discarded as noise
+    pixel_size_m : float
+        Ground sampling distance of one pixel in metres
+    tile_size : int
+        Side length of the refinement tiles
+    overlap : int
+        Extra pixels read on each side of a tile
+    smoothing_radius : int
+        Radius of the change-mask smoothing; overlap is widened to cover it
+    scale : int
+        Downscaling factor of the preview pass
+    on_preview : callable, optional
+        Called as on_preview(preview_image, preview_areas) once the coarse
+        pass is done
+    roi_mask : numpy.ndarray, optional
+        Boolean (H, W) region of interest; change outside it is ignored
+    
+    Returns:
+    --------
+    list
+        List of deforested area dictionaries in scene coordinates
+    """
+    width, height = scene_size(after)
+    if before is not None and scene_size(before) != (width, height):
+        raise ValueError("Before and after images must have the same dimensions")
+    
+    coarse_mask, coarse_after, preview_areas = preview_analysis(
+        after, before, threshold, min_region_pixels, pixel_size_m, scale,
+        reduce_roi(roi_mask, scale) if roi_mask is not None else None
+    )
+    if on_preview is not None:
+        on_preview(render_preview(coarse_after, preview_areas, scale), preview_areas)
+    
+    overlap = max(overlap, 4 * smoothing_radius)
+    results = []
+    for tile in candidate_tiles(coarse_mask, width, height, tile_size, overlap, scale):
+        after_window = read_window(after, tile["window"])
+        before_window = read_window(before, tile["window"]) if before is not None else None
+        results.append((tile, analyze_tile(after_window, before_window, tile, threshold, smoothing_radius,
+                                           window_of(roi_mask, tile["window"]))))
+    
+    if not results:
+        return []
+    stats = merge_tile_results(results)
+    return regions_to_areas(stats, min_region_pixels, pixel_size_m)
@@ -0,0 +1,93 @@
+import weakref
+from PIL import Image
+
+# Widest rendered size of an image in the wide page layout, and of an image
+# inside a two-column layout
+FULL_WIDTH_PX = 1400
+COLUMN_WIDTH_PX = 700
+
+# Pyramids of images displayed in this process, keyed by id() with a weak
+# reference to the base image so entries vanish with the image
+_pyramids = {}
+
+class ImagePyramid:
+    """
+    Multi-resolution copies of an image at successive powers of two.
+    
+    Level 0 is the full-resolution image and level n is downscaled by 2**n.
+    Levels are built on first request from the previous level with
+    Image.reduce, so each one costs a quarter of the one above it.
+    """
+    
+    def __init__(self, image, reduced=None, min_size=64):
+        self.image = image
+        # Levels 1 and up; may be shared with the module-level pyramid cache
+        self.reduced = reduced if reduced is not None else []
+        self.min_size = min_size
+    
+    def level(self, index):
+        """Return level index, building any missing levels down to it."""
+        while len(self.reduced) < index:
+            previous = self.reduced[-1] if self.reduced else self.image
+            if min(previous.size) // 2 < self.min_size:
+                break
+            self.reduced.append(previous.reduce(2))
+        index = min(index, len(self.reduced))
+        return self.reduced[index - 1] if index > 0 else self.image
+    
+    def for_width(self, width):
+        """
+        Return the smallest level at least width pixels wide.
+        
+        Parameters:
+        -----------
+        width : int
+            Rendered width in pixels
+        
+        Returns:
+        --------
+        PIL.Image
+            The chosen pyramid level (level 0 if the image is narrower)
+        """
+        index = 0
+        current = self.image
+        while True:
+            candidate = self.level(index + 1)
+            if candidate is current or candidate.width < width:
+                return current
+            index += 1
+            current = candidate
+
+def get_image_pyramid(image):
+    """Return the ImagePyramid of an image, reusing levels built earlier."""
+    key = id(image)
+    entry = _pyramids.get(key)
+    if entry is None or entry[0]() is not image:
+        # Only the reduced levels are cached; a strong reference to the base
+        # image here would keep it alive forever
+        entry = (weakref.ref(image, lambda _: _pyramids.pop(key, None)), [])
+        _pyramids[key] = entry
+    return ImagePyramid(image, entry[1])
+
+def display_image(image, width=FULL_WIDTH_PX):
+    """
+    Pick the pyramid level of an image to send to the browser.
+    
+    Analysis always works on the full-resolution image; this only affects
+    what st.image encodes and ships.
+    
+    Parameters:
+    -----------
+    image : PIL.Image or None
+        The stored image
+    width : int
+        Width in pixels the image is rendered at
+    
+    Returns:
+    --------
+    PIL.Image or None
+        The smallest pyramid level covering width
+    """
+    if not isinstance(image, Image.Image):
+        return image
+    return get_image_pyramid(image).for_width(width)
@@ -0,0 +1,359 @@
+import io
+import os
+import json
+import mmap
+import zlib
+import struct
+import hashlib
+import tempfile
+import functools
+import numpy as np
+from PIL import Image
+
+# File layout:
+#   magic (4 bytes) | header length (uint32 LE) | JSON header |
+#   tile offsets (uint64 LE, one per tile plus an end offset) | tile data
+# Each tile is compressed on its own, so any tile can be decoded without
+# touching the rest of the file.
+MAGIC = b"FSRT"
+HEADER_FORMAT = "<4sI"
+
+# Directory for rasters produced by the app, shared by all sessions
+DEFAULT_RASTER_DIR = os.environ.get(
+    "FORESTSIGHT_RASTER_DIR", os.path.join(tempfile.gettempdir(), "forestsight-rasters")
+)
+
+# Disk used by stored rasters before the least recently used are removed
+DEFAULT_RASTER_BYTES = int(float(os.environ.get("FORESTSIGHT_RASTER_MB", 1024)) * 1024 * 1024)
+
+def write_raster(path, raster, tile_size=256, level=6, metadata=None):
+    """
+    Write a 2D raster as independently compressed tiles with an index.
+    
+    Boolean rasters (change masks) are bit-packed before compression.
+    
+    Parameters:
+    -----------
+    path : str
+        Destination file; written atomically
+    raster : numpy.ndarray
+        2D array, e.g. a boolean change mask or a uint8 loss-year raster
+    tile_size : int
+        Side length of each square tile
+    level : int
+        zlib compression level
+    metadata : dict, optional
+        JSON-serializable data stored in the header (years, pixel size, ...)
+    """
+    if raster.ndim != 2:
+        raise ValueError("Only 2D rasters can be stored")
+    write_raster_rows(path, raster.shape, raster.dtype, lambda top, bottom: raster[top:bottom],
+                      tile_size, level, metadata)
+
+def write_raster_rows(path, shape, dtype, read_rows, tile_size=256, level=6, metadata=None):
+    """
+    Write a raster produced a band of rows at a time, e.g. a change mask
+    computed from the scene, without holding the whole raster.
+    
+    Parameters:
+    -----------
+    path : str
+        Destination file; written atomically
+    shape : tuple
+        (height, width) of the raster
+    dtype : numpy.dtype
+        Type of the raster
+    read_rows : callable
+        read_rows(top, bottom) returns rows top to bottom (exclusive) as an
+        array of shape (bottom - top, width); it is called with bands of
+        tile_size rows, in order
+    tile_size, level, metadata
+        As for write_raster
+    """
+    height, width = shape
+    dtype = np.dtype(dtype)
+    tiles = []
+    for y0 in range(0, height, tile_size):
+        band = np.asarray(read_rows(y0, min(y0 + tile_size, height)), dtype=dtype)
+        for x0 in range(0, width, tile_size):
+            tile = np.ascontiguousarray(band[:, x0:x0 + tile_size])
+            data = np.packbits(tile).tobytes() if tile.dtype == bool else tile.tobytes()
+            tiles.append(zlib.compress(data, level))
+    
+    header = json.dumps({
+        "dtype": dtype.str,
+        "shape": [height, width],
+        "tile_size": tile_size,
+        "metadata": metadata or {},
+    }).encode()
+    index_start = struct.calcsize(HEADER_FORMAT) + len(header)
+    data_start = index_start + 8 * (len(tiles) + 1)
+    offsets = data_start + np.concatenate(([0], np.cumsum([len(tile) for tile in tiles])))
+    
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(struct.pack(HEADER_FORMAT, MAGIC, len(header)))
+            f.write(header)
+            f.write(offsets.astype("<u8").tobytes())
+            for tile in tiles:
+                f.write(tile)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class TiledRaster:
+    """
+    Read-only view of a tiled raster file through a memory map.
+    
+    Opening a file reads only the header and tile index; tiles are
+    decompressed on demand, so reading a viewport costs only the tiles it
+    overlaps.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        magic, header_length = struct.unpack_from(HEADER_FORMAT, self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a tiled raster file")
+        header_start = struct.calcsize(HEADER_FORMAT)
+        header = json.loads(self._map[header_start:header_start + header_length])
+        
+        self.dtype = np.dtype(header["dtype"])
+        self.shape = tuple(header["shape"])
+        self.tile_size = header["tile_size"]
+        self.metadata = header["metadata"]
+        # Memoized summaries; the file never changes once written
+        self._nonzero = None
+        self._overviews = {}
+        self.tile_rows = -(-self.shape[0] // self.tile_size)
+        self.tile_cols = -(-self.shape[1] // self.tile_size)
+        self._offsets = np.frombuffer(
+            self._map, dtype="<u8", count=self.tile_rows * self.tile_cols + 1,
+            offset=header_start + header_length
+        )
+    
+    def close(self):
+        """Release the memory map."""
+        # Drop the index view first; an exported buffer keeps the map open
+        self._offsets = None
+        self._map.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def read_tile(self, row, col):
+        """
+        Decompress one tile.
+        
+        Parameters:
+        -----------
+        row : int
+            Tile row
+        col : int
+            Tile column
+        
+        Returns:
+        --------
+        numpy.ndarray
+            The tile; edge tiles are smaller than tile_size
+        """
+        index = row * self.tile_cols + col
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        data = zlib.decompress(self._map[start:end])
+        
+        tile_height = min(self.tile_size, self.shape[0] - row * self.tile_size)
+        tile_width = min(self.tile_size, self.shape[1] - col * self.tile_size)
+        if self.dtype == bool:
+            bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=tile_height * tile_width)
+            return bits.astype(bool).reshape(tile_height, tile_width)
+        return np.frombuffer(data, dtype=self.dtype).reshape(tile_height, tile_width)
+    
+    def iter_tiles(self):
+        """Yield (row, col, tile) for every tile in raster order."""
+        for row in range(self.tile_rows):
+            for col in range(self.tile_cols):
+                yield row, col, self.read_tile(row, col)
+    
+    def read_window(self, x0, y0, x1, y1):
+        """
+        Read a rectangular window, decoding only the tiles it overlaps.
+        
+        Parameters:
+        -----------
+        x0, y0, x1, y1 : int
+            Window bounds in pixels, x1/y1 exclusive
+        
+        Returns:
+        --------
+        numpy.ndarray
+            Array of shape (y1 - y0, x1 - x0)
+        """
+        x0, x1 = max(x0, 0), min(x1, self.shape[1])
+        y0, y1 = max(y0, 0), min(y1, self.shape[0])
+        window = np.empty((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=self.dtype)
+        
+        size = self.tile_size
+        for row in range(y0 // size, -(-y1 // size)):
+            for col in range(x0 // size, -(-x1 // size)):
+                tile = self.read_tile(row, col)
+                ty0, tx0 = row * size, col * size
+                # Overlap of the tile and the window in raster coordinates
+                oy0, oy1 = max(y0, ty0), min(y1, ty0 + tile.shape[0])
+                ox0, ox1 = max(x0, tx0), min(x1, tx0 + tile.shape[1])
+                window[oy0 - y0:oy1 - y0, ox0 - x0:ox1 - x0] = tile[oy0 - ty0:oy1 - ty0, ox0 - tx0:ox1 - tx0]
+        return window
+    
+    def read(self):
+        """Read the whole raster."""
+        return self.read_window(0, 0, self.shape[1], self.shape[0])
+
+    def count_nonzero(self):
+        """Number of nonzero pixels (changed pixels of a mask), counted tile by tile."""
+        if self._nonzero is None:
+            self._nonzero = sum(int(np.count_nonzero(tile)) for _, _, tile in self.iter_tiles())
+        return self._nonzero
+    
+    def overview(self, max_size=1024):
+        """
+        Fraction of nonzero pixels in blocks, for display at reduced size.
+        
+        The raster is read a band of rows at a time.
+        
+        Parameters:
+        -----------
+        max_size : int
+            Largest side of the overview
+        
+        Returns:
+        --------
+        numpy.ndarray
+            float32 array of shape (ceil(height / factor), ceil(width / factor)),
+            factor being the smallest integer that fits max_size
+        """
+        if max_size in self._overviews:
+            return self._overviews[max_size]
+        height, width = self.shape
+        factor = max(-(-max(height, width) // max_size), 1)
+        out_height, out_width = -(-height // factor), -(-width // factor)
+        counts = np.zeros((out_height, out_width), dtype=np.float32)
+        band_rows = factor * max(self.tile_size // factor, 1)
+        for top in range(0, height, band_rows):
+            band = self.read_window(0, top, width, min(top + band_rows, height)) != 0
+            rows = -(-band.shape[0] // factor)
+            padded = np.zeros((rows * factor, out_width * factor), dtype=bool)
+            padded[:band.shape[0], :width] = band
+            counts[top // factor:top // factor + rows] = padded.reshape(rows, factor, out_width, factor).sum(axis=(1, 3))
+        # Edge blocks are divided by their full size, as if padded with zeros
+        self._overviews[max_size] = counts / (factor * factor)
+        return self._overviews[max_size]
+    
+    def to_image(self):
+        """
+        Assemble the raster into a PIL image tile by tile.
+        
+        Boolean rasters give a 1-bit image, so a change mask takes an eighth
+        of the memory of the array; uint8 rasters give a grayscale image.
+        """
+        if self.dtype not in (np.dtype(bool), np.dtype(np.uint8)):
+            raise ValueError(f"Cannot convert a {self.dtype} raster to an image")
+        image = Image.new('1' if self.dtype == bool else 'L', (self.shape[1], self.shape[0]))
+        for row, col, tile in self.iter_tiles():
+            image.paste(Image.fromarray(tile), (col * self.tile_size, row * self.tile_size))
+        return image
+
+def open_raster(path):
+    """Open a tiled raster file for reading."""
+    return TiledRaster(path)
+
+def prune_rasters(directory=DEFAULT_RASTER_DIR, max_bytes=DEFAULT_RASTER_BYTES, keep=None):
+    """
+    Remove the least recently used raster files beyond max_bytes, except keep.
+    
+    Rasters already open stay readable: their memory maps outlive the file
+    on POSIX systems, and files that cannot be removed while open (Windows)
+    are skipped.
+    """
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(".fsrt"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            continue
+        total -= size
+
+@functools.lru_cache(maxsize=2)
+def raster_png(raster):
+    """
+    Encode an open TiledRaster as PNG bytes for export, remembering the
+    last few. The open raster stays readable even if its file was removed.
+    """
+    buffer = io.BytesIO()
+    raster.to_image().save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+def store_raster(raster, metadata=None, directory=DEFAULT_RASTER_DIR, tile_size=256,
+                 max_bytes=DEFAULT_RASTER_BYTES):
+    """
+    Save a raster under a content-derived name and open it for reading.
+    
+    Identical rasters map to the same file, which is only written once.
+    Storing a raster marks its file as recently used, and the least
+    recently used files are removed once the directory exceeds max_bytes.
+    
+    Parameters:
+    -----------
+    raster : numpy.ndarray
+        2D raster to store
+    metadata : dict, optional
+        JSON-serializable data stored in the header
+    directory : str
+        Directory holding the raster files
+    tile_size : int
+        Side length of each square tile
+    max_bytes : int
+        Disk budget of the directory
+    
+    Returns:
+    --------
+    TiledRaster
+        The stored raster, memory-mapped
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{raster.dtype.str}:{raster.shape}:{json.dumps(metadata, sort_keys=True)}".encode())
+    digest.update(np.ascontiguousarray(raster).data)
+    
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, digest.hexdigest() + ".fsrt")
+    if os.path.exists(path):
+        os.utime(path)
+    else:
+        write_raster(path, raster, tile_size, metadata=metadata)
+    stored = open_raster(path)
+    prune_rasters(directory, max_bytes, keep=path)
+    return stored
@@ -0,0 +1,281 @@
+import math
+import numpy as np
+from PIL import Image
+
+# Side length of the downsampled grayscale images used for the coarse
+# estimate, and of the full-resolution patch used to refine it
+COARSE_SIZE_PX = 512
+REFINE_SIZE_PX = 512
+
+# Rows of a scene warped or reduced at a time by AlignedImage
+BAND_ROWS = 512
+
+# Phase-correlation peaks below this height are treated as "no reliable
+# match" (e.g. featureless scenes) and leave the image unshifted
+MIN_PEAK = 0.03
+
+def _hann_window(height, width):
+    """Return a 2D Hann window that suppresses the wrap-around edges of a patch."""
+    return np.outer(np.hanning(height), np.hanning(width)).astype(np.float32)
+
+def phase_correlation(reference, moving):
+    """
+    Estimate the translation between two equally sized grayscale arrays.
+    
+    The normalized cross-power spectrum of the two arrays has an inverse FFT
+    that peaks at their relative shift. The peak is located to sub-pixel
+    precision with a parabola fitted through its neighbours.
+    
+    Parameters:
+    -----------
+    reference : numpy.ndarray
+        2D array
+    moving : numpy.ndarray
+        2D array of the same shape, approximately reference shifted
+    
+    Returns:
+    --------
+    tuple
+        (dy, dx, peak) such that moving[y, x] ~ reference[y - dy, x - dx];
+        peak is the correlation height in [0, 1]
+    """
+    height, width = reference.shape
+    window = _hann_window(height, width)
+    reference = (reference - reference.mean()) * window
+    moving = (moving - moving.mean()) * window
+    
+    cross_power = np.fft.rfft2(moving) * np.conj(np.fft.rfft2(reference))
+    cross_power /= np.maximum(np.abs(cross_power), 1e-12)
+    surface = np.fft.irfft2(cross_power, s=(height, width))
+    
+    peak_y, peak_x = np.unravel_index(np.argmax(surface), surface.shape)
+    peak = float(surface[peak_y, peak_x])
+    
+    def subpixel(before, at, after):
+        denominator = before - 2 * at + after
+        return 0.5 * (before - after) / denominator if denominator < 0 else 0.0
+    
+    dy = peak_y + subpixel(surface[peak_y - 1, peak_x], peak, surface[(peak_y + 1) % height, peak_x])
+    dx = peak_x + subpixel(surface[peak_y, peak_x - 1], peak, surface[peak_y, (peak_x + 1) % width])
+    # Peaks past the middle are negative shifts wrapped around by the FFT
+    if dy > height / 2:
+        dy -= height
+    if dx > width / 2:
+        dx -= width
+    return dy, dx, peak
+
+def _reduce(image, factor):
+    """Box-downscale an image by an integer factor, in a mode Image.reduce supports."""
+    if image.mode not in ('L', 'RGB', 'RGBA', 'LA'):
+        image = image.convert('RGB')
+    return image.reduce(factor) if factor > 1 else image
+
+def _gray_array(image):
+    """Return a (small) image as a float32 grayscale array."""
+    return np.asarray(image.convert('L'), dtype=np.float32)
+
+def estimate_translation(reference, moving, coarse_size=COARSE_SIZE_PX, refine_size=REFINE_SIZE_PX):
+    """
+    Estimate the translation of moving relative to reference.
+    
+    A coarse shift is found on grayscale copies reduced to about
+    coarse_size pixels, then refined on a full-resolution patch from the
+    centre of the scene, so the cost barely grows with image size. Only
+    the reduced images and the patches are converted to grayscale.
+    
+    Parameters:
+    -----------
+    reference : PIL.Image
+        Reference image (the later image of a pair)
+    moving : PIL.Image
+        Image to align, the same size as reference
+    coarse_size : int
+        Approximate side length of the downsampled images
+    refine_size : int
+        Side length of the full-resolution refinement patch
+    
+    Returns:
+    --------
+    tuple
+        (dy, dx, peak) in full-resolution pixels, with moving[y, x] ~
+        reference[y - dy, x - dx]; (0.0, 0.0, peak) when no reliable
+        match is found
+    """
+    width, height = reference.size
+    factor = max(1, max(width, height) // coarse_size)
+    coarse_reference = _gray_array(_reduce(reference, factor))
+    coarse_moving = _gray_array(_reduce(moving, factor))
+    dy, dx, peak = phase_correlation(coarse_reference, coarse_moving)
+    if peak < MIN_PEAK:
+        return 0.0, 0.0, peak
+    dy, dx = round(dy * factor), round(dx * factor)
+    
+    # Refine on a central patch, taking the moving patch at the coarse offset
+    size_y = min(refine_size, height - abs(dy))
+    size_x = min(refine_size, width - abs(dx))
+    if size_y < 32 or size_x < 32:
+        return 0.0, 0.0, 0.0
+    top = min(max((height - size_y) // 2, -dy, 0), height - size_y, height - size_y - dy)
+    left = min(max((width - size_x) // 2, -dx, 0), width - size_x, width - size_x - dx)
+    
+    patch_reference = _gray_array(reference.crop((left, top, left + size_x, top + size_y)))
+    patch_moving = _gray_array(moving.crop((left + dx, top + dy, left + dx + size_x, top + dy + size_y)))
+    fine_dy, fine_dx, fine_peak = phase_correlation(patch_reference, patch_moving)
+    if fine_peak < MIN_PEAK or max(abs(fine_dy), abs(fine_dx)) > factor:
+        # The refinement should only move within one coarse pixel
+        return float(dy), float(dx), peak
+    dy, dx = dy + fine_dy, dx + fine_dx
+    # Snap to whole pixels within the precision of the estimate, which keeps
+    # the warp an exact (and much cheaper) pixel copy
+    if abs(dy - round(dy)) < 0.05 and abs(dx - round(dx)) < 0.05:
+        dy, dx = round(dy), round(dx)
+    return float(dy), float(dx), fine_peak
+
+class AlignedImage:
+    """
+    An image shifted to line up with a reference, warped on demand.
+    
+    Behaves like the PIL image apply_translation returns for the parts the
+    tiled analysis uses (size, mode, crop, reduce, convert), but only warps
+    the windows that are read, so aligning a scene costs no full-size copy.
+    Pixels with no counterpart in moving (the strips uncovered by the
+    shift) are taken from reference, so they show no change and are not
+    analyzed as spurious change regions.
+    """
+    
+    def __init__(self, moving, reference, dy, dx):
+        """
+        Parameters:
+        -----------
+        moving : PIL.Image
+            Image to align
+        reference : PIL.Image
+            Image it is aligned to, the same size
+        dy, dx : float
+            Translation from estimate_translation
+        """
+        self.moving = moving
+        self.reference = reference
+        self.dy, self.dx = float(dy), float(dx)
+        # With integer shifts nearest-neighbour sampling copies pixels exactly
+        self.resample = Image.NEAREST if self.dy.is_integer() and self.dx.is_integer() else Image.BILINEAR
+        
+        # Output pixels sampled from inside moving; the partly covered row
+        # or column next to an edge under bilinear sampling is outside
+        width, height = moving.size
+        self.covered = (max(math.ceil(-self.dx), 0), max(math.ceil(-self.dy), 0),
+                        min(math.floor(width - self.dx), width), min(math.floor(height - self.dy), height))
+    
+    @property
+    def size(self):
+        return self.moving.size
+    
+    @property
+    def width(self):
+        return self.moving.width
+    
+    @property
+    def height(self):
+        return self.moving.height
+    
+    @property
+    def mode(self):
+        return self.moving.mode
+    
+    def crop(self, box):
+        """Return a window (x0, y0, x1, y1) of the aligned image as a PIL image."""
+        x0, y0, x1, y1 = box
+        window = self.moving.transform(
+            (x1 - x0, y1 - y0), Image.AFFINE, (1, 0, x0 + self.dx, 0, 1, y0 + self.dy), resample=self.resample
+        )
+        
+        left, top, right, bottom = self.covered
+        strips = ((x0, y0, x1, min(top, y1)), (x0, max(bottom, y0), x1, y1),
+                  (x0, max(top, y0), min(left, x1), min(bottom, y1)),
+                  (max(right, x0), max(top, y0), x1, min(bottom, y1)))
+        for strip in strips:
+            if strip[2] > strip[0] and strip[3] > strip[1]:
+                window.paste(self.reference.crop(strip), (strip[0] - x0, strip[1] - y0))
+        return window
+    
+    def _bands(self, rows):
+        width, height = self.size
+        for y0 in range(0, height, rows):
+            yield y0, self.crop((0, y0, width, min(y0 + rows, height)))
+    
+    def reduce(self, factor):
+        """Box-downscale by an integer factor, warping a band of rows at a time."""
+        width, height = self.size
+        rows = max(BAND_ROWS // factor, 1) * factor
+        reduced = Image.new(self.mode, (math.ceil(width / factor), math.ceil(height / factor)))
+        for y0, band in self._bands(rows):
+            reduced.paste(band.reduce(factor), (0, y0 // factor))
+        return reduced
+    
+    def convert(self, mode):
+        if mode == self.mode:
+            return self
+        return AlignedImage(self.moving.convert(mode), self.reference.convert(mode), self.dy, self.dx)
+    
+    def to_image(self):
+        """Warp the whole image into a new PIL image."""
+        image = Image.new(self.mode, self.size)
+        for y0, band in self._bands(BAND_ROWS):
+            image.paste(band, (0, y0))
+        return image
+
+def apply_translation(moving, reference, dy, dx):
+    """
+    Shift moving by (-dy, -dx) so it lines up with reference.
+    
+    Pixels with no counterpart in moving are copied from reference, as in
+    AlignedImage.
+    
+    Parameters:
+    -----------
+    moving : PIL.Image
+        Image to align
+    reference : PIL.Image
+        Image it is aligned to, the same size and mode
+    dy, dx : float
+        Translation from estimate_translation
+    
+    Returns:
+    --------
+    PIL.Image
+        The aligned image
+    """
+    return AlignedImage(moving, reference, dy, dx).to_image()
+
+def coregister(before_image, after_image, max_shift_fraction=0.1, lazy=False):
+    """
+    Align before_image to after_image by translation.
+    
+    Parameters:
+    -----------
+    before_image : PIL.Image
+        Earlier image, the same size as after_image
+    after_image : PIL.Image
+        Later image, used as the reference
+    max_shift_fraction : float
+        Shifts larger than this fraction of the image size are rejected as
+        misregistrations and leave before_image unchanged
+    lazy : bool
+        Return an AlignedImage that warps windows as they are read instead
+        of a warped copy of the scene
+    
+    Returns:
+    --------
+    tuple
+        (aligned_before_image, (dy, dx)); before_image itself when it is
+        not shifted
+    """
+    dy, dx, _ = estimate_translation(after_image, before_image)
+    
+    width, height = after_image.size
+    if abs(dy) > max_shift_fraction * height or abs(dx) > max_shift_fraction * width:
+        return before_image, (0.0, 0.0)
+    if abs(dy) < 0.1 and abs(dx) < 0.1:
+        return before_image, (0.0, 0.0)
+    aligned = AlignedImage(before_image, after_image, dy, dx)
+    return (aligned if lazy else aligned.to_image()), (dy, dx)
@@ -0,0 +1,104 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+def drawings_to_polygons(drawings, geotransform):
+    """
+    Convert shapes drawn on a map into pixel polygons of the analyzed image.
+    
+    Parameters:
+    -----------
+    drawings : list
+        GeoJSON features as returned by the folium Draw plugin; polygons and
+        rectangles are used, other shapes are ignored
+    geotransform : GeoTransform
+        Georeference of the analyzed image
+    
+    Returns:
+    --------
+    list
+        Polygons as lists of [x, y] pixel coordinates (outer rings only)
+    """
+    rings = []
+    for feature in drawings or []:
+        geometry = (feature or {}).get("geometry") or {}
+        if geometry.get("type") == "Polygon":
+            rings.append(geometry["coordinates"][0])
+        elif geometry.get("type") == "MultiPolygon":
+            rings.extend(polygon[0] for polygon in geometry["coordinates"])
+    
+    polygons = []
+    for ring in rings:
+        lonlat = np.asarray(ring, dtype=np.float64)
+        if len(lonlat) < 3:
+            continue
+        xs, ys = geotransform.lonlat_to_pixel(lonlat[:, 0], lonlat[:, 1])
+        polygons.append(np.round(np.column_stack([xs, ys]), 2).tolist())
+    return polygons
+
+def roi_window(polygons, image_size):
+    """
+    Bounding window of a region of interest, clipped to the image.
+    
+    Returns:
+    --------
+    tuple or None
+        (x0, y0, x1, y1) in pixels with exclusive x1/y1, or None when the
+        polygons do not overlap the image
+    """
+    if not polygons:
+        return None
+    points = np.concatenate([np.asarray(polygon, dtype=np.float64).reshape(-1, 2) for polygon in polygons])
+    width, height = image_size
+    x0, y0 = np.maximum(np.floor(points.min(axis=0)), 0).astype(int)
+    x1 = int(min(np.ceil(points[:, 0].max()), width))
+    y1 = int(min(np.ceil(points[:, 1].max()), height))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return int(x0), int(y0), x1, y1
+
+def rasterize_roi(polygons, window):
+    """
+    Rasterize region-of-interest polygons inside a window.
+    
+    Parameters:
+    -----------
+    polygons : list
+        Polygons as lists of [x, y] pixel coordinates of the full image
+    window : tuple
+        (x0, y0, x1, y1) window from roi_window
+    
+    Returns:
+    --------
+    numpy.ndarray
+        Boolean mask of the window, True inside any polygon
+    """
+    x0, y0, x1, y1 = window
+    canvas = Image.new("1", (x1 - x0, y1 - y0), 0)
+    draw = ImageDraw.Draw(canvas)
+    # Polygon vertices are on pixel corners; PIL places them on pixel centres
+    for polygon in polygons:
+        draw.polygon([(x - x0 - 0.5, y - y0 - 0.5) for x, y in polygon], fill=1)
+    return np.array(canvas, dtype=bool)
+
+def shift_areas(deforested_areas, dx, dy):
+    """
+    Move detected areas from window to full-image pixel coordinates, in place.
+    """
+    if dx == 0 and dy == 0:
+        return deforested_areas
+    for area in deforested_areas:
+        area["x1"] += dx
+        area["x2"] += dx
+        area["y1"] += dy
+        area["y2"] += dy
+        if "centroid_x" in area:
+            area["centroid_x"] = round(area["centroid_x"] + dx, 2)
+            area["centroid_y"] = round(area["centroid_y"] + dy, 2)
+        if "polygon" in area:
+            area["polygon"] = [np.round(np.asarray(ring) + (dx, dy), 2).tolist() for ring in area["polygon"]]
+    return deforested_areas
+
+def reduce_roi(roi_mask, scale):
+    """Downscale an ROI mask, keeping every block that touches the ROI."""
+    coarse = Image.fromarray(roi_mask.astype(np.uint8) * 255).reduce(scale)
+    return np.asarray(coarse) > 0
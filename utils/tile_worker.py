@@ -0,0 +1,61 @@
+"""
+Worker process of the parallel tile analysis in utils.parallel.
+
+Started as ``python -m utils.tile_worker``, so it imports only this module
+and its dependencies, never the parent's __main__ (the page script under
+Streamlit). Tasks arrive pickled on stdin and results are pickled back on
+stdout.
+"""
+import sys
+import pickle
+import numpy as np
+
+from utils.tiling import read_window, analyze_tile
+
+def analyze_stored_tile(scenes, tile, threshold, smoothing_radius):
+    """
+    Analyze one tile of scenes stored as .npy files by utils.parallel.
+    
+    Parameters:
+    -----------
+    scenes : dict
+        Paths of the "after" and "before" (or None) scenes
+    tile : dict
+        Tile description from iter_tile_windows
+    threshold : float
+        Minimum drop in vegetation index counted as change
+    smoothing_radius : int
+        Radius of the change-mask smoothing
+    
+    Returns:
+    --------
+    dict
+        Per-tile region statistics from analyze_tile
+    """
+    after = np.load(scenes["after"], mmap_mode="r")
+    before = np.load(scenes["before"], mmap_mode="r") if scenes["before"] is not None else None
+    # Copied out, so no mapping of the scenes outlives the task
+    after_window = np.array(read_window(after, tile["window"]))
+    before_window = np.array(read_window(before, tile["window"])) if before is not None else None
+    del after, before
+    return analyze_tile(after_window, before_window, tile, threshold, smoothing_radius)
+
+def serve(tasks, results):
+    """Answer (ok, result or exception) to each task until tasks is closed."""
+    while True:
+        try:
+            task = pickle.load(tasks)
+        except EOFError:
+            return
+        try:
+            reply = (True, analyze_stored_tile(*task))
+        except Exception as error:
+            reply = (False, error)
+        pickle.dump(reply, results, protocol=pickle.HIGHEST_PROTOCOL)
+        results.flush()
+
+if __name__ == "__main__":
+    tasks, results = sys.stdin.buffer, sys.stdout.buffer
+    # Anything printed goes to stderr, so stdout carries only results
+    sys.stdout = sys.stderr
+    serve(tasks, results)
@@ -0,0 +1,600 @@
+import os
+import numpy as np
+from PIL import Image
+
+from utils.image_processing import (
+    detect_vegetation_loss,
+    detect_bare_ground,
+    regions_to_areas,
+    render_detection_overlay,
+    process_satellite_image,
+    match_histograms,
+)
+from utils.labeling import resolve_label_equivalences, label_regions, edge_labels
+from utils.morphology import smooth_mask
+from utils.registration import coregister, AlignedImage
+from utils.roi import roi_window, rasterize_roi, shift_areas
+from utils.vectorize import attach_polygons, outline_areas
+from utils.raster_store import write_raster_rows
+
+# Rough peak working memory of the analysis per pixel of a tile (input
+# windows, index temporaries, mask, confidence, labels and label bookkeeping)
+ANALYSIS_BYTES_PER_PIXEL = 120
+
+# Memory ceiling for the analysis working set; scenes that would exceed it
+# are analyzed tile by tile
+DEFAULT_MEMORY_LIMIT_MB = float(os.environ.get("FORESTSIGHT_MEMORY_LIMIT_MB", 512))
+
+STAT_KEYS = ("x1", "y1", "x2", "y2", "pixel_count", "confidence_sum", "x_sum", "y_sum")
+
+def tile_size_for_memory(memory_limit_mb, overlap=32):
+    """
+    Compute the largest square tile whose analysis fits in a memory ceiling.
+    
+    Parameters:
+    -----------
+    memory_limit_mb : float
+        Memory ceiling for the per-tile working set in megabytes
+    overlap : int
+        Overlap in pixels added on each side of the tile
+    
+    Returns:
+    --------
+    int
+        Tile side length in pixels, excluding overlap
+    """
+    max_pixels = memory_limit_mb * 1024 * 1024 / ANALYSIS_BYTES_PER_PIXEL
+    tile_size = int(np.sqrt(max_pixels)) - 2 * overlap
+    if tile_size < 64:
+        raise ValueError(
+            f"A memory limit of {memory_limit_mb} MB is too small for tiles with {overlap} px overlap"
+        )
+    return tile_size
+
+def iter_tile_windows(width, height, tile_size=2048, overlap=32):
+    """
+    Split a scene into fixed-size tiles with overlapping read windows.
+    
+    Parameters:
+    -----------
+    width : int
+        Scene width in pixels
+    height : int
+        Scene height in pixels
+    tile_size : int
+        Side length of the non-overlapping tile core
+    overlap : int
+        Extra pixels read on each side of the core for neighbourhood context
+    
+    Yields:
+    -------
+    dict
+        Tile description with 'row', 'col', 'core' and 'window' boxes, each box
+        being (x0, y0, x1, y1) in scene pixels with exclusive x1/y1
+    """
+    for row, y0 in enumerate(range(0, height, tile_size)):
+        for col, x0 in enumerate(range(0, width, tile_size)):
+            x1 = min(x0 + tile_size, width)
+            y1 = min(y0 + tile_size, height)
+            yield {
+                "row": row,
+                "col": col,
+                "core": (x0, y0, x1, y1),
+                "window": (max(x0 - overlap, 0), max(y0 - overlap, 0),
+                           min(x1 + overlap, width), min(y1 + overlap, height)),
+            }
+
+def scene_size(source):
+    """Return (width, height) of a PIL image, an AlignedImage or an (H, W, C) array."""
+    if isinstance(source, np.ndarray):
+        return source.shape[1], source.shape[0]
+    return source.size
+
+def read_window(source, box):
+    """
+    Read a window of a scene as a uint8 RGB array.
+    
+    Arrays (including numpy.memmap scenes) are sliced, so only the window is
+    paged in. PIL images are cropped, and AlignedImage scenes warp only the
+    window.
+    
+    Parameters:
+    -----------
+    source : PIL.Image, AlignedImage or numpy.ndarray
+        The scene
+    box : tuple
+        (x0, y0, x1, y1) window in scene pixels
+    
+    Returns:
+    --------
+    numpy.ndarray
+        uint8 array of shape (y1 - y0, x1 - x0, 3)
+    """
+    x0, y0, x1, y1 = box
+    if isinstance(source, np.ndarray):
+        return np.ascontiguousarray(source[y0:y1, x0:x1, :3])
+    return np.asarray(source.crop(box).convert('RGB'))
+
+def window_of(mask, box):
+    """Slice a scene-aligned 2D mask to a box, passing None through."""
+    if mask is None:
+        return None
+    x0, y0, x1, y1 = box
+    return mask[y0:y1, x0:x1]
+
+def analyze_tile(after_window, before_window, tile, threshold=0.15, smoothing_radius=0, roi_window=None):
+    """
+    Detect and measure change regions inside one tile.
+    
+    Detection runs on the overlapping window; labeling and measurement are
+    restricted to the tile core so every pixel is counted exactly once.
+    
+    Parameters:
+    -----------
+    after_window : numpy.ndarray
+        RGB window of the later image
+    before_window : numpy.ndarray or None
+        RGB window of the earlier image, or None for single-image analysis
+    tile : dict
+        Tile description from iter_tile_windows
+    threshold : float
+        Minimum drop in vegetation index counted as change
+    smoothing_radius : int
+        Radius of the change-mask smoothing; the tile overlap must be at
+        least 4 * smoothing_radius for the core to be exact
+    roi_window : numpy.ndarray, optional
+        Region-of-interest mask of the read window; change outside it is
+        ignored
+    
+    Returns:
+    --------
+    dict
+        Region statistics in scene coordinates plus the label strips along the
+        core's four edges ('top', 'bottom', 'left', 'right')
+    """
+    if before_window is not None:
+        mask, confidence = detect_vegetation_loss(before_window, after_window, threshold)
+    else:
+        mask, confidence = detect_bare_ground(after_window)
+    mask = smooth_mask(mask, smoothing_radius)
+    if roi_window is not None:
+        mask &= roi_window
+    
+    # Crop the analysis back to the tile core
+    cx0, cy0, cx1, cy1 = tile["core"]
+    wx0, wy0 = tile["window"][:2]
+    core = (slice(cy0 - wy0, cy1 - wy0), slice(cx0 - wx0, cx1 - wx0))
+    core_mask = mask[core]
+    stats, runs, run_labels = label_regions(core_mask, confidence[core])
+    num_labels = len(stats["pixel_count"])
+    
+    stats["x1"] = stats["x1"] + cx0
+    stats["x2"] = stats["x2"] + cx0
+    stats["y1"] = stats["y1"] + cy0
+    stats["y2"] = stats["y2"] + cy0
+    stats["x_sum"] = stats["x_sum"] + cx0 * stats["pixel_count"]
+    stats["y_sum"] = stats["y_sum"] + cy0 * stats["pixel_count"]
+    stats["num_labels"] = num_labels
+    stats.update(edge_labels(core_mask.shape, runs, run_labels))
+    return stats
+
+def merge_tile_results(results):
+    """
+    Stitch per-tile regions into scene-wide regions.
+    
+    Regions touching across a tile seam are joined with union-find, then their
+    bounding boxes, pixel counts and confidence sums are combined. Only the
+    per-region statistics and the one-pixel seam strips are needed, so memory
+    stays proportional to the number of regions rather than the scene size.
+    
+    Parameters:
+    -----------
+    results : list
+        (tile, stats) pairs in raster tile order, stats from analyze_tile
+    
+    Returns:
+    --------
+    dict
+        Region statistics in the format returned by
+        utils.labeling.region_properties
+    """
+    offsets = {}
+    next_offset = 0
+    for tile, stats in results:
+        offsets[(tile["row"], tile["col"])] = next_offset
+        next_offset += stats["num_labels"]
+    
+    by_position = {(tile["row"], tile["col"]): stats for tile, stats in results}
+    first, second = [], []
+    for (row, col), stats in by_position.items():
+        # Seams with the tile below and the tile to the right
+        for neighbour, own_edge, their_edge in (((row + 1, col), "bottom", "top"),
+                                                ((row, col + 1), "right", "left")):
+            if neighbour not in by_position:
+                continue
+            own = stats[own_edge]
+            theirs = by_position[neighbour][their_edge]
+            touching = (own > 0) & (theirs > 0)
+            first.append(own[touching] - 1 + offsets[(row, col)])
+            second.append(theirs[touching] - 1 + offsets[neighbour])
+    
+    merged = {key: np.concatenate([stats[key] for _, stats in results]) for key in STAT_KEYS}
+    if next_offset == 0:
+        return merged
+    
+    roots = resolve_label_equivalences(
+        next_offset,
+        np.concatenate(first) if first else np.zeros(0, dtype=np.int64),
+        np.concatenate(second) if second else np.zeros(0, dtype=np.int64)
+    )
+    _, region = np.unique(roots, return_inverse=True)
+    num_regions = int(region.max()) + 1
+    
+    combined = {
+        "pixel_count": np.bincount(region, weights=merged["pixel_count"], minlength=num_regions).astype(np.int64),
+        "confidence_sum": np.bincount(region, weights=merged["confidence_sum"], minlength=num_regions),
+        "x_sum": np.bincount(region, weights=merged["x_sum"], minlength=num_regions),
+        "y_sum": np.bincount(region, weights=merged["y_sum"], minlength=num_regions),
+    }
+    for key, reduce, initial in (("x1", np.minimum, np.iinfo(np.int64).max),
+                                 ("y1", np.minimum, np.iinfo(np.int64).max),
+                                 ("x2", np.maximum, 0),
+                                 ("y2", np.maximum, 0)):
+        values = np.full(num_regions, initial, dtype=np.int64)
+        reduce.at(values, region, merged[key])
+        combined[key] = values
+    return combined
+
+def analyze_scene_tiled(after, before=None, threshold=0.15, min_region_pixels=50, pixel_size_m=30.0,
+                        tile_size=2048, overlap=32, memory_limit_mb=None, smoothing_radius=0, roi_mask=None):
+    """
+    Detect deforestation in a large scene one tile at a time.
+    
+    Each tile is read with overlap, analyzed and reduced to region statistics
+    before the next tile is read, so the analysis working set is bounded by
+    the tile size. Array and numpy.memmap sources are only paged in window by
+    window; PIL sources are cropped from the decoded image.
+    
+    Parameters:
+    -----------
+    after : PIL.Image or numpy.ndarray
+        The later image (or the only image)
+    before : PIL.Image or numpy.ndarray, optional
+        The earlier image, same size as after
+    threshold : float
+        Minimum drop in vegetation index counted as change
+    min_region_pixels : int
+        Regions smaller than this are discarded as noise
+    pixel_size_m : float
+        Ground sampling distance of one pixel in metres
+    tile_size : int
+        Side length of each tile core in pixels
+    overlap : int
+        Extra pixels read on each side of a tile
+    memory_limit_mb : float, optional
+        Memory ceiling for the per-tile working set; shrinks tile_size to fit
+    smoothing_radius : int
+        Radius of the change-mask smoothing; overlap is widened to cover it
+    roi_mask : numpy.ndarray, optional
+        Boolean (H, W) region of interest; change outside it is ignored
+    
+    Returns:
+    --------
+    list
+        List of deforested area dictionaries in scene coordinates
+    """
+    width, height = scene_size(after)
+    if before is not None and scene_size(before) != (width, height):
+        raise ValueError("Before and after images must have the same dimensions")
+    
+    # Smoothing reaches 4 * radius pixels, so tiles need that much context
+    overlap = max(overlap, 4 * smoothing_radius)
+    if memory_limit_mb is not None:
+        tile_size = min(tile_size, tile_size_for_memory(memory_limit_mb, overlap))
+    
+    results = []
+    for tile in iter_tile_windows(width, height, tile_size, overlap):
+        after_window = read_window(after, tile["window"])
+        before_window = read_window(before, tile["window"]) if before is not None else None
+        results.append((tile, analyze_tile(after_window, before_window, tile, threshold, smoothing_radius,
+                                           window_of(roi_mask, tile["window"]))))
+    
+    stats = merge_tile_results(results)
+    return regions_to_areas(stats, min_region_pixels, pixel_size_m)
+
+def read_change_mask(after, before, box, threshold=0.15, smoothing_radius=0, roi_mask=None):
+    """
+    Recompute the change mask inside a pixel box of a scene.
+    
+    Detection is per pixel, and smoothing only reaches 4 * smoothing_radius
+    pixels, so reading that much context around the box reproduces the mask
+    of the whole-scene analysis exactly.
+    
+    Parameters:
+    -----------
+    after : PIL.Image or numpy.ndarray
+        The later image (or the only image)
+    before : PIL.Image or numpy.ndarray, optional
+        The earlier image, same size as after
+    box : tuple
+        (x1, y1, x2, y2) pixel box, x2/y2 exclusive
+    roi_mask : numpy.ndarray, optional
+        Boolean (H, W) region of interest of the scene
+    
+    Returns:
+    --------
+    numpy.ndarray
+        Boolean mask of shape (y2 - y1, x2 - x1)
+    """
+    width, height = scene_size(after)
+    margin = 4 * smoothing_radius
+    x1, y1, x2, y2 = box
+    window = (max(x1 - margin, 0), max(y1 - margin, 0), min(x2 + margin, width), min(y2 + margin, height))
+    
+    after_window = read_window(after, window)
+    if before is not None:
+        mask, _ = detect_vegetation_loss(read_window(before, window), after_window, threshold)
+    else:
+        mask, _ = detect_bare_ground(after_window)
+    mask = smooth_mask(mask, smoothing_radius)[y1 - window[1]:y2 - window[1], x1 - window[0]:x2 - window[0]]
+    if roi_mask is not None:
+        mask &= roi_mask[y1:y2, x1:x2]
+    return mask
+
+def outline_areas_tiled(after, before, deforested_areas, threshold=0.15, smoothing_radius=0,
+                        tile_size=2048, memory_limit_mb=None, roi_mask=None):
+    """
+    Trace the outlines of areas found by the tiled analysis.
+    
+    The change mask is re-read one tile window at a time and every area lying
+    inside the window is outlined from it. Areas spanning tiles are then
+    outlined from a window around their own box, unless that box is too
+    large for the memory ceiling, in which case they keep only their
+    bounding box.
+    
+    Parameters:
+    -----------
+    after : PIL.Image or numpy.ndarray
+        The analyzed later image (or the only image)
+    before : PIL.Image or numpy.ndarray, optional
+        The earlier image, same size as after
+    deforested_areas : list
+        Areas from analyze_scene_tiled; updated in place
+    
+    Returns:
+    --------
+    list
+        deforested_areas
+    """
+    width, height = scene_size(after)
+    if memory_limit_mb is not None:
+        tile_size = min(tile_size, tile_size_for_memory(memory_limit_mb))
+    
+    # Areas go to the tile holding their top-left corner, whose window
+    # extends a tile to the right and below so most areas fit inside it
+    pending = {}
+    for area in deforested_areas:
+        pending.setdefault((area["y1"] // tile_size, area["x1"] // tile_size), []).append(area)
+    for (row, col), areas in pending.items():
+        x0, y0 = col * tile_size, row * tile_size
+        box = (x0, y0, min(x0 + 2 * tile_size, width), min(y0 + 2 * tile_size, height))
+        inside = [area for area in areas if area["x2"] <= box[2] and area["y2"] <= box[3]]
+        if inside:
+            mask = read_change_mask(after, before, box, threshold, smoothing_radius, roi_mask)
+            outline_areas(mask, inside, box[:2])
+    
+    return attach_polygons(
+        deforested_areas,
+        lambda box: read_change_mask(after, before, box, threshold, smoothing_radius, roi_mask),
+        max_pixels=tile_size * tile_size * 4
+    )
+
+def write_change_mask(path, after, before, scene_size, window=None, threshold=0.15, smoothing_radius=0,
+                      roi_mask=None):
+    """
+    Write the change mask of an analysis to a tiled raster file.
+    
+    The mask is computed a band of rows at a time with read_change_mask,
+    so it is never held whole.
+    
+    Parameters:
+    -----------
+    path : str
+        Destination file
+    after : PIL.Image or numpy.ndarray
+        The analyzed later image (or the only image), or its analyzed window
+    before : PIL.Image or numpy.ndarray, optional
+        The earlier image, same size as after
+    scene_size : tuple
+        (width, height) of the whole scene
+    window : tuple, optional
+        (x0, y0, x1, y1) of the scene that after covers; the mask is empty
+        outside it
+    """
+    scene_width, scene_height = scene_size
+    x0, y0, x1, y1 = window if window is not None else (0, 0, scene_width, scene_height)
+    
+    def read_rows(top, bottom):
+        rows = np.zeros((bottom - top, scene_width), dtype=bool)
+        first, last = max(top, y0), min(bottom, y1)
+        if last > first:
+            rows[first - top:last - top, x0:x1] = read_change_mask(
+                after, before, (0, first - y0, x1 - x0, last - y0), threshold, smoothing_radius, roi_mask
+            )
+        return rows
+    
+    write_raster_rows(path, (scene_height, scene_width), bool, read_rows, metadata={"kind": "change_mask"})
+
+def render_detection_overlay_tiled(image, deforested_areas, tile_size=2048, in_place=False, **style):
+    """
+    Highlight detected areas tile by tile to bound rendering memory.
+    
+    Accepts the same style keyword arguments as render_detection_overlay.
+    
+    Parameters:
+    -----------
+    image : PIL.Image
+        The image to annotate
+    deforested_areas : list
+        List of dictionaries with x1, y1, x2, y2 bounding boxes
+    tile_size : int
+        Side length of each rendered tile
+    in_place : bool
+        Draw into image itself when it is RGB, instead of into a copy
+    
+    Returns:
+    --------
+    PIL.Image
+        RGB image with the detections highlighted
+    """
+    # The only full-size copy is the returned image; tiles are drawn into it
+    result = image if in_place and image.mode == 'RGB' else image.convert('RGB')
+    
+    boxes = np.array(
+        [[area["x1"], area["y1"], area["x2"], area["y2"]] for area in deforested_areas],
+        dtype=np.int64
+    ).reshape(-1, 4)
+    
+    width, height = image.size
+    for tile in iter_tile_windows(width, height, tile_size, overlap=0):
+        x0, y0, x1, y1 = tile["core"]
+        inside = (boxes[:, 0] < x1) & (boxes[:, 2] > x0) & (boxes[:, 1] < y1) & (boxes[:, 3] > y0)
+        if not inside.any():
+            continue
+        
+        # Boxes are shifted into tile coordinates and clipped by the renderer
+        shifted = boxes[inside] - np.array([x0, y0, x0, y0])
+        tile_areas = [{"x1": bx1, "y1": by1, "x2": bx2, "y2": by2} for bx1, by1, bx2, by2 in shifted.tolist()]
+        rendered = render_detection_overlay(result.crop(tile["core"]), tile_areas, **style)
+        result.paste(rendered, (x0, y0))
+    
+    return result
+
+def process_satellite_scene(image, before_image=None, threshold=0.15, min_region_pixels=50,
+                            pixel_size_m=30.0, tile_size=2048, memory_limit_mb=None, workers=None,
+                            align=True, normalize=False, smoothing_radius=0, progressive=False,
+                            on_preview=None, roi=None, mask_path=None):
+    """
+    Process a satellite image, switching to tiled analysis for large scenes.
+    
+    Takes the same arguments and returns the same (processed_image,
+    deforested_areas) tuple as process_satellite_image. Scenes whose
+    whole-image analysis would exceed the memory ceiling are tiled.
+    
+    Parameters:
+    -----------
+    image : PIL.Image
+        The satellite image to process
+    before_image : PIL.Image, optional
+        Earlier image of the same scene
+    tile_size : int
+        Maximum side length of each tile core when tiling
+    memory_limit_mb : float, optional
+        Memory ceiling for the analysis working set, defaults to
+        DEFAULT_MEMORY_LIMIT_MB (FORESTSIGHT_MEMORY_LIMIT_MB in the environment)
+    workers : int, optional
+        Number of processes analyzing tiles, defaults to all available CPUs
+        and never more; 1 keeps the analysis in the calling process
+    align : bool
+        Co-register before_image to image by translation first, so small
+        offsets between the uploads are not detected as change
+    normalize : bool
+        Match the histograms of image to before_image before comparing them,
+        so lighting and seasonal differences are not detected as change
+    smoothing_radius : int
+        Radius of the opening and closing that remove speckle from the
+        change mask; 0 disables smoothing
+    progressive : bool
+        Analyze coarse to fine with utils.progressive: a 1/8-scale pass
+        first, then full resolution only around its candidates
+    on_preview : callable, optional
+        With progressive, called as on_preview(preview_image, preview_areas)
+        as soon as the coarse pass is done
+    roi : list, optional
+        Region of interest as polygons of [x, y] pixel coordinates, e.g.
+        from utils.roi.drawings_to_polygons. Only its bounding window is
+        analyzed and change outside the polygons is ignored
+    mask_path : str, optional
+        Also write the change mask of the whole scene to this file as a
+        tiled raster (utils.raster_store), a band of rows at a time
+    
+    Returns:
+    --------
+    tuple
+        (processed_image, deforested_areas)
+    """
+    if memory_limit_mb is None:
+        memory_limit_mb = DEFAULT_MEMORY_LIMIT_MB
+    if before_image is not None and before_image.size != image.size:
+        before_image = before_image.resize(image.size, Image.BILINEAR)
+    
+    # Only the bounding window of a region of interest is read and analyzed
+    full_image, window, roi_mask = image, None, None
+    if roi is not None:
+        window = roi_window(roi, image.size)
+        if window is None:
+            return image.convert('RGB'), []
+        roi_mask = rasterize_roi(roi, window)
+        image = image.crop(window)
+        if before_image is not None:
+            before_image = before_image.crop(window)
+    
+    # The overlay is drawn on the original image, whatever is analyzed
+    analyzed = image
+    if before_image is not None:
+        if normalize:
+            analyzed = match_histograms(image, before_image)
+        if align:
+            # Windows of the aligned image are warped as the analysis reads them
+            before_image, _ = coregister(before_image, analyzed, lazy=True)
+    
+    width, height = image.size
+    processed_image = None
+    if progressive:
+        # Imported here because utils.progressive builds on this module
+        from utils.progressive import analyze_scene_progressive, REFINE_TILE_SIZE
+        tile_size = min(tile_size, REFINE_TILE_SIZE, tile_size_for_memory(memory_limit_mb))
+        deforested_areas = analyze_scene_progressive(
+            analyzed, before_image, threshold, min_region_pixels, pixel_size_m,
+            tile_size=tile_size, smoothing_radius=smoothing_radius, on_preview=on_preview, roi_mask=roi_mask
+        )
+    elif width * height * ANALYSIS_BYTES_PER_PIXEL <= memory_limit_mb * 1024 * 1024:
+        if isinstance(before_image, AlignedImage):
+            before_image = before_image.to_image()
+        processed_image, deforested_areas = process_satellite_image(
+            analyzed, before_image, threshold, min_region_pixels, pixel_size_m,
+            smoothing_radius, overlay_image=image, roi_mask=roi_mask
+        )
+    elif workers == 1 or roi_mask is not None:
+        # Region-of-interest windows are analyzed in this process
+        deforested_areas = analyze_scene_tiled(
+            analyzed, before_image, threshold, min_region_pixels, pixel_size_m,
+            tile_size=tile_size, memory_limit_mb=memory_limit_mb, smoothing_radius=smoothing_radius,
+            roi_mask=roi_mask
+        )
+    else:
+        # Imported here because utils.parallel builds on this module
+        from utils.parallel import analyze_scene_parallel
+        deforested_areas = analyze_scene_parallel(
+            analyzed, before_image, threshold, min_region_pixels, pixel_size_m,
+            tile_size=tile_size, memory_limit_mb=memory_limit_mb, workers=workers,
+            smoothing_radius=smoothing_radius
+        )
+    
+    if processed_image is None:
+        outline_areas_tiled(analyzed, before_image, deforested_areas, threshold, smoothing_radius,
+                            tile_size, memory_limit_mb, roi_mask)
+        # A region-of-interest window is a crop of its own, drawn on directly
+        processed_image = render_detection_overlay_tiled(image, deforested_areas, tile_size,
+                                                         in_place=window is not None)
+    
+    if mask_path is not None:
+        write_change_mask(mask_path, analyzed, before_image, full_image.size, window, threshold,
+                          smoothing_radius, roi_mask)
+    
+    if window is not None:
+        shift_areas(deforested_areas, window[0], window[1])
+        result = full_image.convert('RGB')
+        result.paste(processed_image, window[:2])
+        processed_image = result
+    return processed_image, deforested_areas
@@ -0,0 +1,208 @@
+import io
+import bisect
+from collections import OrderedDict
+import numpy as np
+from PIL import Image, ImageDraw, features
+
+from utils.image_processing import blend_arrays
+from utils.pyramid import get_image_pyramid
+
+# Encoded frames kept per time-lapse; scrubbing back and forth over a few
+# years is served from here
+DEFAULT_FRAME_CACHE_SIZE = 8
+
+# Animated WebP keeps full colour; GIF is the fallback when Pillow was built
+# without WebP support
+ANIMATION_FORMAT = "WEBP" if features.check("webp") else "GIF"
+
+# Encoded animations kept per time-lapse; each is a few MB, and only the
+# current playback speed is usually needed
+ANIMATION_CACHE_SIZE = 2
+
+class TimelapseFrames:
+    """
+    Time-lapse frames computed on demand from a few keyframes.
+    
+    Frames between two keyframes are blended from them when requested, at
+    the resolution they are displayed at, and the last few encoded frames
+    are kept in an LRU. Only the keyframes are held in memory, however many
+    years the time-lapse spans. With a store, not even those: keyframes are
+    looked up in it by name whenever a frame is computed.
+    """
+    
+    def __init__(self, keyframes, years, cache_size=DEFAULT_FRAME_CACHE_SIZE, image_format="JPEG", quality=85,
+                 store=None):
+        """
+        Parameters:
+        -----------
+        keyframes : dict
+            PIL images of the same size keyed by year, or with a store, the
+            names of such images in it; at least one
+        years : list
+            Every year of the time-lapse, each between the first and last
+            keyframe years
+        cache_size : int
+            Number of encoded frames kept
+        image_format : str
+            PIL format the frames are encoded in
+        quality : int
+            Encoder quality for lossy formats
+        store : SessionImageStore, optional
+            Store holding the keyframes named in keyframes
+        """
+        if not keyframes:
+            raise ValueError("A time-lapse needs at least one keyframe")
+        self.store = store
+        self.keyframe_years = sorted(keyframes)
+        self.keyframes = [keyframes[year] for year in self.keyframe_years]
+        sizes = {self._keyframe(index).size for index in range(len(self.keyframes))}
+        if len(sizes) != 1:
+            raise ValueError("Time-lapse keyframes must have the same size")
+        
+        self.years = sorted(years)
+        if self.years and not self.keyframe_years[0] <= self.years[0] <= self.years[-1] <= self.keyframe_years[-1]:
+            raise ValueError("Time-lapse years must lie between the first and last keyframe")
+        self.size = sizes.pop()
+        self.cache_size = cache_size
+        self.image_format = image_format
+        self.quality = quality
+        self._encoded = OrderedDict()
+        self._animations = OrderedDict()
+    
+    def __len__(self):
+        return len(self.years)
+    
+    def __contains__(self, year):
+        return year in self.years
+    
+    @property
+    def shape(self):
+        """Shape (T, H, W, 3) of the full-resolution frame stack."""
+        return (len(self.years), self.size[1], self.size[0], 3)
+    
+    def _keyframe(self, index):
+        """The RGB image of a keyframe, from the store if there is one."""
+        image = self.keyframes[index] if self.store is None else self.store[self.keyframes[index]]
+        return image if image.mode == 'RGB' else image.convert('RGB')
+    
+    def _neighbours(self, year):
+        """Keyframe indices around a year and the blend fraction between them."""
+        after = bisect.bisect_left(self.keyframe_years, year)
+        if after < len(self.keyframe_years) and self.keyframe_years[after] == year:
+            return after, after, 0.0
+        before = after - 1
+        start, end = self.keyframe_years[before], self.keyframe_years[after]
+        return before, after, (year - start) / (end - start)
+    
+    def frame(self, year, width=None):
+        """
+        Compute the frame of a year.
+        
+        Parameters:
+        -----------
+        year : int
+            A year of the time-lapse
+        width : int, optional
+            Display width; the frame is blended from the smallest keyframe
+            pyramid levels at least this wide. None gives full resolution
+        
+        Returns:
+        --------
+        PIL.Image
+            RGB frame
+        """
+        if year not in self:
+            raise KeyError(year)
+        before, after, fraction = self._neighbours(year)
+        keyframes = [self._keyframe(index) for index in (before, after)]
+        levels = [image if width is None else get_image_pyramid(image).for_width(width) for image in keyframes]
+        if before == after:
+            return levels[0]
+        return Image.fromarray(blend_arrays(np.asarray(levels[0]), np.asarray(levels[1]), fraction))
+    
+    def encoded_frame(self, year, width=None):
+        """
+        Return the frame of a year encoded for display, from the LRU if present.
+        
+        Returns:
+        --------
+        bytes
+            The encoded frame, ready for st.image
+        """
+        key = (year, width)
+        encoded = self._encoded.get(key)
+        if encoded is not None:
+            self._encoded.move_to_end(key)
+            return encoded
+        
+        buffer = io.BytesIO()
+        self.frame(year, width).save(buffer, format=self.image_format, quality=self.quality)
+        encoded = buffer.getvalue()
+        self._encoded[key] = encoded
+        while len(self._encoded) > self.cache_size:
+            self._encoded.popitem(last=False)
+        return encoded
+    
+    def read_band(self, top, bottom):
+        """
+        Full-resolution rows top..bottom of every frame, oldest first.
+        
+        Returns:
+        --------
+        numpy.ndarray
+            uint8 array of shape (T, bottom - top, W, 3)
+        """
+        width = self.size[0]
+        band_keyframes = [np.asarray(self._keyframe(index).crop((0, top, width, bottom)))
+                          for index in range(len(self.keyframes))]
+        band = np.empty((len(self.years), band_keyframes[0].shape[0], width, 3), dtype=np.uint8)
+        for i, year in enumerate(self.years):
+            before, after, fraction = self._neighbours(year)
+            blend_arrays(band_keyframes[before], band_keyframes[after], fraction, out=band[i])
+        return band
+    
+    def animation(self, width, frame_duration_ms=1000, image_format=ANIMATION_FORMAT):
+        """
+        Encode the whole time-lapse as one looping animation.
+        
+        Each frame is labelled with its year. The last ANIMATION_CACHE_SIZE
+        animations (by width, speed and format) are kept and reused, so the
+        browser can play one without the app re-running for every frame.
+        
+        Parameters:
+        -----------
+        width : int
+            Display width of the frames
+        frame_duration_ms : int
+            Time each year is shown for
+        image_format : str
+            "WEBP" or "GIF"
+        
+        Returns:
+        --------
+        bytes
+            The encoded animation
+        """
+        key = (width, int(frame_duration_ms), image_format)
+        animation = self._animations.get(key)
+        if animation is not None:
+            self._animations.move_to_end(key)
+        else:
+            frames = []
+            for year in self.years:
+                # frame() may return a shared keyframe level; label a copy
+                frame = self.frame(year, width).copy()
+                draw = ImageDraw.Draw(frame)
+                left, top, right, bottom = draw.textbbox((8, 8), str(year))
+                draw.rectangle((left - 4, top - 4, right + 4, bottom + 4), fill=(0, 0, 0))
+                draw.text((8, 8), str(year), fill=(255, 255, 255))
+                frames.append(frame)
+            buffer = io.BytesIO()
+            options = {"quality": self.quality} if image_format == "WEBP" else {"optimize": True}
+            frames[0].save(buffer, format=image_format, save_all=True, append_images=frames[1:],
+                           duration=int(frame_duration_ms), loop=0, **options)
+            animation = buffer.getvalue()
+            self._animations[key] = animation
+            while len(self._animations) > ANIMATION_CACHE_SIZE:
+                self._animations.popitem(last=False)
+        return animation
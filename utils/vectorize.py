@@ -0,0 +1,372 @@
+import math
+import numpy as np
+
+from utils.labeling import find_runs, label_runs, region_properties, runs_to_labels
+
+# Boundary steps in clockwise order on screen (y pointing down): east,
+# south, west, north. Turning right from direction d gives (d + 1) % 4.
+_STEPS = np.array([[1, 0], [0, 1], [-1, 0], [0, -1]], dtype=np.int64)
+
+# Ground size of one screen pixel at zoom 0 on the equator in Web Mercator
+_METRES_PER_PIXEL_ZOOM_0 = 156543.03392
+
+def trace_rings(mask):
+    """
+    Trace the boundaries of a mask as closed rings of pixel corners.
+    
+    Every pixel edge between a set and an unset pixel is a unit step,
+    directed so the set pixel is on its right. Each step is followed by the
+    step leaving its end corner that turns right, goes straight or turns
+    left, in that order of preference; preferring the right turn keeps
+    diagonally touching pixels apart, as in 4-connected labeling. Rings are
+    then found and ordered with pointer jumping over the successor array.
+    
+    Parameters:
+    -----------
+    mask : numpy.ndarray
+        Boolean (H, W) array
+    
+    Returns:
+    --------
+    list
+        int64 arrays of shape (N, 2) with the (x, y) corners of each ring,
+        without repeated closing vertex and without collinear vertices.
+        Outer boundaries run clockwise on screen, holes anticlockwise.
+    """
+    height, width = mask.shape
+    padded = np.zeros((height + 2, width + 2), dtype=bool)
+    padded[1:-1, 1:-1] = mask
+    inner = padded[1:-1, 1:-1]
+    
+    # Start corner of the boundary step on each side of a set pixel
+    starts, directions = [], []
+    for direction, neighbour, corner in ((0, padded[:-2, 1:-1], (0, 0)),   # top edge, eastwards
+                                         (1, padded[1:-1, 2:], (1, 0)),    # right edge, southwards
+                                         (2, padded[2:, 1:-1], (1, 1)),    # bottom edge, westwards
+                                         (3, padded[1:-1, :-2], (0, 1))):  # left edge, northwards
+        ys, xs = np.nonzero(inner & ~neighbour)
+        starts.append(np.column_stack((xs + corner[0], ys + corner[1])))
+        directions.append(np.full(xs.size, direction, dtype=np.int64))
+    start = np.concatenate(starts)
+    direction = np.concatenate(directions)
+    num_steps = direction.size
+    if num_steps == 0:
+        return []
+    
+    def step_key(corners, step_direction):
+        return (corners[:, 1] * (width + 1) + corners[:, 0]) * 4 + step_direction
+    
+    keys = step_key(start, direction)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    
+    # Successor of each step: the first existing step out of its end corner
+    end = start + _STEPS[direction]
+    successor = np.full(num_steps, -1, dtype=np.int64)
+    for turn in (1, 0, 3):
+        open_steps = successor < 0
+        candidate = step_key(end[open_steps], (direction[open_steps] + turn) % 4)
+        position = np.minimum(np.searchsorted(sorted_keys, candidate), num_steps - 1)
+        found = sorted_keys[position] == candidate
+        successor[np.flatnonzero(open_steps)[found]] = order[position[found]]
+    
+    # Ring id: smallest step index on each ring, spread by pointer jumping
+    ring = np.arange(num_steps)
+    jump = successor.copy()
+    for _ in range(max(1, math.ceil(math.log2(num_steps)))):
+        ring = np.minimum(ring, ring[jump])
+        jump = jump[jump]
+    
+    # Position along each ring: cut the ring before its first step and count
+    # the steps remaining to the cut
+    is_last = successor == ring
+    following = np.where(is_last, np.arange(num_steps), successor)
+    remaining = (~is_last).astype(np.int64)
+    for _ in range(max(1, math.ceil(math.log2(num_steps)))):
+        remaining = remaining + remaining[following]
+        following = following[following]
+    
+    # Walk order: by ring, then from the first step to the last
+    walk = np.lexsort((-remaining, ring))
+    ring_sorted = ring[walk]
+    direction_sorted = direction[walk]
+    corners = start[walk]
+    ring_starts = np.concatenate(([0], np.flatnonzero(np.diff(ring_sorted)) + 1))
+    ring_ends = np.append(ring_starts[1:], num_steps)
+    
+    # Keep only corners where the direction changes, comparing each ring's
+    # first step with its last
+    previous = np.empty_like(direction_sorted)
+    previous[1:] = direction_sorted[:-1]
+    previous[ring_starts] = direction_sorted[ring_ends - 1]
+    turns = direction_sorted != previous
+    kept_per_ring = np.add.reduceat(turns, ring_starts)
+    return np.split(corners[turns], np.cumsum(kept_per_ring)[:-1])
+
+def ring_signed_area(ring):
+    """Shoelace area of a ring; positive for clockwise rings on screen."""
+    x, y = ring[:, 0].astype(np.float64), ring[:, 1].astype(np.float64)
+    return 0.5 * float(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+
+def simplify_line(points, tolerance):
+    """
+    Douglas-Peucker simplification of an open polyline.
+    
+    Parameters:
+    -----------
+    points : numpy.ndarray
+        (N, 2) array of vertices
+    tolerance : float
+        Largest distance a removed vertex may lie from the simplified line
+    
+    Returns:
+    --------
+    numpy.ndarray
+        The kept vertices, including both end points
+    """
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    points = points.astype(np.float64)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        segment = points[last] - points[first]
+        offsets = points[first + 1:last] - points[first]
+        length = math.hypot(segment[0], segment[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+def simplify_ring(ring, tolerance):
+    """
+    Douglas-Peucker simplification of a closed ring.
+    
+    The ring is split at its first vertex and the vertex farthest from it,
+    and both halves are simplified as polylines. Rings that would collapse
+    to fewer than three vertices are returned unchanged.
+    
+    Returns:
+    --------
+    numpy.ndarray
+        (M, 2) float64 array of the kept vertices, without closing vertex
+    """
+    if len(ring) <= 4 or tolerance <= 0:
+        return ring.astype(np.float64)
+    offsets = ring - ring[0]
+    split = int(np.argmax(offsets[:, 0] ** 2 + offsets[:, 1] ** 2))
+    closed = np.vstack((ring, ring[:1]))
+    simplified = np.vstack((simplify_line(closed[:split + 1], tolerance)[:-1],
+                            simplify_line(closed[split:], tolerance)[:-1]))
+    return simplified if len(simplified) >= 3 else ring.astype(np.float64)
+
+def ring_pixels(rings):
+    """
+    Pixel on the inner side of each ring, as (rows, columns) arrays.
+    
+    The first edge of a traced ring has its region on the right, so the
+    pixel there belongs to the region it outlines (for holes, the region
+    around the hole).
+    """
+    first = np.array([ring[0] for ring in rings], dtype=np.int64).reshape(-1, 2)
+    heading = np.sign(np.array([ring[1] - ring[0] for ring in rings], dtype=np.int64).reshape(-1, 2))
+    # East: pixel below-right of the corner; south: below-left;
+    # west: above-left; north: above-right
+    columns = first[:, 0] - (heading[:, 0] < 0) - (heading[:, 1] > 0)
+    rows = first[:, 1] - (heading[:, 0] < 0) - (heading[:, 1] < 0)
+    return rows, columns
+
+def region_polygon(region_mask, tolerance=1.0):
+    """
+    Vectorize one region into a polygon with holes.
+    
+    Parameters:
+    -----------
+    region_mask : numpy.ndarray
+        Boolean (H, W) array holding a single 4-connected region
+    tolerance : float
+        Douglas-Peucker tolerance in pixels; 1.0 removes the pixel staircase
+        while keeping the outline within a pixel of the region
+    
+    Returns:
+    --------
+    list
+        Rings as lists of [x, y] pixel-corner coordinates, the outer ring
+        first and holes after it
+    """
+    rings = trace_rings(region_mask)
+    rings.sort(key=ring_signed_area, reverse=True)
+    return [np.round(simplify_ring(ring, tolerance), 2).tolist() for ring in rings]
+
+def outline_areas(mask, deforested_areas, offset=(0, 0), tolerance=1.0):
+    """
+    Trace the outlines of detected areas lying inside a mask window.
+    
+    The window is labeled once and each area is matched to the component
+    with the same bounding box and pixel count. The boundaries of all
+    matched components are traced together and every ring is assigned to
+    its component by the pixel on its inner side.
+    
+    Parameters:
+    -----------
+    mask : numpy.ndarray
+        Boolean change mask of the window
+    deforested_areas : list
+        Area dictionaries in scene coordinates; matched ones get a
+        'polygon' entry
+    offset : tuple
+        (x, y) scene position of the window's top-left pixel
+    tolerance : float
+        Douglas-Peucker tolerance in pixels for the stored outlines
+    
+    Returns:
+    --------
+    int
+        Number of areas outlined
+    """
+    runs = find_runs(mask)
+    run_labels, num_labels = label_runs(runs, mask.shape[1])
+    # Only counts and boxes are needed, so confidence is left at zero
+    stats = region_properties(runs, run_labels, num_labels, np.zeros(int(mask.sum()), dtype=np.float32))
+    components = {
+        key: label + 1
+        for label, key in enumerate(zip(stats["x1"] + offset[0], stats["y1"] + offset[1],
+                                        stats["x2"] + offset[0], stats["y2"] + offset[1],
+                                        stats["pixel_count"]))
+    }
+    
+    matched = {}
+    for area in deforested_areas:
+        label = components.get((area["x1"], area["y1"], area["x2"], area["y2"], area["pixel_count"]))
+        if label is not None:
+            matched[label] = area
+    if not matched:
+        return 0
+    
+    # Label raster holding only the matched components
+    selected = np.isin(run_labels, list(matched))
+    labels = runs_to_labels(mask.shape, {key: values[selected] for key, values in runs.items()},
+                            run_labels[selected])
+    rings = trace_rings(labels > 0)
+    rows, columns = ring_pixels(rings)
+    
+    polygons = {label: [] for label in matched}
+    for ring, label in zip(rings, labels[rows, columns]):
+        polygons[label].append(ring)
+    for label, area in matched.items():
+        region_rings = polygons[label]
+        if len(region_rings) > 1:
+            region_rings.sort(key=ring_signed_area, reverse=True)
+        area["polygon"] = [
+            np.round(simplify_ring(ring, tolerance) + offset, 2).tolist() for ring in region_rings
+        ]
+    return len(matched)
+
+def attach_polygons(deforested_areas, read_mask, tolerance=1.0, max_pixels=None):
+    """
+    Add a 'polygon' entry with the traced outline to every area.
+    
+    Parameters:
+    -----------
+    deforested_areas : list
+        Area dictionaries from regions_to_areas; updated in place
+    read_mask : callable
+        Returns the change mask inside a pixel box (x1, y1, x2, y2)
+    tolerance : float
+        Douglas-Peucker tolerance in pixels for the stored outline
+    max_pixels : int, optional
+        Areas whose bounding box holds more pixels are left without an
+        outline, bounding the memory needed to read their mask
+    
+    Returns:
+    --------
+    list
+        deforested_areas
+    """
+    for area in deforested_areas:
+        if "polygon" in area:
+            continue
+        box = (area["x1"], area["y1"], area["x2"], area["y2"])
+        if max_pixels is not None and (box[2] - box[0]) * (box[3] - box[1]) > max_pixels:
+            continue
+        outline_areas(read_mask(box), [area], box[:2], tolerance)
+    return deforested_areas
+
+def tolerance_for_zoom(zoom, latitude, pixel_size_m=30.0, screen_pixels=0.5):
+    """
+    Simplification tolerance in image pixels for a web map zoom level.
+    
+    Parameters:
+    -----------
+    zoom : int
+        Web Mercator zoom level
+    latitude : float
+        Latitude of the scene in degrees
+    pixel_size_m : float
+        Ground sampling distance of one image pixel in metres
+    screen_pixels : float
+        Largest acceptable error on screen in screen pixels
+    
+    Returns:
+    --------
+    float
+        Tolerance in image pixels
+    """
+    metres_per_screen_pixel = _METRES_PER_PIXEL_ZOOM_0 * math.cos(math.radians(latitude)) / 2 ** zoom
+    return screen_pixels * metres_per_screen_pixel / pixel_size_m
+
+def areas_to_geojson(deforested_areas, to_lonlat, tolerance=0.0):
+    """
+    Convert detected areas into one GeoJSON FeatureCollection.
+    
+    Areas with a traced 'polygon' keep their outline, simplified further at
+    tolerance; others fall back to their bounding box.
+    
+    Parameters:
+    -----------
+    deforested_areas : list
+        Area dictionaries in image pixel coordinates
+    to_lonlat : callable
+        Maps arrays of pixel x and y coordinates to arrays of longitude and
+        latitude
+    tolerance : float
+        Douglas-Peucker tolerance in image pixels, e.g. from tolerance_for_zoom
+    
+    Returns:
+    --------
+    dict
+        GeoJSON FeatureCollection with one Polygon feature per area
+    """
+    features = []
+    for index, area in enumerate(deforested_areas or []):
+        rings = area.get("polygon") or [[[area["x1"], area["y1"]], [area["x2"], area["y1"]],
+                                         [area["x2"], area["y2"]], [area["x1"], area["y2"]]]]
+        coordinates = []
+        for ring in rings:
+            # Latitude grows upwards, so clockwise-on-screen outer rings stay
+            # clockwise on the map; reversing them gives GeoJSON's
+            # anticlockwise outer rings and clockwise holes
+            ring = simplify_ring(np.asarray(ring, dtype=np.float64), tolerance)[::-1]
+            lon, lat = to_lonlat(ring[:, 0], ring[:, 1])
+            coordinates.append(np.column_stack((np.append(lon, lon[0]), np.append(lat, lat[0])))
+                               .round(7).tolist())
+        properties = {key: value for key, value in area.items() if key != "polygon"}
+        properties["id"] = index + 1
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": coordinates},
+            "properties": properties,
+        })
+    return {"type": "FeatureCollection", "features": features}